@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Import-time benchmarks for Patchwork modules.
+
+Each module is imported in a fresh interpreter, several times over, and the
+median wall time of the ``import`` statement itself is reported. An initial,
+discarded run makes sure bytecode is cached (as it would be for an installed
+package), so source compilation isn't measured. By default Fabric (and thus
+Invoke and Paramiko) is imported beforehand, since any real user of
+Patchwork has it loaded anyway; this isolates Patchwork's own cost::
+
+    python benchmarks/imports.py                  # all modules
+    python benchmarks/imports.py files packages   # just these
+    python benchmarks/imports.py --cold           # include Fabric's cost
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = (
+    "agent",
+    "checkpoint",
+    "environment",
+    "files",
+    "info",
+    "instrumentation",
+    "packages",
+    "parallel",
+    "rolling",
+    "scheduler",
+    "state",
+    "transfers",
+    "util",
+)
+
+_SCRIPT = """
+import sys, time
+sys.path.insert(0, {root!r})
+{preload}
+start = time.time()
+import patchwork.{module}
+print(time.time() - start)
+"""
+
+
+def measure(module, runs=7, cold=False):
+    """
+    Return the median number of seconds taken to import ``module``.
+    """
+    script = _SCRIPT.format(
+        root=ROOT, preload="" if cold else "import fabric", module=module
+    )
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable, "-c", script]
+    timings = [
+        float(subprocess.check_output(command, env=env))
+        for _ in range(runs + 1)
+    ]
+    timings = sorted(timings[1:])
+    return timings[len(timings) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "modules", nargs="*", help="Module names (default: all)"
+    )
+    parser.add_argument(
+        "--runs", type=int, default=7, help="Imports per module (default: 7)"
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="Don't preload Fabric"
+    )
+    parser.add_argument("--json", action="store_true", help="Emit JSON")
+    args = parser.parse_args(argv)
+    unknown = set(args.modules) - set(MODULES)
+    if unknown:
+        parser.error("unknown modules: {}".format(", ".join(sorted(unknown))))
+    results = [
+        {"module": x, "seconds": measure(x, args.runs, args.cold)}
+        for x in args.modules or MODULES
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(
+                "patchwork.{:<20} {:>8.2f} ms".format(
+                    result["module"], result["seconds"] * 1000
+                )
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Round-trip benchmarks for Patchwork operations, using a simulated transport.
+
+Each scenario runs a Patchwork operation against a `SimulatedConnection`,
+which never touches the network: it answers every command from a canned
+responder and simply counts it. (Like a real host, it refuses commands too
+long to execute; see `MAX_ARG_STRLEN`.) Since real-world cost is dominated by
+per-command latency, each result reports the number of round trips, the
+local CPU time spent building commands, and the projected wall time
+(``round_trips * latency + cpu``) for the configured latency.
+
+Round-trip counts are deterministic, so they can be compared against a saved
+baseline to catch regressions::
+
+    python benchmarks/roundtrips.py                     # print table
+    python benchmarks/roundtrips.py --check             # fail on regressions
+    python benchmarks/roundtrips.py --write-baseline    # accept new numbers
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import re
+import sys
+import time
+
+# Allow running straight from a checkout.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fabric import Connection, Result  # noqa
+from invoke.exceptions import UnexpectedExit  # noqa
+
+from patchwork import files, info, packages, transfers  # noqa
+from patchwork.util import Pipeline  # noqa
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+SIZES = (1, 100, 10000)
+
+#: Linux's limit on the size of any one argument (including its trailing NUL);
+#: commands reach the shell as a single argument, so none may be longer.
+MAX_ARG_STRLEN = 131072
+
+# CPU time used by this process; Python 2 only has time.clock.
+_cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+# Per-command markers emitted by scripts flushed from a Pipeline.
+_PIPELINE_STEP = re.compile(r"(patchwork-[0-9a-f]{32} \d+)'")
+
+
+def default_responder(command):
+    """
+    Return ``(stdout, stderr, exited)`` for ``command``; a pessimistic host.
+
+    Nothing exists, nothing matches and nothing is installed, so idempotent
+    operations take their most expensive path. Scripts flushed by a
+    `~patchwork.util.Pipeline` report every step as successful.
+    """
+    if command.startswith(("test ", "egrep ", "grep ", "sha256sum ")):
+        return "", "", 1
+    if command.startswith("cat /etc/os-release"):
+        return "ID=debian\n--patchwork-facts--\n", "", 0
+    steps = sorted(set(_PIPELINE_STEP.findall(command)))
+    if steps:
+        stdout = "".join("{0}\n\n{0} 0\n".format(x) for x in steps)
+        stderr = "".join("{0}\n\n{0}\n".format(x) for x in steps)
+        return stdout, stderr, 0
+    return "", "", 0
+
+
+class SimulatedConnection(Connection):
+    """
+    A `~fabric.connection.Connection` whose commands never leave the process.
+
+    Every call to `run`, `sudo` or `local` (plus `put`) counts as one round
+    trip and is answered by ``responder``. Commands of `MAX_ARG_STRLEN` bytes
+    or more raise `OSError` (``E2BIG``), as they would on a real host.
+    """
+
+    def __init__(self, responder=default_responder, **kwargs):
+        super(SimulatedConnection, self).__init__(
+            "sim", user="bench", **kwargs
+        )
+        self.config.run.in_stream = False
+        # Real attributes, so they aren't proxied into config.
+        object.__setattr__(self, "responder", responder)
+        object.__setattr__(self, "commands", [])
+
+    def _respond(self, command, **kwargs):
+        if len(command.encode("utf-8")) >= MAX_ARG_STRLEN:
+            raise OSError(errno.E2BIG, "Argument list too long")
+        self.commands.append(command)
+        stdout, stderr, exited = self.responder(command)
+        result = Result(
+            connection=self,
+            command=command,
+            stdout=stdout,
+            stderr=stderr,
+            exited=exited,
+        )
+        if exited and not kwargs.get("warn", False):
+            raise UnexpectedExit(result)
+        return result
+
+    def run(self, command, **kwargs):
+        return self._respond(command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self._respond(command, **kwargs)
+
+    def local(self, command, **kwargs):
+        return self._respond(command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        self.commands.append("put {}".format(remote))
+
+
+def _lines(n):
+    return ["line {}".format(x) for x in range(n)]
+
+
+def _paths(n):
+    return ["/srv/path{}".format(x) for x in range(n)]
+
+
+def _directories_pipelined(c, n):
+    with Pipeline(c) as pipe:
+        for path in _paths(n):
+            files.directory(c, path, user="app", mode="0755", runner=pipe)
+
+
+def _exists_each(c, n):
+    for path in _paths(n):
+        files.exists(c, path)
+
+
+def _contains_each(c, n):
+    for line in _lines(n):
+        files.contains(c, "/etc/app.conf", line)
+
+
+def _distro_family_each(c, n):
+    for _ in range(n):
+        info.distro_family(c)
+
+
+def _package(c, n):
+    packages.package(c, *["pkg{}".format(x) for x in range(n)])
+
+
+#: Name -> (callable taking (connection, size), sizes to run it at.)
+SCENARIOS = {
+    "append": (
+        lambda c, n: files.append(c, "/etc/app.conf", _lines(n)),
+        SIZES,
+    ),
+    "append_batch": (
+        lambda c, n: files.append(c, "/etc/app.conf", _lines(n), batch=True),
+        SIZES,
+    ),
+    "directory": (
+        lambda c, n: [
+            files.directory(c, x, user="app", mode="0755") for x in _paths(n)
+        ],
+        SIZES,
+    ),
+    "directory_pipelined": (_directories_pipelined, SIZES),
+    "exists": (_exists_each, SIZES),
+    "exists_many": (lambda c, n: files.exists_many(c, _paths(n)), SIZES),
+    "contains": (_contains_each, SIZES),
+    "distro_family": (_distro_family_each, SIZES),
+    "package": (_package, (1, 100)),
+    # Ten thousand --exclude options don't fit in one command line.
+    "rsync": (
+        lambda c, n: transfers.rsync(c, "src/", "/srv", exclude=_paths(n)),
+        (1, 100),
+    ),
+    "rsync_detect_changes": (
+        lambda c, n: transfers.rsync(
+            c, "src/", "/srv", exclude=_paths(n), detect_changes=True
+        ),
+        (1, 100),
+    ),
+}
+
+
+def run(names=None, latency=0.05):
+    """
+    Run the named scenarios (default: all) and return a list of result dicts.
+    """
+    results = []
+    for name in sorted(names or SCENARIOS):
+        func, sizes = SCENARIOS[name]
+        for size in sizes:
+            c = SimulatedConnection()
+            start = _cpu_time()
+            func(c, size)
+            cpu = _cpu_time() - start
+            trips = len(c.commands)
+            results.append(
+                {
+                    "operation": name,
+                    "size": size,
+                    "round_trips": trips,
+                    "cpu": cpu,
+                    "projected": trips * latency + cpu,
+                }
+            )
+    return results
+
+
+def compare(results, baseline, tolerance=0.0):
+    """
+    Return human-readable regressions of ``results`` against ``baseline``.
+
+    Only round-trip counts are compared, as they're deterministic; a result
+    regresses if it exceeds its baseline by more than ``tolerance`` (a
+    fraction, e.g. ``0.1`` for 10%.)
+    """
+    regressions = []
+    for result in results:
+        key = "{}[{}]".format(result["operation"], result["size"])
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if result["round_trips"] > expected * (1 + tolerance):
+            err = "{}: {} round trips, baseline {}"
+            regressions.append(
+                err.format(key, result["round_trips"], expected)
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "operations", nargs="*", help="Scenario names (default: all)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Simulated per-round-trip latency in seconds (default: 0.05)",
+    )
+    parser.add_argument("--json", action="store_true", help="Emit JSON")
+    parser.add_argument(
+        "--check", action="store_true", help="Fail if worse than baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.0,
+        help="Allowed fractional round-trip increase for --check",
+    )
+    parser.add_argument(
+        "--write-baseline", action="store_true", help="Save as new baseline"
+    )
+    parser.add_argument("--baseline", default=BASELINE, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.operations) - set(SCENARIOS)
+    if unknown:
+        parser.error(
+            "unknown operations: {}".format(", ".join(sorted(unknown)))
+        )
+    results = run(args.operations, latency=args.latency)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        row = "{:<24} {:>7} {:>12} {:>10} {:>14}"
+        print(
+            row.format(
+                "operation", "size", "round trips", "cpu (s)", "projected (s)"
+            )
+        )
+        for r in results:
+            print(
+                row.format(
+                    r["operation"],
+                    r["size"],
+                    r["round_trips"],
+                    "{:.4f}".format(r["cpu"]),
+                    "{:.2f}".format(r["projected"]),
+                )
+            )
+    if args.write_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline) and os.path.getsize(args.baseline):
+            with open(args.baseline) as fd:
+                baseline = json.load(fd)
+        for r in results:
+            baseline["{}[{}]".format(r["operation"], r["size"])] = r[
+                "round_trips"
+            ]
+        with open(args.baseline, "w") as fd:
+            json.dump(baseline, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+    if args.check:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        for line in regressions:
+            print("REGRESSION: {}".format(line), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
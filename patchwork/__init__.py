@@ -0,0 +1,34 @@
+# Submodules are loaded on first attribute access (on Python 3.7+), so e.g.
+# ``import patchwork`` followed by ``patchwork.files.exists(...)`` only ever
+# pays for importing what's actually used.
+
+import importlib
+
+_SUBMODULES = (
+    "agent",
+    "aio",
+    "checkpoint",
+    "environment",
+    "files",
+    "info",
+    "instrumentation",
+    "packages",
+    "parallel",
+    "rolling",
+    "scheduler",
+    "state",
+    "transfers",
+    "util",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES))
@@ -0,0 +1,163 @@
+"""
+Remote half of `patchwork.agent`: runs a batch of file operations.
+
+This file is shipped verbatim (compressed) to the remote end and run there
+via ``python3 -c``, so it must stay self-contained: standard library only,
+and no imports from the rest of Patchwork. The batch arrives base64-encoded
+and zlib-compressed in ``sys.argv[1:]``; results are written to stdout as a
+single JSON line after `MARKER`.
+"""
+
+import base64
+import grp
+import hashlib
+import json
+import os
+import pwd
+import re
+import stat as _stat
+import sys
+import zlib
+
+MARKER = "PATCHWORK-AGENT "
+
+_TYPES = {
+    _stat.S_IFREG: "file",
+    _stat.S_IFDIR: "directory",
+    _stat.S_IFIFO: "fifo",
+    _stat.S_IFSOCK: "socket",
+    _stat.S_IFCHR: "character device",
+    _stat.S_IFBLK: "block device",
+}
+
+
+def _path(path):
+    # Approximates the shell expansion the `files` functions' paths undergo
+    return os.path.expanduser(os.path.expandvars(path))
+
+
+def _lines(path):
+    """
+    Return the lines of ``path`` (as text), or ``None`` if it's missing.
+    """
+    try:
+        with open(path, "rb") as fd:
+            data = fd.read()
+    except (IOError, OSError):
+        return None
+    return data.decode("utf-8", "surrogateescape").splitlines()
+
+
+def exists(path):
+    return os.path.exists(_path(path))
+
+
+def stat(path):
+    try:
+        st = os.stat(_path(path))
+    except OSError:
+        return None
+    kind = _TYPES.get(_stat.S_IFMT(st.st_mode), "other")
+    return [kind, st.st_size, int(st.st_mtime), _stat.S_IMODE(st.st_mode)]
+
+
+def contains(path, text, exact=False, regex=False):
+    if regex:
+        match = re.compile(text).search
+    elif exact:
+        match = text.__eq__
+    else:
+
+        def match(line):
+            return text in line
+
+    return any(match(line) for line in _lines(_path(path)) or [])
+
+
+def append(path, lines, partial=False):
+    path = _path(path)
+    existing = _lines(path) or []
+    added = []
+    with open(path, "ab") as fd:
+        for line in lines:
+            if line and any(
+                x.startswith(line) if partial else x == line
+                for x in existing
+            ):
+                continue
+            fd.write((line + "\n").encode("utf-8", "surrogateescape"))
+            existing.append(line)
+            added.append(line)
+    return added
+
+
+def mkdir(path, user=None, group=None, mode=None):
+    if not os.path.isdir(_path(path)):
+        os.makedirs(_path(path))
+    if user is not None:
+        chown(path, user, group)
+    if mode is not None:
+        chmod(path, mode)
+
+
+def chown(path, user, group=None):
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group or user).gr_gid
+    os.chown(_path(path), uid, gid)
+
+
+def chmod(path, mode):
+    os.chmod(_path(path), int(mode, 8))
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    try:
+        with open(_path(path), "rb") as fd:
+            for chunk in iter(lambda: fd.read(65536), b""):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+OPERATIONS = {
+    "exists": exists,
+    "stat": stat,
+    "contains": contains,
+    "append": append,
+    "mkdir": mkdir,
+    "chown": chown,
+    "chmod": chmod,
+    "checksum": checksum,
+}
+
+
+def run(operations):
+    """
+    Perform each of ``operations`` in turn, returning their outcomes.
+
+    Each outcome is ``{"value": <result>}`` or, if the operation raised an
+    exception, ``{"error": "<description>"}``; failures don't stop the batch.
+    """
+    results = []
+    for operation in operations:
+        operation = dict(operation)
+        name = operation.pop("op")
+        try:
+            value = OPERATIONS[name](**operation)
+        except Exception as e:
+            results.append({"error": "{}: {}".format(type(e).__name__, e)})
+        else:
+            results.append({"value": value})
+    return results
+
+
+def main(argv):
+    payload = zlib.decompress(base64.b64decode("".join(argv)))
+    results = run(json.loads(payload.decode("utf-8")))
+    sys.stdout.write(MARKER + json.dumps(results) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,266 @@
+"""
+Batched file operations, performed by a helper script on the remote end.
+
+Each `.files` function runs at least one shell command of its own, and has to
+smuggle its arguments through shell (and often regex) quoting on the way. A
+`Batch` instead collects structured operations, and `execute` runs all of
+them with a single command: a small, self-contained Python helper is shipped
+inline (compressed) to ``python3 -c``, along with the batch encoded as JSON,
+and sends back structured results::
+
+    from patchwork.agent import Batch
+
+    batch = Batch()
+    batch.mkdir("/srv/app", user="deploy", mode="0755")
+    hosts = batch.append("/etc/hosts", ["10.0.0.5 db"])
+    sums = [batch.checksum(x) for x in ("/etc/app.conf", "/etc/app.env")]
+    results = batch.run(c, sudo=True)
+    results[hosts]  # -> the lines which were actually appended
+
+Nothing but Python 3 is required remotely, and nothing is left behind. Text
+travels as JSON, so no escaping is needed; patterns given to
+`Batch.contains` are *Python* regular expressions. Paths undergo ``~`` and
+environment variable expansion, approximating the shell expansion `.files`
+paths get (but no globbing.)
+"""
+
+import base64
+import json
+import zlib
+
+from invoke.vendor import six
+
+from .files import Stat, _invalidate
+from .util import _MAX_COMMAND, _memoize, set_runner
+
+
+#: Default remote Python interpreter.
+PYTHON = "python3"
+
+# Must match _agent.MARKER (which isn't imported, as it's remote-only code.)
+_MARKER = "PATCHWORK-AGENT "
+
+_BOOTSTRAP = "import base64,zlib;exec(zlib.decompress(base64.b64decode({!r})))"
+
+
+class OperationError(Exception):
+    """
+    Stands in for the result of a batched operation which failed remotely.
+
+    ``operation`` is the operation's `dict` (as in `Batch.operations`) and
+    ``message`` the remote exception's type and message.
+    """
+
+    def __init__(self, operation, message):
+        super(OperationError, self).__init__(operation, message)
+        self.operation = operation
+        self.message = message
+
+
+class BatchError(Exception):
+    """
+    Raised by `execute` if any operation failed (and ``warn`` wasn't set.)
+
+    ``results`` is the complete results list, with an `OperationError` in
+    place of each failed operation's result.
+    """
+
+    def __init__(self, results):
+        errors = [x for x in results if isinstance(x, OperationError)]
+        super(BatchError, self).__init__(errors)
+        self.results = results
+
+
+class Batch(object):
+    """
+    An ordered collection of operations, to be performed by `execute`.
+
+    Each method queues one operation and returns its index within the list
+    of results which `run` (or `execute`) will return.
+    """
+
+    def __init__(self):
+        #: Queued operations, as JSON-friendly dicts.
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def run(self, c, **kwargs):
+        """
+        Shorthand for ``execute(c, batch.operations, **kwargs)``.
+        """
+        return execute(c, self.operations, **kwargs)
+
+    def exists(self, path):
+        """
+        Whether ``path`` exists; `bool`.
+        """
+        return self._add("exists", path=path)
+
+    def stat(self, path):
+        """
+        ``path``'s metadata as a `.files.Stat`, or ``None`` if missing.
+        """
+        return self._add("stat", path=path)
+
+    def contains(self, path, text, exact=False, regex=False):
+        """
+        Whether any line of ``path`` contains ``text``; `bool`.
+
+        :param bool exact: Whether the whole line must equal ``text``.
+        :param bool regex:
+            Whether ``text`` is a Python regular expression, searched for
+            within each line (``exact`` is then ignored; use ``^`` and ``$``.)
+        """
+        return self._add(
+            "contains", path=path, text=text, exact=exact, regex=regex
+        )
+
+    def append(self, path, lines, partial=False):
+        """
+        Append those of ``lines`` which are missing; see `.files.append`.
+
+        A line counts as present if some line of ``path`` equals it (or,
+        with ``partial=True``, starts with it); empty lines are always
+        appended. The result is the `list` of lines actually appended.
+        """
+        if isinstance(lines, six.string_types):
+            lines = [lines]
+        return self._add(
+            "append", path=path, lines=list(lines), partial=partial
+        )
+
+    def mkdir(self, path, user=None, group=None, mode=None):
+        """
+        Ensure directory ``path`` exists; see `.files.directory`.
+
+        Parents are created as needed. ``mode`` must be octal, e.g.
+        ``"0755"``.
+        """
+        return self._add(
+            "mkdir", path=path, user=user, group=group, mode=mode
+        )
+
+    def chown(self, path, user, group=None):
+        """
+        Change ``path``'s owner, and group (which defaults to ``user``.)
+        """
+        return self._add("chown", path=path, user=user, group=group)
+
+    def chmod(self, path, mode):
+        """
+        Change ``path``'s permissions to octal ``mode``, e.g. ``"0640"``.
+        """
+        return self._add("chmod", path=path, mode=mode)
+
+    def checksum(self, path):
+        """
+        ``path``'s SHA-256 hex digest, or ``None`` if it can't be read.
+        """
+        return self._add("checksum", path=path)
+
+    def _add(self, op, **kwargs):
+        kwargs["op"] = op
+        self.operations.append(kwargs)
+        return len(self.operations) - 1
+
+
+@set_runner
+def execute(c, runner, operations, python=PYTHON, warn=False):
+    """
+    Perform ``operations`` remotely, in order, with a single command.
+
+    Failed operations don't stop the ones after them. Batches too large for
+    one command line (mostly due to `Batch.append` lines) are split over as
+    many commands as needed, run one after the other.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param operations:
+        Iterable of operation dicts, e.g. a `Batch`'s ``operations``.
+    :param str python:
+        Remote Python 3 interpreter to run the helper with.
+    :param bool warn:
+        Whether to return failed operations' `OperationError` objects among
+        the results, instead of raising `BatchError`.
+
+    :returns:
+        A `list` holding each operation's result, in order; see the `Batch`
+        methods for what those are.
+    :raises:
+        `ValueError` if a single operation is too large for a command line.
+    """
+    operations = list(operations)
+    if not operations:
+        return []
+    for operation in operations:
+        op = operation["op"]
+        if op in ("append", "mkdir", "chown", "chmod"):
+            _invalidate(c, operation["path"], parents=op == "mkdir")
+    outcomes = []
+    for command in _commands(operations, python):
+        outcomes.extend(_parse(runner(command, hide=True).stdout))
+    results = []
+    for operation, outcome in zip(operations, outcomes):
+        if "error" in outcome:
+            results.append(OperationError(operation, outcome["error"]))
+        elif operation["op"] == "stat" and outcome["value"] is not None:
+            results.append(Stat(*outcome["value"]))
+        else:
+            results.append(outcome["value"])
+    if not warn and any(isinstance(x, OperationError) for x in results):
+        raise BatchError(results)
+    return results
+
+
+def _commands(operations, python, limit=_MAX_COMMAND):
+    """
+    Return commands performing ``operations``, each under ``limit`` bytes.
+
+    The whole command line reaches the remote shell as one argument, which
+    Linux caps at 128KiB; so batches which don't fit are halved (repeatedly,
+    if need be) instead.
+    """
+    command = _command(operations, python)
+    if len(command) < limit:
+        return [command]
+    if len(operations) == 1:
+        err = "Operation too large for one command line: {!r}"
+        raise ValueError(err.format(operations[0]["op"]))
+    half = len(operations) // 2
+    return _commands(operations[:half], python, limit) + _commands(
+        operations[half:], python, limit
+    )
+
+
+def _command(operations, python):
+    # base64 needs no quoting
+    payload = _encode(json.dumps(operations).encode("utf-8"))
+    bootstrap = _BOOTSTRAP.format(_shipped("_agent.py"))
+    return "{} -c {} {}".format(
+        python, six.moves.shlex_quote(bootstrap), payload
+    )
+
+
+@_memoize
+def _shipped(name):
+    """
+    Return package file ``name``, compressed and base64-encoded.
+    """
+    # Imported here as it's only needed once.
+    import pkgutil
+
+    return _encode(pkgutil.get_data(__name__.rpartition(".")[0], name))
+
+
+def _encode(data):
+    return base64.b64encode(zlib.compress(data, 9)).decode("ascii")
+
+
+def _parse(stdout):
+    # Anything else (e.g. noise from shell startup files) is ignored.
+    for line in reversed(stdout.splitlines()):
+        if line.startswith(_MARKER):
+            return json.loads(line[len(_MARKER):])
+    raise ValueError("No results found in agent output: {!r}".format(stdout))
@@ -0,0 +1,457 @@
+"""
+Asyncio-native counterparts of the `.files`, `.info` and `.packages` APIs.
+
+Everywhere else, Patchwork blocks on every command it runs, so operating on
+many hosts at once means a thread per host (see `.parallel`). The coroutines
+in here build exactly the same commands as their blocking namesakes, but
+``await`` their execution instead, so a single event loop can drive thousands
+of hosts concurrently::
+
+    import asyncio
+    from patchwork import aio
+
+    async def converge(c):
+        await aio.directory(c, "/srv/app", user="deploy", sudo=True)
+        await aio.append(c, "/etc/app.conf", ["a=1", "b=2"], batch=True)
+
+    asyncio.run(aio.fan_out(contexts, converge))
+
+Contexts handed to these functions need only provide *coroutine* ``run`` and
+``sudo`` methods with the same signature and semantics as those of
+`~invoke.context.Context` (in particular, honoring ``hide`` and ``warn``, and
+raising `~invoke.exceptions.UnexpectedExit` on failure) and returning
+`~invoke.runners.Result`-like objects. `LocalContext`, which runs commands as
+local subprocesses, is included; remote implementations can be built atop any
+asyncio SSH library.
+
+File state caching (`.files.enable_cache`) and fact caching (`.info.facts`)
+are shared with the blocking API, since both are keyed off the context object;
+so are compiled commands (see `.files.prepare`.)
+
+.. note::
+    This module requires Python 3.5 or newer; on older interpreters (which
+    Patchwork otherwise still supports) it is a syntax error to import, and
+    the test suite and CI linting skip it. `set_runner` call hooks (and
+    thus `.instrumentation`) do not yet observe these coroutines, and
+    `.files.upload_if_changed` has no counterpart here, since it requires
+    file transfer.
+"""
+
+import asyncio
+import os
+import sys
+
+from functools import wraps
+
+from fabric import GroupResult
+from fabric.exceptions import GroupException
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result, normalize_hide
+from invoke.vendor import six
+
+from . import files as _files
+from . import info as _info
+from . import packages as _packages
+from .files import _cached, _invalidate, _plan
+from .util import _select_runner, context_state, munge_docstring
+
+
+class LocalContext(object):
+    """
+    Minimal asynchronous context which runs commands as local subprocesses.
+
+    Mostly useful for testing, or for converging the local machine alongside
+    remote ones.
+
+    :param dict env:
+        Extra environment variables for every command, on top of the current
+        process environment.
+    :param str encoding:
+        Encoding used to decode command output. Default: ``"utf-8"``.
+    """
+
+    def __init__(self, env=None, encoding="utf-8"):
+        self.env = env or {}
+        self.encoding = encoding
+
+    async def run(self, command, hide=None, warn=False, env=None, **kwargs):
+        """
+        Run ``command`` via ``/bin/sh``, returning a `~invoke.runners.Result`.
+
+        Only the ``hide``, ``warn`` and ``env`` kwargs are honored; others are
+        accepted (for compatibility with callers written for
+        `~invoke.context.Context.run`) and ignored.
+        """
+        environment = dict(os.environ, **self.env)
+        environment.update(env or {})
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=environment,
+        )
+        stdout, stderr = await process.communicate()
+        hidden = normalize_hide(hide)
+        result = Result(
+            stdout=stdout.decode(self.encoding, "replace"),
+            stderr=stderr.decode(self.encoding, "replace"),
+            encoding=self.encoding,
+            command=command,
+            shell="/bin/sh",
+            env=env or {},
+            exited=process.returncode,
+            hide=tuple(hidden),
+        )
+        if "stdout" not in hidden:
+            sys.stdout.write(result.stdout)
+        if "stderr" not in hidden:
+            sys.stderr.write(result.stderr)
+        if result.failed and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    async def sudo(self, command, **kwargs):
+        """
+        Run ``command`` via non-interactive ``sudo``; see `run`.
+        """
+        wrapped = "sudo -n sh -c {}".format(six.moves.shlex_quote(command))
+        return await self.run(wrapped, **kwargs)
+
+
+def set_runner(f):
+    """
+    Coroutine counterpart of `patchwork.util.set_runner`.
+
+    Accepts the same ``sudo``, ``runner_method`` and ``runner`` kwargs; the
+    runner handed to the decorated coroutine is expected to be a coroutine
+    function, e.g. ``c.run`` on an asynchronous context.
+    """
+
+    @wraps(f)
+    async def inner(*args, **kwargs):
+        args = list(args)
+        runner, _ = _select_runner(args[0], kwargs)
+        args.insert(1, runner)
+        return await f(*args, **kwargs)
+
+    inner.__doc__ = munge_docstring(f, inner)
+    return inner
+
+
+async def fan_out(contexts, func, *args, **kwargs):
+    """
+    Await ``func(c, *args, **kwargs)`` for every ``c`` in ``contexts``.
+
+    The asynchronous analogue of `.parallel.fan_out`: all calls share the
+    running event loop instead of each occupying a thread.
+
+    :param contexts:
+        Iterable of asynchronous contexts.
+    :param func:
+        Coroutine function to call per context.
+    :param int workers:
+        Keyword-only. Maximum number of calls in flight at once. Default:
+        ``None`` (no limit.)
+
+    :returns:
+        A `~fabric.group.GroupResult` mapping each context to ``func``'s
+        return value.
+
+    :raises:
+        `~fabric.exceptions.GroupException`, if any call raised an exception;
+        the failed hosts' values in its ``result`` are those exceptions.
+    """
+    workers = kwargs.pop("workers", None)
+    semaphore = asyncio.Semaphore(workers) if workers else None
+
+    async def call(c):
+        if semaphore is None:
+            return await func(c, *args, **kwargs)
+        async with semaphore:
+            return await func(c, *args, **kwargs)
+
+    contexts = list(contexts)
+    values = await asyncio.gather(
+        *[call(c) for c in contexts], return_exceptions=True
+    )
+    results = GroupResult()
+    for c, value in zip(contexts, values):
+        results[c] = value
+    if results.failed:
+        raise GroupException(results)
+    return results
+
+
+# files
+
+
+@set_runner
+async def directory(c, runner, path, user=None, group=None, mode=None):
+    """
+    Ensure a directory exists and has given user and/or mode.
+
+    See `.files.directory`.
+    """
+    _invalidate(c, path, parents=True)
+    prepared = _plan(_files.directory, path, user, group, mode)
+    for command in prepared.commands:
+        await runner(command)
+
+
+@set_runner
+async def exists(c, runner, path):
+    """
+    Return True if given path exists on the current remote host.
+
+    See `.files.exists`.
+    """
+    entry = _cached(c, path)
+    if "exists" in entry:
+        return entry["exists"]
+    command = _plan(_files.exists, path).command
+    result = await runner(command, hide=True, warn=True)
+    entry["exists"] = result.ok
+    return result.ok
+
+
+@set_runner
+async def exists_many(c, runner, paths, stat=False):
+    """
+    Check whether each of ``paths`` exists, using a single command.
+
+    See `.files.exists_many`.
+    """
+    paths = list(paths)
+    found = {}
+    if not stat:
+        for path in paths:
+            entry = _cached(c, path)
+            if "exists" in entry:
+                found[path] = entry["exists"]
+        paths = [x for x in paths if x not in found]
+    if not paths:
+        return found
+    stdout = ""
+    for command in _plan(_files.exists_many, paths, stat).commands:
+        stdout += (await runner(command, hide=True)).stdout
+    for path, value in _files._parse_exists_many(stdout, paths, stat):
+        found[path] = value
+        _cached(c, path)["exists"] = bool(value)
+    return found
+
+
+@set_runner
+async def contains(c, runner, filename, text, exact=False, escape=True):
+    """
+    Return True if ``filename`` contains ``text`` (which may be a regex.)
+
+    See `.files.contains`.
+    """
+    entry = _cached(c, filename)
+    key = ("contains", text, exact, escape)
+    if key in entry:
+        return entry[key]
+    command = _plan(_files.contains, filename, text, exact, escape).command
+    result = await runner(command, hide=True, warn=True)
+    entry[key] = result.ok
+    return result.ok
+
+
+@set_runner
+async def search(
+    c, runner, filename, patterns, fixed=False, line_numbers=False, limit=1
+):
+    """
+    Check which of several ``patterns`` occur in ``filename``, in one pass.
+
+    See `.files.search`.
+    """
+    patterns = list(patterns)
+    found = dict((x, []) for x in patterns)
+    if patterns:
+        command = _plan(
+            _files.search, filename, patterns, fixed, line_numbers, limit
+        ).command
+        result = await runner(command, hide=True, warn=True)
+        for line in result.stdout.splitlines():
+            index, number = line.split()
+            found[patterns[int(index)]].append(int(number))
+    if line_numbers:
+        return found
+    return dict((x, bool(y)) for x, y in found.items())
+
+
+@set_runner
+async def append(
+    c, runner, filename, text, partial=False, escape=True, batch=False
+):
+    """
+    Append string (or list of strings) ``text`` to ``filename``.
+
+    See `.files.append`.
+    """
+    if isinstance(text, six.string_types):
+        text = [text]
+    prepared = _plan(_files.append, filename, text, partial, escape, batch)
+    if batch:
+        _invalidate(c, filename)
+        stdout = ""
+        for command in prepared.commands:
+            stdout += (await runner(command, hide=True)).stdout
+        return _files._parse_append_batch(stdout, text)
+    for regex, command in zip(prepared.checks, prepared.commands):
+        if (
+            regex
+            and await exists(c, filename, runner=runner)
+            and await contains(c, filename, regex, escape=False, runner=runner)
+        ):
+            continue
+        _invalidate(c, filename)
+        await runner(command)
+
+
+@set_runner
+async def ensure_block(
+    c, runner, filename, lines, marker="patchwork", comment="#", present=True
+):
+    """
+    Ensure ``filename`` contains ``lines`` as a block delimited by markers.
+
+    See `.files.ensure_block`.
+    """
+    if isinstance(lines, six.string_types):
+        lines = [lines]
+    command = _plan(
+        _files.ensure_block, filename, lines, marker, comment, present
+    ).command
+    changed = (await runner(command, hide=True)).stdout.strip() == "changed"
+    if changed:
+        _invalidate(c, filename)
+    return changed
+
+
+# info
+
+
+async def facts(c, cache_dir=None, ttl=None, refresh=False):
+    """
+    Gather (and cache) basic facts about the host ``c`` is connected to.
+
+    See `.info.facts`; the cache is shared with it.
+    """
+    state = context_state(c, "info")
+    if not refresh and "facts" in state:
+        return state["facts"]
+    path = _info._cache_path(c, cache_dir) if cache_dir else None
+    found = None
+    if path and not refresh:
+        found = _info._read_cache(path, ttl)
+    if found is None:
+        result = await c.run(_info._gather_command(), hide=True, warn=True)
+        found = _info._parse_facts(result.stdout)
+        if path:
+            _info._write_cache(path, found)
+    state["facts"] = found
+    return found
+
+
+async def distro_name(c):
+    """
+    Return simple Linux distribution name identifier, e.g. ``"ubuntu"``.
+
+    See `.info.distro_name`.
+    """
+    return _info._distro_name(await facts(c))
+
+
+async def distro_family(c):
+    """
+    Returns basic "family" ID for the remote system's distribution.
+
+    See `.info.distro_family`.
+    """
+    return _info._distro_family(await distro_name(c))
+
+
+# packages
+
+
+async def package(c, *packages, **kwargs):
+    """
+    Installs one or more ``packages`` using the system package manager.
+
+    See `.packages.package`, whose keyword-only arguments (``transaction``,
+    ``warn``, ``refresh``, ``ttl``, ``manager`` and backend options such as
+    ``cache`` and ``proxy``) are also accepted.
+
+    :returns: A `.packages.PackageReport`.
+    """
+    transaction = kwargs.pop("transaction", True)
+    warn = kwargs.pop("warn", False)
+    fresh = kwargs.pop("refresh", False)
+    ttl = kwargs.pop("ttl", _packages.REFRESH_TTL)
+    manager = await backend(c, *_packages._options("package", kwargs))
+    if fresh:
+        await _refresh(c, manager, ttl)
+    present = await _installed(c, manager, packages)
+    steps = _packages._install(
+        c, manager, packages, present, transaction, warn
+    )
+    step = next(steps)
+    while not isinstance(step, _packages.PackageReport):
+        step = steps.send(await c.sudo(step, warn=True))
+    return step
+
+
+async def installed_packages(c, packages, family=None, **kwargs):
+    """
+    Return the subset of ``packages`` which are already installed.
+
+    See `.packages.installed_packages`.
+    """
+    packages = list(packages)
+    if not packages:
+        return set()
+    if family is not None and "manager" not in kwargs:
+        kwargs["manager"] = _packages._family_backend(family)
+    options = _packages._options("installed_packages", kwargs)
+    return await _installed(c, await backend(c, *options), packages)
+
+
+async def refresh(c, ttl=_packages.REFRESH_TTL, force=False, **kwargs):
+    """
+    Refresh package metadata (e.g. ``apt-get update``), unless still fresh.
+
+    See `.packages.refresh`, whose freshness bookkeeping is shared with this.
+    """
+    manager = await backend(c, *_packages._options("refresh", kwargs))
+    return await _refresh(c, manager, 0 if force else ttl)
+
+
+async def backend(c, manager=None, options=None):
+    """
+    Return a `.packages.Backend` for the package manager ``c``'s host uses.
+
+    See `.packages.backend`; backend options are given as a dict here.
+    """
+    if manager is None:
+        manager = _packages._family_backend(await distro_family(c))
+    return _packages._create_backend(manager, options or {})
+
+
+async def _installed(c, manager, packages):
+    packages = list(packages)
+    if not packages:
+        return set()
+    command = manager.installed_command(packages)
+    result = await c.run(command, hide=True, warn=True)
+    return manager.parse_installed(result.stdout, packages)
+
+
+async def _refresh(c, manager, ttl):
+    command = _packages._refresh_command(c, manager, ttl)
+    if command is None:
+        return False
+    result = await c.sudo(command, hide=True)
+    return _packages._refreshed(c, manager, result)
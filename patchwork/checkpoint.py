@@ -0,0 +1,308 @@
+"""
+Resumable runs, which skip work already done before being interrupted.
+
+A long run across many hosts which dies partway through (a local crash, a
+lost laptop connection, a Ctrl-C) normally has to start over from scratch.
+A `Journal` instead records, in a local JSON Lines file, every operation
+completed on every host, along with its result::
+
+    from patchwork.checkpoint import Journal
+    from patchwork.parallel import fan_out
+
+    with Journal("rollout.journal") as journal:
+        fan_out(hosts, deploy)
+
+Run the same code again with the same journal file and each operation that
+already completed on a given host returns its recorded result straight away,
+without running anything, so the run effectively resumes where it left off.
+
+Every `~patchwork.util.set_runner`-decorated function takes part
+automatically (via `~patchwork.util.add_call_wrapper`); anything else, e.g.
+`.transfers.rsync` or `.packages.package`, can be journaled explicitly with
+`Journal.call`.
+
+Operations are identified by host, function name, a hash of their arguments
+and how many identical calls preceded them on that host in the same run --
+so e.g. an `.files.exists` check repeated after the path was created is a
+distinct step from the original check. Runs are thus expected to be
+deterministic: a resumed run should issue the same calls, in the same order,
+per host. Calls which raised an exception aren't recorded, and so are
+retried.
+
+Arguments are hashed by value. Those with no value which would be the same
+in another process (e.g. a file object, whose ``repr`` is merely its memory
+address) can't identify a step, so calls given them are never journaled.
+"""
+
+import hashlib
+import importlib
+import io
+import json
+import re
+import threading
+import types
+
+from invoke.vendor import six
+
+from .util import Call, add_call_wrapper, remove_call_wrapper
+
+
+class Journal(object):
+    """
+    A checkpoint journal, stored as JSON Lines in a local file.
+
+    Use as a context manager, which loads the journal (if the file exists)
+    and starts journaling `~patchwork.util.set_runner`-decorated calls in all
+    threads, until exited. Instances may be used for one run at a time.
+
+    Results are recorded as JSON, with tuples (including named tuples such
+    as `.files.Stat`), sets and dicts with non-string keys tagged so that
+    they are replayed as the same types. Results made of anything else (e.g.
+    `~invoke.runners.Result` objects) aren't recorded, meaning those calls
+    always run.
+
+    Calls given an explicit ``runner`` (i.e. those made from within another
+    decorated function, or deferred via a `~patchwork.util.Pipeline`) are
+    never journaled themselves: they're part of their caller's step, or
+    haven't actually run yet.
+
+    :param str path: File to read and append the journal to.
+    :param bool force:
+        Whether to run (and re-record) every call, even if already recorded
+        as completed; handy for a deliberate full rerun which still leaves a
+        journal to resume from.
+    """
+
+    def __init__(self, path, force=False):
+        self.path = path
+        self.force = force
+        #: Number of calls skipped (their results replayed) so far.
+        self.replayed = 0
+        self._done = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = None
+
+    def __enter__(self):
+        self._done, complete = self._load()
+        self._seen = {}
+        self.replayed = 0
+        self._file = io.open(self.path, "a", encoding="utf-8")
+        if not complete:
+            # Don't run on from a line cut short by a crash
+            self._file.write(u"\n")
+        add_call_wrapper(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_call_wrapper(self)
+        self._file.close()
+        self._file = None
+
+    def __call__(self, call, proceed):
+        # Nested and deferred calls belong to whatever step they're part of
+        if call.method is None or getattr(self._local, "busy", False):
+            return proceed()
+        key = self._key(call)
+        if key is None:
+            return proceed()
+        with self._lock:
+            done = key in self._done and not self.force
+            if done:
+                self.replayed += 1
+                return self._done[key]
+        self._local.busy = True
+        try:
+            result = proceed()
+        finally:
+            self._local.busy = False
+        self._record(key, result)
+        return result
+
+    def call(self, c, func, *args, **kwargs):
+        """
+        Call ``func(c, *args, **kwargs)``, unless already journaled.
+
+        For operations not decorated with `~patchwork.util.set_runner`, such
+        as `.transfers.rsync`; any decorated functions ``func`` calls are
+        considered part of this one step.
+
+        :returns: ``func``'s result, or its recorded result.
+        """
+        name = "{}.{}".format(
+            getattr(func, "__module__", None), getattr(func, "__name__", func)
+        )
+        call = Call(
+            function=name, context=c, args=args, kwargs=kwargs, method="run"
+        )
+        return self(call, lambda: func(c, *args, **kwargs))
+
+    def _key(self, call):
+        """
+        Return ``call``'s journal key, or ``None`` if it can't have one.
+        """
+        host = getattr(call.context, "host", None) or "local"
+        try:
+            arguments = _encode([list(call.args), call.kwargs], key=True)
+        except ValueError:
+            return None
+        payload = json.dumps(arguments + [call.method], sort_keys=True)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        base = (host, call.function, digest)
+        with self._lock:
+            occurrence = self._seen.get(base, 0)
+            self._seen[base] = occurrence + 1
+        return base + (occurrence,)
+
+    def _record(self, key, result):
+        host, function, digest, occurrence = key
+        entry = {
+            "host": host,
+            "function": function,
+            "hash": digest,
+            "n": occurrence,
+        }
+        try:
+            entry["result"] = _encode(result)
+            line = json.dumps(entry, sort_keys=True)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._done[key] = _decode(entry["result"])
+            self._file.write(six.text_type(line) + u"\n")
+            self._file.flush()
+
+    def _load(self):
+        """
+        Return recorded results, and whether the file's last line is whole.
+        """
+        done, complete = {}, True
+        try:
+            fd = io.open(self.path, encoding="utf-8")
+        except IOError:
+            return done, complete
+        with fd:
+            for line in fd:
+                complete = line.endswith(u"\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                key = (
+                    entry["host"],
+                    entry["function"],
+                    entry["hash"],
+                    entry["n"],
+                )
+                done[key] = _decode(entry["result"])
+        return done, complete
+
+
+# Marks JSON objects standing in for values JSON has no type for.
+_TAG = "__journal__"
+
+# Object reprs like "<object at 0x7f0c...>", only meaningful in one process.
+_ADDRESS = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+def _encode(value, key=False):
+    """
+    Return ``value`` as JSON-serializable data, tagging types JSON lacks.
+
+    Other objects raise `TypeError`; unless ``key`` is given, in which case
+    (since only equality matters for journal keys) they are represented by
+    their ``repr``, or their dotted name for functions and classes.
+    `ValueError` is raised if neither would be the same in another process.
+    """
+    scalars = (bool, float, type(None)) + six.integer_types + six.string_types
+    if isinstance(value, scalars):
+        return value
+    if isinstance(value, list):
+        return [_encode(x, key) for x in value]
+    if isinstance(value, tuple):
+        items = [_encode(x, key) for x in value]
+        kind = type(value)
+        if hasattr(kind, "_fields"):
+            name = "{}:{}".format(kind.__module__, _qualname(kind))
+            return {_TAG: "namedtuple", "class": name, "items": items}
+        return {_TAG: "tuple", "items": items}
+    if isinstance(value, (set, frozenset)):
+        kind = "frozenset" if isinstance(value, frozenset) else "set"
+        items = sorted((_encode(x, key) for x in value), key=_dumps)
+        return {_TAG: kind, "items": items}
+    if isinstance(value, dict):
+        strings = all(isinstance(x, six.string_types) for x in value)
+        if strings and _TAG not in value:
+            return dict((x, _encode(y, key)) for x, y in value.items())
+        items = sorted(
+            ([_encode(x, key), _encode(y, key)] for x, y in value.items()),
+            key=_dumps,
+        )
+        return {_TAG: "dict", "items": items}
+    if not key:
+        raise TypeError("Can't record {!r}".format(value))
+    if isinstance(value, (type, types.FunctionType)):
+        name = _qualname(value)
+        if "<" in name:
+            # Lambdas and nested functions don't have unique names.
+            raise ValueError("Unstable argument: {!r}".format(value))
+        return {_TAG: "name", "name": "{}:{}".format(value.__module__, name)}
+    text = repr(value)
+    if _ADDRESS.search(text):
+        raise ValueError("Unstable argument: {}".format(text))
+    return {_TAG: "repr", "repr": text}
+
+
+def _decode(data):
+    """
+    Inverse of `_encode`, for results.
+    """
+    if isinstance(data, list):
+        return [_decode(x) for x in data]
+    if not isinstance(data, dict):
+        return data
+    kind = data.get(_TAG)
+    if kind is None:
+        return dict((x, _decode(y)) for x, y in data.items())
+    items = [_decode(x) for x in data["items"]]
+    if kind == "namedtuple":
+        cls = _namedtuple(data["class"])
+        return tuple(items) if cls is None else cls(*items)
+    if kind == "dict":
+        return dict((_hashable(x), y) for x, y in items)
+    if kind in ("set", "frozenset"):
+        items = [_hashable(x) for x in items]
+        return set(items) if kind == "set" else frozenset(items)
+    return tuple(items)
+
+
+def _hashable(value):
+    # Decoded lists were lists originally, so can't have been keys; but be
+    # lenient with hand-edited journals.
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _namedtuple(name):
+    """
+    Import named tuple class ``name`` (``module:qualname``), or return None.
+    """
+    module, _, path = name.partition(":")
+    try:
+        value = importlib.import_module(module)
+        for part in path.split("."):
+            value = getattr(value, part)
+    except (ImportError, AttributeError):
+        return None
+    if isinstance(value, type) and issubclass(value, tuple):
+        if hasattr(value, "_fields"):
+            return value
+    return None
+
+
+def _qualname(value):
+    return getattr(value, "__qualname__", value.__name__)
+
+
+def _dumps(data):
+    return json.dumps(data, sort_keys=True)
@@ -2,9 +2,63 @@
 Shell environment introspection, e.g. binaries in effective $PATH, etc.
 """
 
+from invoke.vendor import six
+
+from .util import context_state
+
 
 def have_program(c, name):
     """
     Returns whether connected user has program ``name`` in their ``$PATH``.
     """
     return c.run("which {}".format(name), hide=True, warn=True)
+
+
+def have_programs(c, names, refresh=False):
+    """
+    Look up many programs in the connected user's ``$PATH`` at once.
+
+    All ``names`` are resolved (via the POSIX ``command -v``) in a single
+    remote command. Answers are cached on ``c``, so asking about the same
+    program again costs nothing; the cache is dropped automatically whenever
+    `.packages.package` installs something, and may be dropped by hand with
+    `clear_programs`.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param names:
+        Iterable of program names.
+    :param bool refresh:
+        Whether to ignore (and update) cached answers.
+
+    :returns:
+        A `dict` mapping each name to its full path, or to ``None`` if not
+        found. (Shell builtins, functions and aliases map to their own name.)
+    """
+    names = list(names)
+    cache = context_state(c, "environment").setdefault("programs", {})
+    missing = [x for x in names if refresh or x not in cache]
+    if missing:
+        lines = [
+            "printf '{}\\t'; command -v {} || echo".format(
+                index, six.moves.shlex_quote(name)
+            )
+            for index, name in enumerate(missing)
+        ]
+        script = "\n".join(lines)
+        result = c.run(
+            "sh -c {}".format(six.moves.shlex_quote(script)), hide=True
+        )
+        for line in result.stdout.splitlines():
+            index, _, path = line.partition("\t")
+            cache[missing[int(index)]] = path or None
+    return dict((x, cache.get(x)) for x in names)
+
+
+def clear_programs(c):
+    """
+    Forget program locations cached for ``c`` by `have_programs`.
+
+    :param c: `~invoke.context.Context` whose cache should be cleared.
+    """
+    context_state(c, "environment").pop("programs", None)
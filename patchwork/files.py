@@ -2,11 +2,81 @@
 Tools for file and directory management.
 """
 
+import io
+import posixpath
 import re
+import threading
+
+from collections import OrderedDict, namedtuple
 
 from invoke.vendor import six
 
-from .util import set_runner
+from .util import (
+    _memoize,
+    _random_hex,
+    _shell_commands,
+    context_state,
+    set_runner,
+)
+
+
+def enable_cache(c, paths=()):
+    """
+    Start caching remote file state for context ``c``.
+
+    While enabled, `exists`, `exists_many` and `contains` remember their
+    answers per path and return them without running anything remotely on
+    subsequent calls. Patchwork's own mutating functions (`append`,
+    `directory`, `upload_if_changed`, `.transfers.rsync` etc) invalidate the
+    entries for the paths they touch.
+
+    Cache entries are keyed by the path *string* given (normalized, so e.g.
+    ``/srv/app/`` and ``/srv/app`` are the same), which means ``~/.bashrc``
+    and ``/home/me/.bashrc`` are cached (and invalidated) independently, and
+    changes made by other means (e.g. a raw ``c.run("rm ...")``) are not
+    noticed; call `clear_cache` after such changes.
+
+    :param c:
+        `~invoke.context.Context` to cache state for.
+    :param paths:
+        Optional iterable of paths whose existence should be snapshotted
+        immediately, in one command, via `exists_many`.
+    """
+    state = context_state(c, "files")
+    if state.get("cache") is None:
+        state["cache"] = {}
+    paths = list(paths)
+    if paths:
+        exists_many(c, paths)
+
+
+def disable_cache(c):
+    """
+    Stop caching remote file state for ``c``, discarding anything cached.
+
+    :param c:
+        `~invoke.context.Context` to stop caching state for.
+    """
+    context_state(c, "files").pop("cache", None)
+
+
+def clear_cache(c, path=None):
+    """
+    Forget cached remote file state for ``c`` (if caching is enabled.)
+
+    :param c:
+        `~invoke.context.Context` whose cache should be cleared.
+    :param str path:
+        If given, only entries for this path are forgotten; otherwise the
+        entire cache is emptied.
+    """
+    cache = _cache(c)
+    if cache is None:
+        return
+    if path is None:
+        cache.clear()
+    else:
+        cache.pop(_cache_key(path), None)
 
 
 @set_runner
@@ -25,12 +95,10 @@ def directory(c, runner, path, user=None, group=None, mode=None):
     :param str mode:
         ``chmod`` compatible mode string to apply to the directory.
     """
-    runner("mkdir -p {}".format(path))
-    if user is not None:
-        group = group or user
-        runner("chown {}:{} {}".format(user, group, path))
-    if mode is not None:
-        runner("chmod {} {}".format(mode, path))
+    # mkdir -p may have created parents too.
+    _invalidate(c, path, parents=True)
+    for command in _plan(directory, path, user, group, mode).commands:
+        runner(command)
 
 
 @set_runner
@@ -43,8 +111,64 @@ def exists(c, runner, path):
     :param str path:
         Path to check for existence.
     """
-    cmd = 'test -e "$(echo {})"'.format(path)
-    return runner(cmd, hide=True, warn=True).ok
+    entry = _cached(c, path)
+    if "exists" in entry:
+        return entry["exists"]
+    result = runner(_plan(exists, path).command, hide=True, warn=True).ok
+    entry["exists"] = result
+    return result
+
+
+#: File metadata as returned by `exists_many` when ``stat=True``: ``type`` is
+#: one of ``"file"``, ``"directory"`` or another ``stat``-reported type name
+#: (e.g. ``"fifo"``), ``size`` is in bytes, ``mtime`` is seconds since the
+#: epoch and ``mode`` holds the permission bits (e.g. ``0o644``.)
+Stat = namedtuple("Stat", "type size mtime mode")
+
+
+@set_runner
+def exists_many(c, runner, paths, stat=False):
+    """
+    Check whether each of ``paths`` exists, using a single remote command.
+
+    Each path undergoes the same shell expansion as in `exists`. (Should the
+    paths not fit in one command line, as many commands as needed are used.)
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param paths:
+        Iterable of paths to check for existence.
+    :param bool stat:
+        Whether to return `Stat` records (or ``None`` for missing paths)
+        instead of booleans. Requires GNU ``stat``.
+
+    :returns:
+        A `dict` mapping each of ``paths`` to a boolean or `Stat`.
+    """
+    paths = list(paths)
+    found = {}
+    if not stat:
+        # Only bother the remote end about paths we don't already know.
+        for path in paths:
+            entry = _cached(c, path)
+            if "exists" in entry:
+                found[path] = entry["exists"]
+        paths = [x for x in paths if x not in found]
+    if not paths:
+        return found
+    commands = _plan(exists_many, paths, stat).commands
+    stdout = "".join(runner(x, hide=True).stdout for x in commands)
+    for path, value in _parse_exists_many(stdout, paths, stat):
+        found[path] = value
+        _cached(c, path)["exists"] = bool(value)
+    return found
+
+
+_STAT_TYPES = {
+    "regular file": "file",
+    "regular empty file": "file",
+    "directory": "directory",
+}
 
 
 @set_runner
@@ -75,16 +199,71 @@ def contains(c, runner, filename, text, exact=False, escape=True):
     :param bool escape:
         Whether to perform regex-oriented escaping on ``text``.
     """
-    if escape:
-        text = _escape_for_regex(text)
-        if exact:
-            text = "^{}$".format(text)
-    egrep_cmd = 'egrep "{}" "{}"'.format(text, filename)
-    return runner(egrep_cmd, hide=True, warn=True).ok
+    entry = _cached(c, filename)
+    key = ("contains", text, exact, escape)
+    if key in entry:
+        return entry[key]
+    cmd = _plan(contains, filename, text, exact, escape).command
+    result = runner(cmd, hide=True, warn=True).ok
+    entry[key] = result
+    return result
+
+
+@set_runner
+def search(
+    c, runner, filename, patterns, fixed=False, line_numbers=False, limit=1
+):
+    """
+    Check which of several ``patterns`` occur in ``filename``, in one pass.
+
+    Unlike calling `contains` once per pattern, this reads ``filename`` only
+    once, using a single ``awk`` invocation which tests every line against
+    every pattern still being looked for, and which stops reading as soon as
+    each pattern has matched ``limit`` times. Only pattern indices and line
+    numbers are sent back, never file contents, so searching multi-gigabyte
+    logs is as cheap on the wire as searching tiny files.
+
+    Patterns are extended regular expressions (as with ``egrep``), unless
+    ``fixed=True``, in which case they're matched as plain substrings (as
+    with ``grep -F``.) A missing or unreadable ``filename`` matches nothing.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param str filename:
+        File path to search.
+    :param patterns:
+        Iterable of patterns to search for.
+    :param bool fixed:
+        Whether to treat ``patterns`` as literal strings instead of regexes.
+    :param bool line_numbers:
+        Whether to return the numbers of matching lines instead of booleans.
+    :param int limit:
+        How many matching lines to look for per pattern before it's
+        considered done. Set to ``None`` to find every matching line (which
+        means always reading the entire file.)
+
+    :returns:
+        A `dict` mapping each pattern to whether it was found or, when
+        ``line_numbers=True``, to the `list` of (1-indexed) numbers of the
+        lines it matched, in file order.
+    """
+    patterns = list(patterns)
+    found = dict((x, []) for x in patterns)
+    if patterns:
+        command = _plan(
+            search, filename, patterns, fixed, line_numbers, limit
+        ).command
+        result = runner(command, hide=True, warn=True)
+        for line in result.stdout.splitlines():
+            index, number = line.split()
+            found[patterns[int(index)]].append(int(number))
+    if line_numbers:
+        return found
+    return dict((x, bool(y)) for x, y in found.items())
 
 
 @set_runner
-def append(c, runner, filename, text, partial=False, escape=True):
+def append(c, runner, filename, text, partial=False, escape=True, batch=False):
     """
     Append string (or list of strings) ``text`` to ``filename``.
 
@@ -103,6 +282,16 @@ def append(c, runner, filename, text, partial=False, escape=True):
     Because ``text`` is single-quoted, single quotes will be transparently
     backslash-escaped. This can be disabled with ``escape=False``.
 
+    By default, every line costs up to three commands (an existence test, a
+    ``grep`` and the ``echo`` itself). Specify ``batch=True`` to instead ship
+    all of ``text`` to the remote end inside a single shell script, which
+    performs the same per-line checks (honoring ``partial``) and appends only
+    the missing lines, in order. (Very long lists are split over as many
+    scripts as needed to stay within the operating system's command length
+    limit.) In this mode each line is shell-quoted by Patchwork itself (so
+    ``escape`` is ignored) and the return value is the list of lines which
+    were actually appended.
+
     :param c:
         `~invoke.context.Context` within to execute commands.
     :param str filename:
@@ -114,22 +303,632 @@ def append(c, runner, filename, text, partial=False, escape=True):
         necessary.
     :param bool escape:
         Whether to perform regex-oriented escaping on ``text``.
+    :param bool batch:
+        Whether to check and append all lines using a single remote command.
+
+    :returns:
+        ``None``, or (when ``batch=True``) a list of the appended lines.
     """
     # Normalize non-list input to be a list
     if isinstance(text, six.string_types):
         text = [text]
-    for line in text:
-        regex = "^" + _escape_for_regex(line) + ("" if partial else "$")
+    prepared = _plan(append, filename, text, partial, escape, batch)
+    if batch:
+        _invalidate(c, filename)
+        stdout = "".join(
+            runner(x, hide=True).stdout for x in prepared.commands
+        )
+        return _parse_append_batch(stdout, text)
+    for regex, command in zip(prepared.checks, prepared.commands):
         if (
-            line
+            regex
             and exists(c, filename, runner=runner)
             and contains(c, filename, regex, escape=False, runner=runner)
         ):
             continue
-        line = line.replace("'", r"'\\''") if escape else line
-        runner("echo '{}' >> {}".format(line, filename))
+        _invalidate(c, filename)
+        runner(command)
+
+
+@set_runner
+def ensure_block(
+    c, runner, filename, lines, marker="patchwork", comment="#", present=True
+):
+    """
+    Ensure ``filename`` contains ``lines`` as a block delimited by markers.
+
+    The block is bracketed by ``<comment> BEGIN <marker>`` and ``<comment>
+    END <marker>`` lines, so it can be found again (and replaced or removed)
+    later on, independently of the rest of the file -- handy for owning a
+    section of e.g. ``sshd_config`` or ``sysctl.conf``. A missing block is
+    added at the end of the file; a missing file is created.
+
+    Everything happens in a single remote command: the SHA-256 checksum of
+    the block currently in the file is compared to that of the desired one
+    and, only if they differ, the file is rewritten in one streaming
+    ``awk`` pass into a temporary copy (keeping the original's mode) which
+    is then renamed over ``filename``. Readers never see a half-edited file.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param str filename:
+        File path to manage a block within.
+    :param lines:
+        String, or list of strings, making up the body of the block.
+    :param str marker:
+        Text identifying this block; use distinct markers to manage several
+        blocks within the same file.
+    :param str comment:
+        The file format's comment prefix, used for the marker lines.
+    :param bool present:
+        Whether the block should exist; ``False`` removes it.
+
+    :returns: ``True`` if the file was changed, ``False`` otherwise.
+    :raises:
+        `~invoke.exceptions.UnexpectedExit` if ``filename`` has a begin
+        marker but no matching end marker after it, in which case the file is
+        left untouched.
+    """
+    if isinstance(lines, six.string_types):
+        lines = [lines]
+    command = _plan(
+        ensure_block, filename, lines, marker, comment, present
+    ).command
+    changed = runner(command, hide=True).stdout.strip() == "changed"
+    if changed:
+        _invalidate(c, filename)
+    return changed
+
+
+@set_runner
+def upload_if_changed(
+    c, runner, local, remote, user=None, group=None, mode=None
+):
+    """
+    Upload ``local`` to ``remote``, but only if their contents differ.
+
+    The SHA-256 checksum of ``local`` is compared to that of ``remote`` (via
+    ``sha256sum`` on the remote end); if they match, nothing is transferred.
+    Otherwise, the file is uploaded to a temporary staging path, copied next
+    to ``remote``, given the requested ownership and mode (or else those of
+    the existing ``remote``, if any), and finally renamed over ``remote`` --
+    so readers of ``remote`` never see a partially written file or one with
+    the wrong permissions. All post-upload steps
+    happen in one command (run via the runner, so ``sudo=True`` works for
+    root-owned destinations.)
+
+    .. note::
+        This requires a `~fabric.connection.Connection`, since it uses
+        `Connection.put <fabric.connection.Connection.put>`.
+
+    :param c:
+        `~fabric.connection.Connection` within to execute commands.
+    :param local:
+        Local file path, or a file-like object (e.g. rendered template
+        contents in an `io.BytesIO`.)
+    :param str remote:
+        Remote file path to install to.
+    :param str user:
+        Username which should own the file.
+    :param str group:
+        Group which should own the file; defaults to ``user``.
+    :param str mode:
+        ``chmod`` compatible mode string to apply to the file.
+
+    :returns: ``True`` if the file was uploaded, ``False`` if it was current.
+    """
+    checksum = runner('sha256sum "{}"'.format(remote), hide=True, warn=True)
+    current = checksum.stdout.split()[:1] if checksum.ok else []
+    if current == [_sha256(local)]:
+        return False
+    staging = "/tmp/patchwork-{}".format(_random_hex())
+    c.put(local, staging)
+    _invalidate(c, remote)
+    runner(_install_command(staging, remote, user, group, mode))
+    return True
+
+
+def prepare(function, *args, **kwargs):
+    """
+    Compile a call to one of this module's operations, for reuse.
+
+    All shell commands the call may need -- including any regex escaping,
+    quoting and checksumming of its arguments -- are built immediately,
+    without reference to any context. The returned `Prepared` object can
+    then be run against any number of hosts, doing only the per-host work::
+
+        push = prepare(append, "/etc/hosts", lines, batch=True)
+        fan_out(connections, push, sudo=True)
+
+    Plain calls (e.g. ``append(c, ...)``) go through the same compilation
+    step, whose results are cached for recently seen arguments, so repeating
+    an identical call on many hosts is cheap either way; `prepare` simply
+    makes that reuse explicit, and the compiled commands inspectable.
+
+    That cache holds at most 512 compiled calls, and 4MiB of commands; calls
+    compiling to more than that (e.g. a batched `append` of a great many
+    lines) are never cached, so to reuse those, hold on to a `Prepared`.
+
+    :param function:
+        The operation: `directory`, `exists`, `exists_many`, `contains`,
+        `search`, `append` or `ensure_block`.
+    :param args: Positional arguments for ``function``, minus the context.
+    :param kwargs:
+        Keyword arguments for ``function``, minus any `set_runner` kwargs
+        (which are instead given when running the result.)
+
+    :returns: A `Prepared` object.
+    :raises: `TypeError` if ``function`` isn't a supported operation.
+    """
+    if function not in _COMPILERS:
+        raise TypeError("Can't prepare {!r}".format(function))
+    prepared = _COMPILERS[function](*args, **kwargs)
+    _remember(prepared)
+    return prepared
+
+
+class Prepared(object):
+    """
+    One of this module's operations, compiled by `prepare`.
+
+    Instances don't refer to any context, so one may be run against many
+    hosts, from many threads, by calling it with each host's context (plus,
+    optionally, the ``sudo``, ``runner_method`` or ``runner`` kwargs of
+    `set_runner`-decorated functions); the call returns whatever the
+    operation itself returns.
+
+    Attributes:
+
+    - ``function``: the operation, e.g. `append`;
+    - ``args``: all of its arguments, positionally, with lists turned into
+      tuples;
+    - ``commands``: tuple of the commands built for it; which of them
+      actually run depends on the operation (and on `enable_cache` state);
+    - ``checks``: for non-batched `append`, each line's regex as given to
+      `contains`, or ``None`` for empty lines (which are always appended.)
+    """
+
+    def __init__(self, function, args, commands, checks=()):
+        self.function = function
+        self.args = args
+        self.commands = tuple(commands)
+        self.checks = tuple(checks)
+
+    @property
+    def command(self):
+        """
+        The first (typically, the only) command.
+        """
+        return self.commands[0]
+
+    def __call__(self, c, **kwargs):
+        # Calling the operation itself keeps call hooks and wrappers seeing
+        # an ordinary call; it is handed this object (see _plan) rather than
+        # looking its commands up again.
+        outer = getattr(_calling, "prepared", None)
+        _calling.prepared = self
+        try:
+            return self.function(c, *self.args, **kwargs)
+        finally:
+            _calling.prepared = outer
+
+    def __repr__(self):
+        return "<Prepared {}{!r}>".format(self.function.__name__, self.args)
+
+
+def _cache(c):
+    return context_state(c, "files").get("cache")
+
+
+def _cached(c, path):
+    """
+    Return the mutable cache entry for ``path``.
+
+    When caching is disabled, a throwaway dict is returned instead, so callers
+    needn't special-case anything.
+    """
+    cache = _cache(c)
+    if cache is None:
+        return {}
+    return cache.setdefault(_cache_key(path), {})
+
+
+def _invalidate(c, path, parents=False, tree=False):
+    cache = _cache(c)
+    if cache is None:
+        return
+    path = _cache_key(path)
+    cache.pop(path, None)
+    if tree:
+        prefix = path.rstrip("/") + "/"
+        for key in [x for x in cache if x.startswith(prefix)]:
+            cache.pop(key, None)
+    if parents:
+        while "/" in path.lstrip("/"):
+            path = path.rsplit("/", 1)[0]
+            cache.pop(path, None)
+        cache.pop("/", None)
+
+
+def _cache_key(path):
+    # So e.g. "/srv/app/" and "/srv//app" share an entry with "/srv/app".
+    return posixpath.normpath(path)
+
+
+def _sha256(local):
+    # Imported on demand, as hashlib is relatively slow to import.
+    import hashlib
+
+    digest = hashlib.sha256()
+    if hasattr(local, "read"):
+        position = local.tell()
+        data = local.read()
+        local.seek(position)
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        digest.update(data)
+        return digest.hexdigest()
+    with open(local, "rb") as fd:
+        for chunk in iter(lambda: fd.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Compiled operations, keyed by (function, *args); the least recently used
+# are evicted once there are _MAX_PLANS of them, or once their commands total
+# over _MAX_PLAN_BYTES (so e.g. huge batched appends can't pin hundreds of
+# MB.) Plans bigger than that on their own aren't cached at all.
+_PLANS = OrderedDict()
+_PLANS_LOCK = threading.Lock()
+_MAX_PLANS = 512
+_MAX_PLAN_BYTES = 4 * 1024 * 1024
+_plan_bytes = 0
+
+# The Prepared being called, per thread; see Prepared.__call__.
+_calling = threading.local()
+
+
+def _plan(function, *args):
+    """
+    Return the (possibly cached) `Prepared` form of ``function(*args)``.
+
+    ``args`` must be complete and positional, as each function's compiler
+    normalizes them to.
+    """
+    args = tuple(tuple(x) if isinstance(x, list) else x for x in args)
+    current = getattr(_calling, "prepared", None)
+    if (
+        current is not None
+        and current.function is function
+        and current.args == args
+    ):
+        return current
+    key = (function,) + args
+    try:
+        with _PLANS_LOCK:
+            # Re-inserted to mark it as the most recently used.
+            prepared = _PLANS[key] = _PLANS.pop(key)
+        return prepared
+    except KeyError:
+        prepared = _COMPILERS[function](*args)
+    except TypeError:
+        # Unhashable arguments; not worth caching
+        return _COMPILERS[function](*args)
+    _remember(prepared)
+    return prepared
+
+
+def _remember(prepared):
+    global _plan_bytes
+    try:
+        key = (prepared.function,) + prepared.args
+        hash(key)
+    except TypeError:
+        return
+    size = _plan_size(prepared)
+    if size > _MAX_PLAN_BYTES:
+        return
+    with _PLANS_LOCK:
+        if key in _PLANS:
+            _plan_bytes -= _plan_size(_PLANS.pop(key))
+        _PLANS[key] = prepared
+        _plan_bytes += size
+        while len(_PLANS) > _MAX_PLANS or _plan_bytes > _MAX_PLAN_BYTES:
+            _plan_bytes -= _plan_size(_PLANS.popitem(last=False)[1])
+
+
+def _forget_plans():
+    global _plan_bytes
+    with _PLANS_LOCK:
+        _PLANS.clear()
+        _plan_bytes = 0
+
+
+def _plan_size(prepared):
+    # Roughly the memory a cached plan keeps alive: its strings' lengths.
+    strings = prepared.commands + prepared.checks
+    return sum(len(x) for x in strings if x is not None)
+
+
+def _compile_directory(path, user=None, group=None, mode=None):
+    commands = _directory_commands(path, user, group, mode)
+    return Prepared(directory, (path, user, group, mode), commands)
+
+
+def _compile_exists(path):
+    return Prepared(exists, (path,), [_exists_command(path)])
+
+
+def _compile_exists_many(paths, stat=False):
+    paths = tuple(paths)
+    commands = _exists_many_commands(paths, stat)
+    return Prepared(exists_many, (paths, stat), commands)
+
+
+def _compile_contains(filename, text, exact=False, escape=True):
+    command = _contains_command(filename, text, exact, escape)
+    return Prepared(contains, (filename, text, exact, escape), [command])
+
+
+def _compile_search(
+    filename, patterns, fixed=False, line_numbers=False, limit=1
+):
+    patterns = tuple(patterns)
+    commands = []
+    if patterns:
+        commands.append(_search_command(filename, patterns, fixed, limit))
+    args = (filename, patterns, fixed, line_numbers, limit)
+    return Prepared(search, args, commands)
+
+
+def _compile_append(filename, text, partial=False, escape=True, batch=False):
+    if isinstance(text, six.string_types):
+        text = [text]
+    text = tuple(text)
+    args = (filename, text, partial, escape, batch)
+    if batch:
+        commands = _append_batch_commands(filename, text, partial)
+        return Prepared(append, args, commands)
+    commands = [_append_command(filename, x, escape) for x in text]
+    checks = [_append_regex(x, partial) if x else None for x in text]
+    return Prepared(append, args, commands, checks)
+
+
+def _compile_ensure_block(
+    filename, lines, marker="patchwork", comment="#", present=True
+):
+    if isinstance(lines, six.string_types):
+        lines = [lines]
+    lines = tuple(lines)
+    command = _ensure_block_command(filename, lines, marker, comment, present)
+    args = (filename, lines, marker, comment, present)
+    return Prepared(ensure_block, args, [command])
+
+
+_COMPILERS = {
+    directory: _compile_directory,
+    exists: _compile_exists,
+    exists_many: _compile_exists_many,
+    contains: _compile_contains,
+    search: _compile_search,
+    append: _compile_append,
+    ensure_block: _compile_ensure_block,
+}
+
+
+# Command builders. These are shared with the asyncio API in `.aio`, so they
+# must stay free of any actual command execution.
+
+
+def _directory_commands(path, user=None, group=None, mode=None):
+    commands = ["mkdir -p {}".format(path)]
+    if user is not None:
+        group = group or user
+        commands.append("chown {}:{} {}".format(user, group, path))
+    if mode is not None:
+        commands.append("chmod {} {}".format(mode, path))
+    return commands
+
+
+def _exists_command(path):
+    return 'test -e "$(echo {})"'.format(path)
+
+
+def _exists_many_commands(paths, stat):
+    if stat:
+        probe = "stat -L -c '%F\t%s\t%Y\t%a' \"$p\" 2>/dev/null || echo"
+    else:
+        probe = 'test -e "$p" && echo 1 || echo 0'
+    lines = [
+        'p="$(echo {})"; printf "{}\\t"; {}'.format(path, index, probe)
+        for index, path in enumerate(paths)
+    ]
+    return [x for x, _ in _shell_commands(lines)]
+
+
+def _parse_exists_many(stdout, paths, stat):
+    """
+    Yield ``(path, value)`` for each line of `_exists_many_commands` output.
+    """
+    for line in stdout.splitlines():
+        fields = line.split("\t")
+        path = paths[int(fields[0])]
+        if not stat:
+            yield path, fields[1:] == ["1"]
+        elif len(fields) == 5:
+            type_, size, mtime, mode = fields[1:]
+            yield path, Stat(
+                type=_STAT_TYPES.get(type_, type_),
+                size=int(size),
+                mtime=int(mtime),
+                mode=int(mode, 8),
+            )
+        else:
+            yield path, None
+
+
+def _contains_command(filename, text, exact=False, escape=True):
+    if escape:
+        text = _escape_for_regex(text)
+        if exact:
+            text = "^{}$".format(text)
+    return 'egrep "{}" "{}"'.format(text, filename)
+
+
+# Patterns are handed over as arguments (and then removed from ARGV so awk
+# doesn't try to read them as files); unlike -v assignments, arguments don't
+# undergo escape processing, so regexes arrive intact.
+_SEARCH_PROGRAM = """
+BEGIN {{
+    n = ARGC - 2; left = n
+    for (i = 1; i <= n; i++) {{ p[i] = ARGV[i]; delete ARGV[i] }}
+}}
+{{
+    for (i = 1; i <= n; i++) {{
+        if ((!limit || c[i] < limit) && {match}) {{
+            print i - 1, FNR
+            if (++c[i] == limit && --left == 0) exit
+        }}
+    }}
+}}
+"""
+
+
+def _search_command(filename, patterns, fixed=False, limit=1):
+    match = "index($0, p[i])" if fixed else "$0 ~ p[i]"
+    program = _SEARCH_PROGRAM.format(match=match)
+    return 'awk -v limit={} {} {} "{}"'.format(
+        limit or 0,
+        six.moves.shlex_quote(program),
+        " ".join(six.moves.shlex_quote(x) for x in patterns),
+        filename,
+    )
+
+
+def _append_regex(line, partial):
+    return "^" + _escape_for_regex(line) + ("" if partial else "$")
+
+
+def _append_command(filename, line, escape=True):
+    line = line.replace("'", r"'\\''") if escape else line
+    return "echo '{}' >> {}".format(line, filename)
+
+
+# Arguments are: begin marker, end marker, and (for the rewrite) the desired
+# block text including markers, or "" to remove it. See _SEARCH_PROGRAM re:
+# why these are arguments.
+_BLOCK_EXTRACT = """
+BEGIN { b = ARGV[1]; e = ARGV[2]; delete ARGV[1]; delete ARGV[2] }
+$0 == b { inside = 1 }
+inside { print }
+inside && $0 == e { exit }
+"""
+
+_BLOCK_REWRITE = """
+BEGIN {
+    b = ARGV[1]; e = ARGV[2]; block = ARGV[3]
+    for (i = 1; i <= 3; i++) delete ARGV[i]
+}
+$0 == b { if (!done) printf "%s", block; done = skip = 1; next }
+skip { if ($0 == e) skip = 0; next }
+{ print }
+END {
+    # A begin marker without an end one: rewriting would drop everything
+    # after it, so refuse (leaving the file alone) instead.
+    if (skip) { printf "unterminated block: %s\\n", b > "/dev/stderr"; exit 2 }
+    if (!done) printf "%s", block
+}
+"""
+
+
+def _ensure_block_command(filename, lines, marker, comment, present):
+    quote = six.moves.shlex_quote
+    begin = "{} BEGIN {}".format(comment, marker)
+    end = "{} END {}".format(comment, marker)
+    block = ""
+    if present:
+        block = "\n".join([begin] + list(lines) + [end]) + "\n"
+    markers = "{} {}".format(quote(begin), quote(end))
+    expected = _sha256(io.BytesIO(block.encode("utf-8")))
+    script = "\n".join(
+        [
+            'f="$(echo {})"; t="$f.patchwork-tmp"'.format(filename),
+            'current() { test -e "$f" && cat "$f"; }',
+            "sum=$(current | awk {} {} | sha256sum)".format(
+                quote(_BLOCK_EXTRACT), markers
+            ),
+            '[ "${{sum%% *}}" = {} ] && exit 0'.format(expected),
+            'if test -e "$f"; then cp -p "$f" "$t"; else : > "$t"; fi',
+            "current | awk {} {} {} > \"$t\" && mv -f \"$t\" \"$f\"".format(
+                quote(_BLOCK_REWRITE), markers, quote(block)
+            ),
+            'rc=$?; rm -f "$t"; [ $rc -eq 0 ] && echo changed; exit $rc',
+        ]
+    )
+    return "sh -c {}".format(quote(script))
+
+
+def _install_command(staging, remote, user=None, group=None, mode=None):
+    """
+    Command moving uploaded ``staging`` over ``remote``, atomically.
+
+    As in `_ensure_block_command`, the new file starts out as a copy of any
+    existing ``remote`` (made with ``cp -p``) which is then overwritten, so
+    that its mode and ownership carry over unless given explicitly.
+    """
+    partial = "{}.patchwork-tmp".format(remote)
+    steps = [
+        'if test -e "{1}"; then cp -p "{1}" "{2}" && cat "{0}" > "{2}"; '
+        'else cp "{0}" "{2}"; fi'.format(staging, remote, partial)
+    ]
+    if user is not None:
+        group = group or user
+        steps.append('chown {}:{} "{}"'.format(user, group, partial))
+    if mode is not None:
+        steps.append('chmod {} "{}"'.format(mode, partial))
+    steps.append('mv -f "{}" "{}"'.format(partial, remote))
+    return '{}; rc=$?; rm -f "{}" "{}"; exit $rc'.format(
+        " && ".join(steps), staging, partial
+    )
+
+
+def _append_batch_commands(filename, lines, partial):
+    """
+    Commands appending missing ``lines`` to ``filename`` via ``sh -c``.
+
+    Usually there's just one, but long lists are split over several scripts
+    (see `~patchwork.util._shell_commands`), which run one after another.
+    Each appended line's index is echoed back so we can tell the caller what
+    actually changed. ``set -e`` ensures a failed append aborts the script
+    (and thus raises, unless the runner was told to ``warn``.)
+    """
+    parts = []
+    for index, line in enumerate(lines):
+        write = "printf '%s\\n' {} >> {}; echo {}".format(
+            six.moves.shlex_quote(line), filename, index
+        )
+        if not line:
+            parts.append(write)
+            continue
+        regex = "^" + _escape_for_bre(line) + ("" if partial else "$")
+        test = "test -e {0} && grep -q -e {1} {0}".format(
+            filename, six.moves.shlex_quote(regex)
+        )
+        parts.append("{{ {}; }} || {{ {}; }}".format(test, write))
+    return [x for x, _ in _shell_commands(parts, prefix="set -e")]
+
+
+def _parse_append_batch(stdout, lines):
+    return [lines[int(index)] for index in stdout.split()]
+
+
+@_memoize
+def _escape_for_bre(text):
+    """Escape ``text`` to allow literal matching using (basic regex) grep"""
+    return re.sub(r"([\\.*\[^$])", r"\\\1", text)
 
 
+@_memoize
 def _escape_for_regex(text):
     """Escape ``text`` to allow literal matching using egrep"""
     regex = re.escape(text)
@@ -6,32 +6,113 @@ manipulate this information (such as `.packages`). For example, detecting
 operating system family and version.
 """
 
-from .files import exists
+import json
+import os
+import shlex
+import time
+
+from .util import context_state
+
+
+#: Files whose mere existence identifies a distribution; checked in order.
+SENTINEL_FILES = (
+    ("fedora", "/etc/fedora-release"),
+    ("centos", "/etc/centos-release"),
+)
+
+#: Distribution names understood via ``/etc/os-release``'s ``ID`` field.
+KNOWN_DISTROS = (
+    "fedora",
+    "rhel",
+    "centos",
+    "ubuntu",
+    "debian",
+    "alpine",
+    "arch",
+)
+
+# Separates os-release contents from sentinel probe output.
+_MARKER = "--patchwork-facts--"
+
+
+def facts(c, cache_dir=None, ttl=None, refresh=False):
+    """
+    Gather (and cache) basic facts about the host ``c`` is connected to.
+
+    All facts are gathered with a single remote command, which reads
+    ``/etc/os-release`` and checks for the distribution sentinel files at the
+    same time. The result is cached on ``c`` itself, so subsequent calls (e.g.
+    from `distro_name`, `distro_family` or `.packages.package`) cost nothing.
+
+    The returned dict has the following keys:
+
+    * ``os_release``: a dict of the key/value pairs in ``/etc/os-release``
+      (empty if the file is missing);
+    * ``sentinels``: list of the `SENTINEL_FILES` found on the host.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param str cache_dir:
+        Optional local directory in which to additionally cache facts on disk,
+        one JSON file per host, so they survive across processes.
+    :param int ttl:
+        Maximum age, in seconds, of on-disk cache entries; older entries are
+        ignored and regathered. Defaults to ``None`` (never expire.)
+    :param bool refresh:
+        Whether to ignore all caches and regather facts unconditionally.
+    """
+    state = context_state(c, "info")
+    if not refresh and "facts" in state:
+        return state["facts"]
+    path = _cache_path(c, cache_dir) if cache_dir else None
+    found = None
+    if path and not refresh:
+        found = _read_cache(path, ttl)
+    if found is None:
+        found = _gather(c)
+        if path:
+            _write_cache(path, found)
+    state["facts"] = found
+    return found
+
+
+def clear_facts(c, cache_dir=None):
+    """
+    Forget any facts cached for ``c`` by `facts`.
+
+    :param c:
+        `~invoke.context.Context` whose cached facts should be dropped.
+    :param str cache_dir:
+        If given, the on-disk cache entry for ``c``'s host is removed too.
+    """
+    context_state(c, "info").pop("facts", None)
+    if cache_dir:
+        path = _cache_path(c, cache_dir)
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def distro_name(c):
     """
     Return simple Linux distribution name identifier, e.g. ``"ubuntu"``.
 
-    Uses tools like ``/etc/issue``, and ``lsb_release`` and fits the remote
-    system into one of the following:
+    Uses ``/etc/os-release`` and well-known sentinel files, and fits the
+    remote system into one of the following:
 
     * ``fedora``
     * ``rhel``
     * ``centos``
     * ``ubuntu``
     * ``debian``
+    * ``alpine``
+    * ``arch``
     * ``other``
+
+    Sentinel files (see `SENTINEL_FILES`) take precedence over the ``ID``
+    field of ``/etc/os-release``. Detection is performed via `facts`, and so
+    is cached per connection.
     """
-    sentinel_files = {
-        "fedora": ("fedora-release",),
-        "centos": ("centos-release",),
-    }
-    for name, sentinels in sentinel_files.items():
-        for sentinel in sentinels:
-            if exists(c, "/etc/{}".format(sentinel)):
-                return name
-    return "other"
+    return _distro_name(facts(c))
 
 
 def distro_family(c):
@@ -46,12 +127,88 @@ def distro_family(c):
     If the system falls outside these categories, its specific family or
     release name will be returned instead.
     """
+    return _distro_family(distro_name(c))
+
+
+def _distro_name(found):
+    for name, sentinel in SENTINEL_FILES:
+        if sentinel in found["sentinels"]:
+            return name
+    distro = found["os_release"].get("ID", "")
+    if distro in KNOWN_DISTROS:
+        return distro
+    return "other"
+
+
+def _distro_family(distro):
     families = {
         "debian": "debian ubuntu".split(),
         "redhat": "rhel centos fedora".split(),
     }
-    distro = distro_name(c)
     for family, members in families.items():
         if distro in members:
             return family
     return distro
+
+
+def _gather(c):
+    return _parse_facts(c.run(_gather_command(), hide=True, warn=True).stdout)
+
+
+def _gather_command():
+    tests = "; ".join(
+        'test -e "{0}" && echo "{0}"'.format(sentinel)
+        for _, sentinel in SENTINEL_FILES
+    )
+    return "cat /etc/os-release 2>/dev/null; echo {}; {}; true".format(
+        _MARKER, tests
+    )
+
+
+def _parse_facts(stdout):
+    release, _, sentinels = stdout.partition(_MARKER)
+    return {
+        "os_release": _parse_os_release(release),
+        "sentinels": sentinels.split(),
+    }
+
+
+def _parse_os_release(text):
+    values = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if not sep or key.startswith("#"):
+            continue
+        try:
+            value = " ".join(shlex.split(value))
+        except ValueError:
+            pass
+        values[key] = value
+    return values
+
+
+def _cache_path(c, cache_dir):
+    host = getattr(c, "host", None) or "localhost"
+    return os.path.join(cache_dir, "{}.json".format(host))
+
+
+def _read_cache(path, ttl):
+    try:
+        with open(path) as fd:
+            entry = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+    if ttl is not None and time.time() - entry.get("time", 0) > ttl:
+        return None
+    return entry.get("facts")
+
+
+def _write_cache(path, found):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write-then-rename so concurrent readers never see partial JSON.
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as fd:
+        json.dump({"time": time.time(), "facts": found}, fd)
+    os.rename(tmp, path)
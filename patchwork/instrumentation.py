@@ -0,0 +1,111 @@
+"""
+Measuring what Patchwork operations cost, in commands and wall-clock time.
+
+Every `~patchwork.util.set_runner`-decorated function funnels its remote
+commands through a single runner; `Recorder` hooks into that choke point (via
+`~patchwork.util.add_call_hook`) to find out which operations dominate a run::
+
+    from patchwork.instrumentation import Recorder
+
+    with Recorder() as recorder:
+        deploy(c)
+
+    print(recorder.to_json(indent=2))
+"""
+
+import json
+import threading
+
+from .util import add_call_hook, remove_call_hook
+
+
+class Recorder(object):
+    """
+    Collects `~patchwork.util.CallRecord` objects and summarizes them.
+
+    Use as a context manager (which registers and unregisters the recorder
+    as a call hook), or register it yourself with
+    `~patchwork.util.add_call_hook` -- instances are callable. Recording is
+    thread-safe, so one recorder may observe operations running on many hosts
+    at once (e.g. via `.parallel.fan_out`.)
+    """
+
+    def __init__(self):
+        #: All `~patchwork.util.CallRecord` objects observed, in completion
+        #: order.
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.calls.append(record)
+
+    def __enter__(self):
+        add_call_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_call_hook(self)
+
+    def report(self, detail=False):
+        """
+        Aggregate recorded calls into a JSON-friendly dict.
+
+        The result has ``functions`` and ``hosts`` keys, each mapping a
+        function name or hostname (respectively) to a dict of totals:
+
+        - ``calls``: number of calls;
+        - ``errors``: how many of those calls raised an exception;
+        - ``commands``: number of commands issued;
+        - ``sudo_commands``: how many of those were run via ``sudo``;
+        - ``time``: total wall-clock seconds spent in calls;
+        - ``command_time``: total seconds spent running commands.
+
+        :param bool detail:
+            Whether to also include a ``calls`` key, listing every call and
+            each of its commands individually.
+        """
+        with self._lock:
+            calls = list(self.calls)
+        report = {"functions": {}, "hosts": {}}
+        for call in calls:
+            functions, hosts = report["functions"], report["hosts"]
+            _accumulate(functions.setdefault(call.function, _totals()), call)
+            _accumulate(hosts.setdefault(call.host, _totals()), call)
+        if detail:
+            report["calls"] = [_describe(call) for call in calls]
+        return report
+
+    def to_json(self, detail=False, **kwargs):
+        """
+        Return `report` serialized as JSON.
+
+        :param bool detail: Passed to `report`.
+        :param kwargs: Passed to `json.dumps` (e.g. ``indent=2``.)
+        """
+        return json.dumps(self.report(detail=detail), **kwargs)
+
+
+def _totals():
+    keys = "calls errors commands sudo_commands time command_time".split()
+    return dict.fromkeys(keys, 0)
+
+
+def _accumulate(totals, call):
+    totals["calls"] += 1
+    totals["errors"] += call.error is not None
+    totals["commands"] += len(call.commands)
+    totals["sudo_commands"] += len(call.commands) if call.sudo else 0
+    totals["time"] += call.duration or 0
+    totals["command_time"] += sum(x.duration for x in call.commands)
+
+
+def _describe(call):
+    return {
+        "function": call.function,
+        "host": call.host,
+        "sudo": call.sudo,
+        "duration": call.duration,
+        "error": None if call.error is None else repr(call.error),
+        "commands": [x._asdict() for x in call.commands],
+    }
@@ -1,32 +1,408 @@
 """
 Management of various (usually binary) package types - OS, language, etc.
+
+Each package manager is driven by a backend (see `Backend`) living in its own
+submodule: `.apt`, `.dnf` (``dnf`` and ``yum``), `.apk`, `.pacman` and
+`.gem`. The functions in here pick the right one for the remote system, or
+take a ``manager`` name explicitly, and accept the backends' ``cache`` and
+``proxy`` options, e.g. to download through a local mirror::
+
+    from patchwork.packages import package, prefetch
+
+    options = dict(proxy="http://apt-cache:3142", refresh=True)
+    download = prefetch(c, "postgresql", "nginx", **options)
+    ... # other work, while packages download
+    package(c, "postgresql", "nginx", **options)
 """
 
-# TODO: intent is to have various submodules for the various package managers -
-# apt/deb, rpm/yum/dnf, arch/pacman, etc etc etc.
+import threading
+import time
 
+from collections import namedtuple
 
+from invoke.exceptions import UnexpectedExit
+from invoke.vendor import six
+
+from patchwork.environment import clear_programs
 from patchwork.info import distro_family
+from patchwork.util import _open, context_state
+
+from .apk import Apk
+from .apt import Apt
+from .base import Backend  # noqa
+from .dnf import Dnf, Yum
+from .gem import Gem
+from .pacman import Pacman
+
 
+#: Outcome of a `package` call: lists of package names which were newly
+#: ``installed``, already ``present`` beforehand, or which ``failed``.
+PackageReport = namedtuple("PackageReport", "installed present failed")
 
-def package(c, *packages):
+#: `Backend` classes, by the names accepted as ``manager``.
+BACKENDS = dict((x.name, x) for x in (Apt, Dnf, Yum, Apk, Pacman, Gem))
+
+#: Backend names used for each `.info.distro_family`; others get ``yum``.
+FAMILY_BACKENDS = {
+    "debian": "apt",
+    "redhat": "yum",
+    "alpine": "apk",
+    "arch": "pacman",
+}
+
+#: Default number of seconds package metadata stays fresh; see `refresh`.
+REFRESH_TTL = 3600
+
+# Remote file whose mtime records a backend's last metadata refresh.
+_STAMP = "/var/tmp/patchwork-{}-refreshed"
+
+
+def backend(c, manager=None, **options):
+    """
+    Return a `Backend` for the package manager ``c``'s host uses.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param str manager:
+        Name of the backend to use (a key of `BACKENDS`), instead of
+        choosing one based on `.info.distro_family`.
+    :param options:
+        Backend options, such as ``cache`` and ``proxy``.
+
+    :raises: `ValueError` if ``manager`` is unknown.
+    """
+    if manager is None:
+        manager = _family_backend(distro_family(c))
+    return _create_backend(manager, options)
+
+
+def package(c, *packages, **kwargs):
     """
     Installs one or more ``packages`` using the system package manager.
 
     Specifically, this function calls a package manager like ``apt-get`` or
-    ``yum`` once per package given.
+    ``yum``. Packages which are already installed (as determined by a single
+    ``dpkg-query`` or ``rpm -q`` call) are skipped, and the rest are installed
+    in one package manager transaction.
+
+    If that transaction fails, the remaining packages are retried one at a
+    time in order to pinpoint which of them are at fault.
+
+    Any downloads started for ``c`` by `prefetch` are waited for first.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param packages:
+        Names of packages to install.
+    :param bool transaction:
+        Keyword-only. Whether to install all packages in one package manager
+        invocation. When ``False``, the package manager is called once per
+        package instead. Default: ``True``.
+    :param bool warn:
+        Keyword-only. Whether to merely report failed installs instead of
+        raising the first failure's exception. Default: ``False``.
+    :param bool refresh:
+        Keyword-only. Whether to `refresh` package metadata first (if older
+        than ``ttl`` seconds, which defaults to `REFRESH_TTL`.) Default:
+        ``False``.
+    :param str manager:
+        Keyword-only. Backend name; see `backend`.
+    :param options:
+        Other keyword arguments are backend options, e.g. ``cache`` and
+        ``proxy``; see `Backend`.
+
+    :returns: A `PackageReport`.
+    """
+    transaction = kwargs.pop("transaction", True)
+    warn = kwargs.pop("warn", False)
+    fresh = kwargs.pop("refresh", False)
+    ttl = kwargs.pop("ttl", REFRESH_TTL)
+    manager = _backend(c, "package", kwargs)
+    for pending in context_state(c, "packages").pop("prefetches", []):
+        pending._join()
+    if fresh:
+        _refresh(c, manager, ttl)
+    present = _installed(c, manager, packages)
+    steps = _install(c, manager, packages, present, transaction, warn)
+    step = next(steps)
+    while not isinstance(step, PackageReport):
+        step = steps.send(c.sudo(step, warn=True))
+    return step
+
+
+def installed_packages(c, packages, family=None, **kwargs):
+    """
+    Return the subset of ``packages`` which are already installed.
+
+    Uses a single query (e.g. ``dpkg-query`` on Debian, ``rpm -q`` on Red Hat
+    family systems) regardless of how many packages are given.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param packages:
+        Iterable of package names to check.
+    :param str family:
+        Distribution family, as returned by `.info.distro_family`; looked up
+        if not given.
+    :param str manager:
+        Keyword-only. Backend name, overriding ``family``; see `backend`.
+
+    :returns: A `set` of package names.
+    """
+    packages = list(packages)
+    if not packages:
+        return set()
+    if family is not None and "manager" not in kwargs:
+        kwargs["manager"] = _family_backend(family)
+    return _installed(c, _backend(c, "installed_packages", kwargs), packages)
+
+
+def refresh(c, ttl=REFRESH_TTL, force=False, **kwargs):
+    """
+    Refresh package metadata (e.g. ``apt-get update``), unless still fresh.
+
+    Metadata counts as fresh if this function (or `package` or `prefetch`
+    with ``refresh=True``) refreshed it less than ``ttl`` seconds ago: in
+    this process, which costs nothing to check; or, going by a timestamp
+    file under ``/var/tmp``, at any time before -- so e.g. consecutive image
+    builds sharing a base layer don't each refresh again.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param int ttl:
+        Maximum age, in seconds, of metadata which needn't be refreshed.
+    :param bool force:
+        Whether to refresh regardless of age.
+    :param str manager:
+        Keyword-only. Backend name; see `backend`.
+    :param options:
+        Other keyword arguments are backend options; see `Backend`.
+
+    :returns: ``True`` if metadata was refreshed, ``False`` otherwise.
+    """
+    manager = _backend(c, "refresh", kwargs)
+    return _refresh(c, manager, 0 if force else ttl)
+
+
+def prefetch(c, *packages, **kwargs):
+    """
+    Start downloading ``packages`` without installing them, in the background.
+
+    This lets slow downloads overlap with other work (on this or other
+    hosts), so that a later `package` call only has to install. That call
+    waits for any prefetches still running on ``c`` first, since package
+    managers can't install and download at once. Packages already installed
+    are skipped.
+
+    Backends lacking a download-only mode (`.apk` and `.gem`) merely check
+    what's installed (and refresh, if asked.)
+
+    The download shares ``c`` with the caller, each using its own SSH
+    session, so ``c`` is opened (if it isn't already) before this returns.
+
+    :param c:
+        `~invoke.context.Context` within to execute commands.
+    :param packages:
+        Names of packages to download.
+    :param bool refresh:
+        Keyword-only. Whether to `refresh` package metadata first (if older
+        than ``ttl`` seconds, which defaults to `REFRESH_TTL`.) Default:
+        ``False``.
+    :param str manager:
+        Keyword-only. Backend name; see `backend`.
+    :param options:
+        Other keyword arguments are backend options, e.g. ``cache``; see
+        `Backend`. Use the same options for the eventual `package` call.
+
+    :returns: A `Prefetch`.
+    """
+    fresh = kwargs.pop("refresh", False)
+    ttl = kwargs.pop("ttl", REFRESH_TTL)
+    manager = _backend(c, "prefetch", kwargs)
+
+    def download():
+        if fresh:
+            _refresh(c, manager, ttl)
+        present = _installed(c, manager, packages)
+        missing = [x for x in packages if x not in present]
+        command = manager.download_command(missing) if missing else None
+        if command is None:
+            return None
+        return c.sudo(command, hide=True, warn=True)
+
+    _open(c)
+    pending = Prefetch(download)
+    context_state(c, "packages").setdefault("prefetches", []).append(pending)
+    return pending
+
+
+class Prefetch(object):
+    """
+    A download started by `prefetch`, running in a background thread.
+    """
+
+    def __init__(self, download):
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(download,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, download):
+        try:
+            self.result = download()
+        except Exception as e:
+            self.error = e
+
+    def _join(self):
+        # Join in small increments so KeyboardInterrupt is still delivered.
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def wait(self):
+        """
+        Wait for the download to finish.
+
+        :returns:
+            The download command's `~invoke.runners.Result` (which may have
+            failed; prefetching is only an optimization), or ``None`` if
+            nothing needed downloading.
+        :raises: Whatever exception the download raised, if any.
+        """
+        self._join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def rubygem(c, *gems, **kwargs):
+    """
+    Install one or more Ruby gems, skipping those already installed.
+
+    Shorthand for `package` with ``manager="gem"``, so the missing gems are
+    installed with one ``gem install`` call. Besides the usual backend
+    options, the `.gem` backend accepts a gem server URL as ``source``.
+
+    :returns: A `PackageReport`.
+    """
+    kwargs["manager"] = "gem"
+    return package(c, *gems, **kwargs)
+
+
+def _backend(c, caller, kwargs):
+    """
+    Pop ``manager`` and backend options from ``kwargs``; return a `Backend`.
+
+    ``kwargs`` must hold nothing else.
+    """
+    manager, options = _options(caller, kwargs)
+    return backend(c, manager, **options)
+
+
+def _options(caller, kwargs):
+    """
+    Pop ``manager`` and backend options from ``kwargs``, returning both.
+
+    ``kwargs`` must hold nothing else.
+    """
+    manager = kwargs.pop("manager", None)
+    options = dict(
+        (x, kwargs.pop(x)) for x in ("cache", "proxy", "source") if x in kwargs
+    )
+    if kwargs:
+        err = "{}() got unexpected keyword arguments: {}"
+        raise TypeError(err.format(caller, ", ".join(sorted(kwargs))))
+    return manager, options
+
+
+def _create_backend(manager, options):
+    if manager not in BACKENDS:
+        raise ValueError("Unknown package manager: {!r}".format(manager))
+    return BACKENDS[manager](**options)
+
+
+def _family_backend(family):
+    return FAMILY_BACKENDS.get(family, "yum")
+
+
+def _install(c, manager, packages, present, transaction, warn):
+    """
+    Generator driving `package`'s installs, given the ``present`` packages.
+
+    Yields each install command, to be sent back its ``warn=True`` result,
+    and finally yields the `PackageReport` (or raises the first failure.)
+    Running the commands is left to the caller, so that `.aio.package` can
+    share this.
+    """
+    missing = [x for x in packages if x not in present]
+    installed, failed, error = [], [], None
+    if missing and transaction:
+        result = yield manager.install_command(missing)
+        if result.ok:
+            installed, missing = missing, []
+    for package in missing:
+        result = yield manager.install_command([package])
+        if result.ok:
+            installed.append(package)
+        else:
+            failed.append(package)
+            # Failed Results are falsy, so no "error or result" here.
+            if error is None:
+                error = result
+    if installed:
+        # New packages usually mean new programs on $PATH.
+        clear_programs(c)
+    if error is not None and not warn:
+        raise UnexpectedExit(error)
+    present = [x for x in packages if x in present]
+    yield PackageReport(installed=installed, present=present, failed=failed)
+
+
+def _installed(c, manager, packages):
+    packages = list(packages)
+    if not packages:
+        return set()
+    result = c.run(manager.installed_command(packages), hide=True, warn=True)
+    return manager.parse_installed(result.stdout, packages)
+
+
+def _refresh(c, manager, ttl):
+    command = _refresh_command(c, manager, ttl)
+    if command is None:
+        return False
+    return _refreshed(c, manager, c.sudo(command, hide=True))
+
+
+def _refresh_command(c, manager, ttl):
+    """
+    Return the command refreshing ``manager``'s metadata, or ``None``.
+
+    ``None`` means there is nothing to do: the backend has no metadata, or
+    this process refreshed it less than ``ttl`` seconds ago. The command
+    itself skips the refresh if the remote timestamp is fresh enough.
     """
-    # Try to suppress interactive prompts, assume 'yes' to all questions
-    apt = "DEBIAN_FRONTEND=noninteractive apt-get install -y {}"
-    # Run from cache vs updating package lists every time; assume 'yes'.
-    yum = "yum install -y %s"
-    manager = apt if distro_family(c) == "debian" else yum
-    for package in packages:
-        c.sudo(manager.format(package))
+    command = manager.refresh_command()
+    if command is None:
+        return None
+    refreshed = context_state(c, "packages").get("refreshed", {})
+    if ttl and time.time() - refreshed.get(manager.name, 0) < ttl:
+        return None
+    stamp = _STAMP.format(manager.name)
+    script = "{} && touch {} && echo refreshed".format(command, stamp)
+    if ttl:
+        # find prints the stamp only if modified less than N minutes ago
+        fresh = '[ -n "$(find {} -mmin -{} 2>/dev/null)" ]'.format(
+            stamp, max(1, int(ttl) // 60)
+        )
+        script = "{} || {{ {}; }}".format(fresh, script)
+    return "sh -c {}".format(six.moves.shlex_quote(script))
 
 
-def rubygem(c, gem):
+def _refreshed(c, manager, result):
     """
-    Install a Ruby gem.
+    Record that ``result`` (of a `_refresh_command`) has run; return whether
+    it actually refreshed anything.
     """
-    return c.sudo("gem install -b --no-rdoc --no-ri {}".format(gem))
+    refreshed = context_state(c, "packages").setdefault("refreshed", {})
+    refreshed[manager.name] = time.time()
+    return result.stdout.strip() == "refreshed"
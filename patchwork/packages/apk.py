@@ -0,0 +1,38 @@
+"""
+Alpine Linux: ``apk``.
+"""
+
+from invoke.vendor import six
+
+from .base import Backend
+
+
+class Apk(Backend):
+    """
+    Installs via ``apk``; ``cache`` sets ``--cache-dir``, and ``proxy`` the
+    ``http_proxy`` environment variables.
+
+    ``apk`` has no download-only mode, so prefetching does nothing.
+    """
+
+    name = "apk"
+
+    def install_command(self, packages):
+        return self._apk("add", packages)
+
+    def refresh_command(self):
+        return self._apk("update")
+
+    def installed_command(self, packages):
+        # Prints the name of each installed package given
+        return "apk info -e {}".format(" ".join(packages))
+
+    def parse_installed(self, stdout, packages):
+        return set(stdout.split()) & set(packages)
+
+    def _apk(self, action, packages=()):
+        words = ["apk"]
+        if self.cache is not None:
+            quote = six.moves.shlex_quote
+            words.append("--cache-dir {}".format(quote(self.cache)))
+        return self._proxy_env() + " ".join(words + [action] + list(packages))
@@ -0,0 +1,47 @@
+"""
+Debian-style systems: ``apt-get`` and ``dpkg``.
+"""
+
+from invoke.vendor import six
+
+from .base import Backend
+
+
+class Apt(Backend):
+    """
+    Installs via ``apt-get``; ``cache`` sets ``Dir::Cache::Archives`` and
+    ``proxy`` sets ``Acquire::http::Proxy``.
+    """
+
+    name = "apt"
+
+    def install_command(self, packages):
+        return self._apt_get("install -y", packages)
+
+    def download_command(self, packages):
+        return self._apt_get("install -y --download-only", packages)
+
+    def refresh_command(self):
+        return self._apt_get("update")
+
+    def installed_command(self, packages):
+        query = "dpkg-query -W -f='${{Package}} ${{db:Status-Status}}\\n' {}"
+        return query.format(" ".join(packages))
+
+    def _apt_get(self, action, packages=()):
+        quote = six.moves.shlex_quote
+        # Try to suppress interactive prompts
+        words = ["DEBIAN_FRONTEND=noninteractive", "apt-get"]
+        if self.cache is not None:
+            option = "Dir::Cache::Archives={}".format(self.cache)
+            words.append("-o {}".format(quote(option)))
+        if self.proxy is not None:
+            option = "Acquire::http::Proxy={}".format(self.proxy)
+            words.append("-o {}".format(quote(option)))
+        command = " ".join(words + [action] + list(packages))
+        if self.cache is None:
+            return command
+        # apt-get refuses to use an archives dir lacking a partial/ subdir
+        partial = quote(self.cache.rstrip("/") + "/partial")
+        script = "mkdir -p {} && {}".format(partial, command)
+        return "sh -c {}".format(quote(script))
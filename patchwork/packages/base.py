@@ -0,0 +1,82 @@
+"""
+The interface shared by all package manager backends.
+"""
+
+import abc
+
+from invoke.vendor import six
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Backend(object):
+    """
+    A package manager: builds the commands Patchwork runs, parses their output.
+
+    Backends only hold their options, no connection state, so one instance
+    may be used for any number of hosts. This class is abstract: subclasses
+    must implement at least `install_command` and `installed_command`.
+
+    :param str cache:
+        Remote directory to keep downloaded packages in, instead of the
+        package manager's default; e.g. a volume shared by many image
+        builds.
+    :param str proxy:
+        URL of an HTTP proxy to download through, e.g. a local caching
+        proxy or mirror such as ``apt-cacher-ng``.
+    """
+
+    #: Name of the backend, as accepted by `~patchwork.packages.backend`.
+    name = None
+
+    def __init__(self, cache=None, proxy=None):
+        self.cache = cache
+        self.proxy = proxy
+
+    @abc.abstractmethod
+    def install_command(self, packages):
+        """
+        Command installing all of ``packages`` in one transaction.
+        """
+
+    def download_command(self, packages):
+        """
+        Command downloading ``packages`` (and dependencies) only.
+
+        Returns ``None`` if the package manager can't do that.
+        """
+        return None
+
+    def refresh_command(self):
+        """
+        Command refreshing package metadata, or ``None`` if there is none.
+        """
+        return None
+
+    @abc.abstractmethod
+    def installed_command(self, packages):
+        """
+        Command reporting which of ``packages`` are installed.
+
+        Its output is interpreted by `parse_installed`.
+        """
+
+    def parse_installed(self, stdout, packages):
+        """
+        Return the `set` of ``packages`` reported installed in ``stdout``.
+
+        By default, expects lines of the form ``<name> installed``.
+        """
+        found = set()
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == "installed":
+                found.add(parts[0])
+        return found & set(packages)
+
+    def _proxy_env(self):
+        # For package managers without a proxy option of their own
+        if self.proxy is None:
+            return ""
+        return "http_proxy={0} https_proxy={0} ".format(
+            six.moves.shlex_quote(self.proxy)
+        )
@@ -0,0 +1,50 @@
+"""
+Red Hat-style systems: ``dnf`` or ``yum``, and ``rpm``.
+"""
+
+from invoke.vendor import six
+
+from .base import Backend
+
+
+class Dnf(Backend):
+    """
+    Installs via ``dnf``; ``cache`` and ``proxy`` set the ``cachedir`` and
+    ``proxy`` options (and ``keepcache``, so downloads persist.)
+    """
+
+    name = "dnf"
+
+    def install_command(self, packages):
+        return self._command("install -y", packages)
+
+    def download_command(self, packages):
+        return self._command("install -y --downloadonly", packages)
+
+    def refresh_command(self):
+        return self._command("makecache")
+
+    def installed_command(self, packages):
+        query = "rpm -q --qf '%{{NAME}} installed\\n' {}"
+        return query.format(" ".join(packages))
+
+    def _command(self, action, packages=()):
+        quote = six.moves.shlex_quote
+        words = [self.name]
+        if self.cache is not None:
+            words.append("--setopt=cachedir={}".format(quote(self.cache)))
+            words.append("--setopt=keepcache=1")
+        if self.proxy is not None:
+            words.append("--setopt=proxy={}".format(quote(self.proxy)))
+        return " ".join(words + [action] + list(packages))
+
+
+class Yum(Dnf):
+    """
+    Installs via ``yum``, which takes the same options as ``dnf``.
+
+    On current releases, ``yum`` is ``dnf`` by another name; older ones need
+    the ``downloadonly`` plugin for prefetching.
+    """
+
+    name = "yum"
@@ -0,0 +1,45 @@
+"""
+Ruby gems: ``gem``.
+"""
+
+from invoke.vendor import six
+
+from .base import Backend
+
+
+class Gem(Backend):
+    """
+    Installs gems via ``gem install``; ``proxy`` sets ``--http-proxy``.
+
+    Gems are installed straight from their source, so neither ``cache`` nor
+    prefetching nor refreshing apply.
+
+    :param str source:
+        URL of a gem server (e.g. a local mirror) to use instead of the
+        configured sources.
+    """
+
+    name = "gem"
+
+    def __init__(self, cache=None, proxy=None, source=None):
+        if cache is not None:
+            raise ValueError("The gem backend doesn't support cache")
+        super(Gem, self).__init__(proxy=proxy)
+        self.source = source
+
+    def install_command(self, packages):
+        quote = six.moves.shlex_quote
+        words = ["gem install --no-document"]
+        if self.proxy is not None:
+            words.append("--http-proxy {}".format(quote(self.proxy)))
+        if self.source is not None:
+            source = quote(self.source)
+            words.append("--clear-sources --source {}".format(source))
+        return " ".join(words + list(packages))
+
+    def installed_command(self, packages):
+        # Lists every installed gem; there's no way to ask about only some
+        return "gem list --local --no-versions"
+
+    def parse_installed(self, stdout, packages):
+        return set(stdout.split()) & set(packages)
@@ -0,0 +1,45 @@
+"""
+Arch Linux: ``pacman``.
+"""
+
+from invoke.vendor import six
+
+from .base import Backend
+
+
+class Pacman(Backend):
+    """
+    Installs via ``pacman``; ``cache`` sets ``--cachedir``, and ``proxy`` the
+    ``http_proxy`` environment variables.
+
+    Note that refreshing metadata (``pacman -Sy``) without then upgrading
+    the whole system risks partial upgrades; Arch users may prefer to
+    refresh as part of a full ``pacman -Syu`` instead.
+    """
+
+    name = "pacman"
+
+    def install_command(self, packages):
+        return self._pacman("-S --needed --noconfirm", packages)
+
+    def download_command(self, packages):
+        return self._pacman("-Sw --noconfirm", packages)
+
+    def refresh_command(self):
+        return self._pacman("-Sy --noconfirm")
+
+    def installed_command(self, packages):
+        # Prints "<name> <version>" per installed package, complains (on
+        # stderr) about the rest.
+        return "pacman -Q {}".format(" ".join(packages))
+
+    def parse_installed(self, stdout, packages):
+        found = set(x.split()[0] for x in stdout.splitlines() if x.strip())
+        return found & set(packages)
+
+    def _pacman(self, action, packages=()):
+        words = ["pacman"]
+        if self.cache is not None:
+            quote = six.moves.shlex_quote
+            words.append("--cachedir {}".format(quote(self.cache)))
+        return self._proxy_env() + " ".join(words + [action] + list(packages))
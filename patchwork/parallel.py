@@ -0,0 +1,119 @@
+"""
+Running Patchwork operations against many hosts at once.
+
+Every other Patchwork module operates on a single context/connection. The
+tools in here fan those same functions out across a collection of
+`~fabric.connection.Connection` objects (such as a `~fabric.group.Group`),
+using a bounded pool of threads, and gather per-host results and exceptions
+into a `~fabric.group.GroupResult` just as `~fabric.group.ThreadingGroup`
+does for plain commands.
+"""
+
+import threading
+
+from fabric import GroupResult
+from fabric.exceptions import GroupException
+
+
+#: Default maximum number of hosts operated upon concurrently.
+WORKERS = 32
+
+
+def fan_out(connections, func, *args, **kwargs):
+    """
+    Call ``func(c, *args, **kwargs)`` for every ``c`` in ``connections``.
+
+    Calls happen concurrently, in up to ``workers`` threads at a time. Any
+    Patchwork function taking a context as its first argument works, including
+    `~patchwork.util.set_runner`-decorated ones (so e.g. ``sudo=True`` is
+    passed through as usual)::
+
+        from fabric import Group
+        from patchwork.files import directory
+        from patchwork.parallel import fan_out
+
+        hosts = Group("web1", "web2", "web3")
+        fan_out(hosts, directory, "/srv/app", user="deploy", sudo=True)
+
+    :param connections:
+        Iterable of `~fabric.connection.Connection` objects, e.g. a
+        `~fabric.group.Group`.
+    :param func:
+        The callable to run per connection.
+    :param int workers:
+        Keyword-only. Maximum number of concurrent calls. Defaults to
+        `WORKERS`.
+    :param args:
+        Positional arguments for ``func``, after the connection.
+    :param kwargs:
+        Keyword arguments for ``func``.
+
+    :returns:
+        A `~fabric.group.GroupResult` mapping each connection to ``func``'s
+        return value.
+
+    :raises:
+        `~fabric.exceptions.GroupException`, if any call raised an exception;
+        its ``result`` attribute holds the `~fabric.group.GroupResult`, whose
+        values for the failed hosts are the exceptions raised.
+    """
+    workers = kwargs.pop("workers", WORKERS)
+
+    def call(c):
+        return func(c, *args, **kwargs)
+
+    connections = list(connections)
+    results = GroupResult()
+    for c, value in zip(connections, pool_map(call, connections, workers)):
+        results[c] = value
+    if results.failed:
+        raise GroupException(results)
+    return results
+
+
+def pool_map(func, items, workers=WORKERS):
+    """
+    Return ``[func(item) for item in items]``, computed by a pool of threads.
+
+    Unlike `map`, exceptions do not propagate; instead, whatever exception an
+    item's call raised takes the place of its return value. Order is
+    preserved.
+
+    This is the building block behind `fan_out` and is exposed for advanced
+    use, e.g. driving non-Patchwork callables with the same concurrency model.
+
+    :param func: Callable taking a single argument.
+    :param items: Iterable of arguments to call ``func`` with.
+    :param int workers: Maximum number of threads to use.
+    :returns: A `list`.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(enumerate(items))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                try:
+                    index, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                results[index] = e
+
+    threads = [
+        threading.Thread(target=work)
+        for _ in range(max(1, min(workers or len(items), len(items))))
+    ]
+    for thread in threads:
+        # Don't let a hung host keep the interpreter alive after Ctrl-C.
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join in small increments so KeyboardInterrupt is still delivered.
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
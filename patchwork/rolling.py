@@ -0,0 +1,204 @@
+"""
+Rolling, batched deployments gated on health checks.
+
+`.parallel.fan_out` changes every host at once, which is fast but unsafe: a
+bad release breaks the whole fleet before anyone notices. `rolling` instead
+deploys to a few hosts at a time, checks their health, and stops as soon as
+too many have failed::
+
+    from patchwork.rolling import rolling
+    from patchwork.transfers import rsync
+
+    rollout = rolling(
+        Group(*hosts),
+        lambda c: rsync(c, "build/", "/srv/app", delete=True),
+        check="curl -fsS http://localhost:8000/health",
+        batch_size="10%",
+        depth=2,
+        max_failures=2,
+    )
+    if rollout.halted:
+        ...
+
+With ``depth`` above 1, deployment to the next batch(es) starts as soon as
+the current batch's deployment has finished, overlapping its health checks,
+which hides most of the transfer time; hosts in those batches are then
+already being deployed to if a check fails, so keep ``depth`` small.
+"""
+
+import threading
+import time
+
+from collections import deque, namedtuple
+
+from fabric import GroupResult
+from invoke.vendor import six
+
+from .parallel import WORKERS, pool_map
+
+
+#: Outcome of a `rolling` deployment:
+#:
+#: - ``results``: a `~fabric.group.GroupResult` mapping every host deployed
+#:   to its deploy function's return value, or to the exception raised by
+#:   the deploy function or the health check (a `HealthCheckFailed` if the
+#:   check simply reported failure);
+#: - ``skipped``: list of connections never deployed to, because the
+#:   rollout was halted;
+#: - ``halted``: whether more than ``max_failures`` hosts failed.
+Rollout = namedtuple("Rollout", "results skipped halted")
+
+
+class HealthCheckFailed(Exception):
+    """
+    A host failed its post-deployment health check.
+
+    ``result`` is what the check returned: the command's
+    `~invoke.runners.Result`, or the check callable's (falsey) return value.
+    """
+
+    def __init__(self, result):
+        super(HealthCheckFailed, self).__init__(result)
+        self.result = result
+
+
+def rolling(
+    connections,
+    deploy,
+    check=None,
+    batch_size=1,
+    depth=1,
+    max_failures=0,
+    pause=0,
+    workers=WORKERS,
+):
+    """
+    Run ``deploy`` against ``connections`` in batches, checking health.
+
+    Each batch is deployed to concurrently, then (once every host in it is
+    done) health checked concurrently. Hosts whose deployment raised an
+    exception, or which fail the check, count as failed; once more than
+    ``max_failures`` hosts have failed, no further batches are started.
+
+    :param connections:
+        Iterable of `~fabric.connection.Connection` objects, in rollout
+        order.
+    :param deploy:
+        Callable taking a connection, e.g. a ``lambda`` calling
+        `.transfers.rsync`.
+    :param check:
+        Health check: either a shell command, run (hidden) on each host,
+        which must exit successfully; or a callable taking a connection,
+        which must return a truthy value. ``None`` disables checking.
+    :param batch_size:
+        Hosts per batch: an `int`, or a percentage string of the total such
+        as ``"25%"`` (rounded up.)
+    :param int depth:
+        Number of batches in flight at once. At the default of ``1``,
+        batches are strictly sequential; at ``2``, the next batch is
+        deployed to while the current one is health checked; and so on.
+    :param max_failures:
+        Number of failed hosts tolerated before halting: an `int`, or a
+        percentage string of the total (rounded down.)
+    :param pause:
+        Seconds to wait between a batch's deployment and its health check,
+        e.g. to let services restart.
+    :param int workers:
+        Maximum number of hosts operated on concurrently within a batch.
+
+    :returns: A `Rollout`.
+    """
+    connections = list(connections)
+    total = len(connections)
+    size = max(1, _amount(batch_size, total, round_up=True))
+    threshold = _amount(max_failures, total, round_up=False)
+    batches = deque(connections[x:x + size] for x in range(0, total, size))
+    results = GroupResult()
+    in_flight = deque()
+    failures, halted = 0, False
+
+    def start():
+        if batches and not halted:
+            batch = batches.popleft()
+            in_flight.append((batch, _Deployment(deploy, batch, workers)))
+
+    start()
+    while in_flight:
+        batch, deployment = in_flight.popleft()
+        values = deployment.wait()
+        # Overlap deployment of what's next with this batch's checks
+        while len(in_flight) < depth - 1 and batches and not halted:
+            start()
+        deployed = [c for c, x in zip(batch, values) if not _failed(x)]
+        if check is not None and deployed:
+            if pause:
+                time.sleep(pause)
+            checks = dict(
+                zip(deployed, pool_map(_checker(check), deployed, workers))
+            )
+        else:
+            checks = {}
+        for c, value in zip(batch, values):
+            results[c] = checks.get(c) or value
+            failures += _failed(results[c])
+        # NOTE: not using results.failed, as GroupResult caches it on access
+        if failures > threshold:
+            halted = True
+        if not in_flight:
+            start()
+    skipped = [c for batch in batches for c in batch]
+    return Rollout(results=results, skipped=skipped, halted=halted)
+
+
+class _Deployment(object):
+    """
+    One batch's deployment, running in the background.
+    """
+
+    def __init__(self, deploy, batch, workers):
+        self.values = None
+        self.thread = threading.Thread(
+            target=self.run, args=(deploy, batch, workers)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, deploy, batch, workers):
+        self.values = pool_map(deploy, batch, workers)
+
+    def wait(self):
+        # Join in small increments so KeyboardInterrupt is still delivered.
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        return self.values
+
+
+def _checker(check):
+    def run(c):
+        if callable(check):
+            value = check(c)
+        else:
+            value = c.run(check, hide=True, warn=True)
+        if not value:
+            raise HealthCheckFailed(value)
+        # Only failures are recorded, so the deploy result stands otherwise
+        return None
+
+    return run
+
+
+def _failed(value):
+    return isinstance(value, BaseException)
+
+
+def _amount(value, total, round_up):
+    """
+    Resolve an `int` or ``"N%"`` string against ``total``.
+    """
+    if isinstance(value, six.string_types) and value.endswith("%"):
+        share = float(value[:-1]) * total / 100
+        amount = int(share)
+        if round_up and amount < share:
+            amount += 1
+        return amount
+    return int(value)
@@ -0,0 +1,266 @@
+"""
+Running interdependent Patchwork operations concurrently, across many hosts.
+
+Calling Patchwork functions one after another serializes everything, even
+work which doesn't depend on anything else. A `Scheduler` instead holds a
+graph of named tasks, each of which declares the tasks it must follow::
+
+    from patchwork.scheduler import Scheduler
+
+    s = Scheduler()
+    s.add("packages", package, "nginx")
+    s.add("app-dir", directory, "/srv/app", user="deploy", sudo=True)
+    s.add("config", append, "/etc/nginx/app.conf", lines, after=["packages"])
+    s.add("restart", restart_nginx, after=["config", "app-dir"])
+    results = s.run(Group("web1", "web2", "web3"))
+
+Every task runs once per connection, as soon as the tasks it comes ``after``
+have completed on that same connection. Independent tasks run concurrently,
+both on one host (each in its own SSH session, over the connection's single
+transport) and across hosts, subject to a global and a per-host concurrency
+limit. The threads doing the work come from `.parallel.pool_map`.
+"""
+
+import threading
+
+from collections import namedtuple
+
+from fabric import GroupResult
+from fabric.exceptions import GroupException
+
+from .parallel import WORKERS, pool_map
+from .util import _open
+
+
+#: Default maximum number of tasks running concurrently on any one host.
+PER_HOST = 4
+
+#: A task added via `Scheduler.add`.
+Task = namedtuple("Task", "name func args kwargs after")
+
+
+class DependencyFailed(Exception):
+    """
+    Stands in for the result of a task skipped because a dependency failed.
+
+    ``dependency`` is the name of the failed task.
+    """
+
+    def __init__(self, dependency):
+        super(DependencyFailed, self).__init__(dependency)
+        self.dependency = dependency
+
+
+class TaskError(Exception):
+    """
+    Stands in for a host's results when any of its tasks failed.
+
+    ``results`` maps every task name to its return value, or to the
+    exception it raised (a `DependencyFailed`, for tasks which were skipped.)
+    """
+
+    def __init__(self, results):
+        super(TaskError, self).__init__(sorted(self.errors_in(results)))
+        self.results = results
+
+    @property
+    def errors(self):
+        """
+        The subset of ``results`` which are exceptions.
+        """
+        return self.errors_in(self.results)
+
+    @staticmethod
+    def errors_in(results):
+        return dict(
+            (name, value)
+            for name, value in results.items()
+            if isinstance(value, Exception)
+        )
+
+
+class Scheduler(object):
+    """
+    A dependency graph of tasks, to be run against one or more connections.
+    """
+
+    def __init__(self):
+        #: Tasks added so far, in order.
+        self.tasks = []
+
+    def add(self, name, func, *args, **kwargs):
+        """
+        Add task ``name``, which calls ``func(c, *args, **kwargs)``.
+
+        :param str name:
+            Unique name for the task, used in ``after`` lists and results.
+        :param func:
+            Callable taking a connection as its first argument, e.g. any
+            Patchwork function.
+        :param after:
+            Keyword-only. Iterable of names of tasks which must complete
+            first. They needn't have been added yet, so long as they are by
+            the time `run` is called.
+        :param args: Positional arguments for ``func``.
+        :param kwargs: Keyword arguments for ``func``.
+
+        :returns: The new `Task`.
+        """
+        after = tuple(kwargs.pop("after", ()))
+        if name in [x.name for x in self.tasks]:
+            raise ValueError("Duplicate task name: {!r}".format(name))
+        task = Task(name, func, args, kwargs, after)
+        self.tasks.append(task)
+        return task
+
+    def order(self):
+        """
+        Return the tasks in a valid (topologically sorted) serial order.
+
+        :raises:
+            `ValueError` if a task depends on an unknown task, or if there's
+            a dependency cycle.
+        """
+        names = set(x.name for x in self.tasks)
+        for task in self.tasks:
+            for dependency in task.after:
+                if dependency not in names:
+                    err = "Task {!r} depends on unknown task {!r}"
+                    raise ValueError(err.format(task.name, dependency))
+        done, ordered, remaining = set(), [], list(self.tasks)
+        while remaining:
+            ready = [x for x in remaining if done.issuperset(x.after)]
+            if not ready:
+                cycle = ", ".join(sorted(x.name for x in remaining))
+                raise ValueError("Dependency cycle among: {}".format(cycle))
+            for task in ready:
+                done.add(task.name)
+                ordered.append(task)
+                remaining.remove(task)
+        return ordered
+
+    def run(self, connections, workers=WORKERS, per_host=PER_HOST):
+        """
+        Run every task against every one of ``connections``.
+
+        When a task raises an exception, the tasks depending on it
+        (directly or not) are skipped on that host; everything else carries
+        on.
+
+        :param connections:
+            Iterable of `~fabric.connection.Connection` objects, e.g. a
+            `~fabric.group.Group`.
+        :param int workers:
+            Maximum number of tasks running at once, across all hosts, or
+            ``None`` for no limit beyond ``per_host``.
+        :param int per_host:
+            Maximum number of tasks running at once on any single host, or
+            ``None`` for no limit.
+
+        :returns:
+            A `~fabric.group.GroupResult` mapping each connection to a `dict`
+            of task names and return values.
+
+        :raises:
+            `~fabric.exceptions.GroupException` if any task failed; in its
+            ``result``, hosts with failures map to a `TaskError`.
+        """
+        tasks = self.order()
+        connections = list(connections)
+        per_host = per_host or max(1, len(tasks))
+        workers = workers or len(connections) * per_host
+        run = _Run(tasks, connections, per_host)
+        if run.nodes:
+            pool_map(lambda _: run.work(), range(workers), workers)
+        results = GroupResult()
+        for index, c in enumerate(connections):
+            values = dict(
+                (task.name, run.results[index, task.name]) for task in tasks
+            )
+            failed = TaskError.errors_in(values)
+            results[c] = TaskError(values) if failed else values
+        if results.failed:
+            raise GroupException(results)
+        return results
+
+
+class _Run(object):
+    """
+    State of one `Scheduler.run`; `work` is run by each worker thread.
+
+    Nodes are ``(connection index, task name)`` tuples.
+    """
+
+    def __init__(self, tasks, connections, per_host):
+        self.connections = connections
+        self.per_host = per_host
+        self.tasks = dict((x.name, x) for x in tasks)
+        self.nodes = [
+            (index, task.name)
+            for index in range(len(connections))
+            for task in tasks
+        ]
+        self.waiting = {}
+        self.dependents = dict((x, []) for x in self.nodes)
+        for index, name in self.nodes:
+            after = self.tasks[name].after
+            self.waiting[index, name] = len(after)
+            for dependency in after:
+                self.dependents[index, dependency].append((index, name))
+        self.ready = [x for x in self.nodes if not self.waiting[x]]
+        self.running = [0] * len(connections)
+        # Connection.open() isn't thread-safe; see util._open.
+        self.opening = [threading.Lock() for _ in connections]
+        self.results = {}
+        self.condition = threading.Condition()
+
+    def work(self):
+        while True:
+            with self.condition:
+                node = self._next()
+                while node is None:
+                    if len(self.results) == len(self.nodes):
+                        return
+                    self.condition.wait(0.1)
+                    node = self._next()
+                self.running[node[0]] += 1
+            index, name = node
+            task = self.tasks[name]
+            c = self.connections[index]
+            try:
+                with self.opening[index]:
+                    _open(c)
+                value = task.func(c, *task.args, **task.kwargs)
+                failed = False
+            except Exception as e:
+                value, failed = e, True
+            with self.condition:
+                self.running[index] -= 1
+                self._finish(node, value, failed)
+                self.condition.notify_all()
+
+    def _next(self):
+        for node in self.ready:
+            if self.running[node[0]] < self.per_host:
+                self.ready.remove(node)
+                return node
+        return None
+
+    def _finish(self, node, value, failed):
+        self.results[node] = value
+        for dependent in self.dependents[node]:
+            if dependent in self.results:
+                continue
+            if failed:
+                self._skip(dependent, node[1])
+                continue
+            self.waiting[dependent] -= 1
+            if not self.waiting[dependent]:
+                self.ready.append(dependent)
+
+    def _skip(self, node, dependency):
+        if node in self.results:
+            return
+        self.results[node] = DependencyFailed(dependency)
+        for dependent in self.dependents[node]:
+            self._skip(dependent, dependency)
@@ -0,0 +1,272 @@
+"""
+Declarative, desired-state counterparts to the imperative Patchwork functions.
+
+Instead of calling `.files.directory`, `.files.append`, `.packages.package`
+and `.transfers.rsync` one after another (each of which checks and then
+mutates the host on its own), describe the desired state of a host as data::
+
+    from patchwork.state import Directory, Line, Package, Tree, converge
+
+    resources = [
+        Package("nginx"),
+        Directory("/srv/app", user="deploy", mode="0755"),
+        Line("/etc/environment", "APP_ENV=production"),
+        Tree("build/", "/srv/app", options={"delete": True}),
+    ]
+    converge(c, resources, sudo=True)
+
+`plan` gathers the current state of every resource in a handful of batched
+commands (one for all paths and lines, unless too many to fit on one command
+line; one for all packages; and one local ``rsync --dry-run`` per tree), and
+returns the list of `Action` objects needed to get from there to the desired
+state. `apply` then performs only those actions, again batched: at most one
+package manager transaction, one `~patchwork.util.Pipeline` flush for all
+directory and line changes, and one ``rsync`` per tree which actually has
+changes. `converge` does both, and doubles as a dry run.
+"""
+
+from collections import namedtuple
+
+from invoke.vendor import six
+
+from . import files as _files
+from . import packages as _packages
+from . import transfers as _transfers
+from .environment import clear_programs
+from .util import Pipeline, _shell_commands
+
+
+#: A directory, with optional ownership and (octal) mode; see
+#: `.files.directory`. Symbolic modes (e.g. ``"u+x"``) can't be compared
+#: with the current state, and so are always applied.
+Directory = namedtuple("Directory", "path user group mode")
+Directory.__new__.__defaults__ = (None, None, None)
+
+#: A line which should be present in a file; see `.files.append`.
+Line = namedtuple("Line", "filename text partial")
+Line.__new__.__defaults__ = (False,)
+
+#: A system package which should be installed; see `.packages.package`.
+Package = namedtuple("Package", "name")
+
+#: A local tree to keep synchronized to the remote end; ``options`` is a
+#: dict of extra keyword arguments for `.transfers.rsync` (e.g. ``exclude``.)
+Tree = namedtuple("Tree", "source target options")
+Tree.__new__.__defaults__ = (None,)
+
+class Action(namedtuple("Action", "resource changes")):
+    """
+    A change required to bring one resource to its desired state.
+
+    ``resource`` is the `Directory`, `Line`, `Package` or `Tree` concerned,
+    and ``changes`` a list describing what's out of date: for directories,
+    some of ``"create"``, ``"owner"`` and ``"mode"``; ``["append"]`` for
+    lines; ``["install"]`` for packages; and for trees, the
+    `.transfers.Change` records reported by ``rsync``.
+    """
+
+    def __str__(self):
+        resource = self.resource
+        kind = type(resource).__name__.lower()
+        if isinstance(resource, Tree):
+            subject = "{} -> {}".format(resource.source, resource.target)
+            detail = "{} changes".format(len(self.changes))
+        elif isinstance(resource, Line):
+            subject = "{}: {}".format(resource.filename, resource.text)
+            detail = "append"
+        else:
+            subject = resource[0]
+            detail = ", ".join(self.changes)
+        return "{} {} ({})".format(kind, subject, detail)
+
+
+def plan(c, resources, sudo=False):
+    """
+    Return the `Action` objects needed to reach the desired ``resources``.
+
+    Nothing is changed on the remote end (or locally.)
+
+    :param c:
+        `~fabric.connection.Connection` to plan for.
+    :param resources:
+        Iterable of `Directory`, `Line`, `Package` and `Tree` objects.
+    :param bool sudo:
+        Whether to inspect remote files via ``sudo``, e.g. because some
+        aren't readable by the connecting user.
+
+    :returns: A `list` of `Action` objects, in the order `apply` uses.
+    """
+    resources = list(resources)
+    for resource in resources:
+        if not isinstance(resource, (Directory, Line, Package, Tree)):
+            raise TypeError("Unknown resource: {!r}".format(resource))
+    packages = [x for x in resources if isinstance(x, Package)]
+    paths = [x for x in resources if isinstance(x, (Directory, Line))]
+    trees = [x for x in resources if isinstance(x, Tree)]
+    actions = []
+    if packages:
+        present = _packages.installed_packages(c, [x.name for x in packages])
+        actions.extend(
+            Action(x, ["install"]) for x in packages if x.name not in present
+        )
+    if paths:
+        runner = c.sudo if sudo else c.run
+        stdout = "".join(
+            runner(x, hide=True).stdout for x in _probe_commands(paths)
+        )
+        actions.extend(_path_actions(paths, stdout))
+    for tree in trees:
+        options = dict(
+            (x, y)
+            for x, y in (tree.options or {}).items()
+            # Only those shaping the command also apply to the dry run
+            if x in _transfers._RSYNC_OPTIONS
+        )
+        options["rsync_opts"] = "{} --dry-run --itemize-changes".format(
+            options.get("rsync_opts", "")
+        )
+        command = _transfers._rsync_command(
+            c, tree.source, tree.target, **options
+        )
+        changes = _transfers.parse_itemized(c.local(command, hide=True).stdout)
+        if changes:
+            actions.append(Action(tree, changes))
+    return actions
+
+
+def apply(c, actions, sudo=False):
+    """
+    Perform the given ``actions`` (as returned by `plan`), in few commands.
+
+    Package installs always use ``sudo``, just like `.packages.package`.
+
+    :param c:
+        `~fabric.connection.Connection` to apply changes to.
+    :param actions:
+        Iterable of `Action` objects.
+    :param bool sudo:
+        Whether to make directory and line changes via ``sudo``.
+    """
+    actions = list(actions)
+    packages = [x.resource.name for x in _of(actions, Package)]
+    if packages:
+        manager = _packages.backend(c)
+        c.sudo(manager.install_command(packages))
+        clear_programs(c)
+    with Pipeline(c, sudo=sudo) as pipe:
+        for action in _of(actions, Directory):
+            path, user, group, mode = action.resource
+            _files.directory(c, path, user, group, mode, runner=pipe)
+        groups, texts = [], {}
+        for action in _of(actions, Line):
+            key = (action.resource.filename, action.resource.partial)
+            if key not in texts:
+                groups.append(key)
+            texts.setdefault(key, []).append(action.resource.text)
+        for filename, partial in groups:
+            _files._invalidate(c, filename)
+            # Lines are re-checked remotely, in case anything changed since
+            # planning.
+            commands = _files._append_batch_commands(
+                filename, texts[filename, partial], partial
+            )
+            for command in commands:
+                pipe(command, hide=True)
+    for action in _of(actions, Tree):
+        tree = action.resource
+        _transfers.rsync(c, tree.source, tree.target, **(tree.options or {}))
+
+
+def converge(c, resources, sudo=False, dry_run=False):
+    """
+    `plan` and then (unless ``dry_run``) `apply`, returning the plan.
+
+    :param c:
+        `~fabric.connection.Connection` to converge.
+    :param resources:
+        Iterable of `Directory`, `Line`, `Package` and `Tree` objects.
+    :param bool sudo:
+        Passed to `plan` and `apply`.
+    :param bool dry_run:
+        Whether to stop after planning.
+
+    :returns:
+        The `list` of `Action` objects which were (or, when ``dry_run``,
+        would have been) applied; empty if the host was already converged.
+    """
+    actions = plan(c, resources, sudo=sudo)
+    if actions and not dry_run:
+        apply(c, actions, sudo=sudo)
+    return actions
+
+
+def _of(actions, kind):
+    return [x for x in actions if isinstance(x.resource, kind)]
+
+
+def _probe_commands(resources):
+    """
+    Scripts reporting on every directory and line: ``<index>\\t<info>``.
+
+    Usually there is just one, unless the probes don't all fit on one command
+    line.
+
+    Directories report ``stat`` output (type, owner, group, octal mode), or
+    nothing if missing; lines report ``1`` if already present.
+    """
+    lines = []
+    for index, resource in enumerate(resources):
+        if isinstance(resource, Directory):
+            probe = (
+                'p="$(echo {})"; printf "{}\\t"; '
+                "stat -L -c '%F\t%U\t%G\t%a' \"$p\" 2>/dev/null || echo"
+            ).format(resource.path, index)
+        else:
+            text = resource.text
+            regex = "^" + _files._escape_for_bre(text)
+            regex += "" if resource.partial else "$"
+            probe = (
+                'printf "{0}\\t"; {{ test -e {1} && grep -q -e {2} {1}; }} '
+                "&& echo 1 || echo 0"
+            ).format(index, resource.filename, six.moves.shlex_quote(regex))
+            # As with append(), empty lines are always appended.
+            if not text:
+                probe = 'printf "{}\\t"; echo 0'.format(index)
+        lines.append(probe)
+    return [x for x, _ in _shell_commands(lines)]
+
+
+def _path_actions(resources, stdout):
+    found = {}
+    for line in stdout.splitlines():
+        fields = line.split("\t")
+        found[int(fields[0])] = fields[1:]
+    actions = []
+    for index, resource in enumerate(resources):
+        fields = found.get(index, [])
+        if isinstance(resource, Line):
+            if fields != ["1"]:
+                actions.append(Action(resource, ["append"]))
+            continue
+        changes = _directory_changes(resource, fields)
+        if changes:
+            actions.append(Action(resource, changes))
+    return actions
+
+
+def _directory_changes(resource, fields):
+    if len(fields) != 4 or fields[0] != "directory":
+        return ["create"]
+    _, user, group, mode = fields
+    changes = []
+    if resource.user is not None:
+        if (user, group) != (resource.user, resource.group or resource.user):
+            changes.append("owner")
+    if resource.mode is not None:
+        try:
+            wanted = int(resource.mode, 8)
+        except ValueError:
+            wanted = None
+        if wanted != int(mode, 8):
+            changes.append("mode")
+    return changes
@@ -2,8 +2,34 @@
 File transfer functionality above and beyond basic ``put``/``get``.
 """
 
+import os
+import re
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from invoke.exceptions import UnexpectedExit
 from invoke.vendor import six
 
+from .files import _invalidate
+from .parallel import WORKERS, fan_out
+from .util import context_state
+
+
+#: Default number of seconds a multiplexed SSH master connection (see
+#: `multiplexed`) lingers once idle, should it outlive its cleanup.
+CONTROL_PERSIST = 60
+
+# rsync() options which shape the rsync command itself (as opposed to e.g.
+# ``multiplex``, which only affects how it runs.)
+_RSYNC_OPTIONS = (
+    "exclude",
+    "delete",
+    "strict_host_keys",
+    "rsync_opts",
+    "ssh_opts",
+)
+
 
 def rsync(
     c,
@@ -14,6 +40,8 @@ def rsync(
     strict_host_keys=True,
     rsync_opts="",
     ssh_opts="",
+    detect_changes=False,
+    multiplex=False,
 ):
     """
     Convenient wrapper around your friendly local ``rsync``.
@@ -77,7 +105,290 @@ def rsync(
     :param str ssh_opts:
         Like ``rsync_opts`` but specifically for the SSH options string
         (rsync's ``--rsh`` flag.)
+    :param bool detect_changes:
+        When True, first perform a quick dry run (``--dry-run
+        --itemize-changes``) to find out what would change. If nothing would,
+        the real transfer is skipped entirely. See below for the effect on
+        the return value. Defaults to False.
+    :param bool multiplex:
+        When True, start sharing one SSH connection between this and all
+        later ``rsync`` calls on ``c`` (as if inside `multiplexed`), so only
+        the first pays for the SSH handshake. The shared connection is shut
+        down by `close_multiplexed`, or when ``c`` itself is closed (e.g. on
+        leaving a ``with Connection(...)`` block.) Defaults to False.
+
+    :returns:
+        The `~invoke.runners.Result` of the ``rsync`` call; or, if
+        ``detect_changes`` was given, a list of `Change` records for
+        everything that was (or would have been) transferred or deleted --
+        which is empty (and thus falsey) when the transfer was skipped.
+    """
+    if multiplex and not _control_path(c):
+        _start_multiplexing(c, CONTROL_PERSIST)
+        _close_with_connection(c)
+    cmd = _rsync_command(
+        c,
+        source,
+        target,
+        exclude=exclude,
+        delete=delete,
+        strict_host_keys=strict_host_keys,
+        rsync_opts=rsync_opts,
+        ssh_opts=ssh_opts,
+    )
+    if not detect_changes:
+        return _transfer(c, cmd, target)
+    dry_run = _rsync_command(
+        c,
+        source,
+        target,
+        exclude=exclude,
+        delete=delete,
+        strict_host_keys=strict_host_keys,
+        rsync_opts="{} --dry-run --itemize-changes".format(rsync_opts),
+        ssh_opts=ssh_opts,
+    )
+    changes = parse_itemized(c.local(dry_run, hide=True).stdout)
+    if changes:
+        _transfer(c, cmd, target)
+    return changes
+
+
+@contextmanager
+def multiplexed(c, persist=CONTROL_PERSIST):
     """
+    Share a single SSH connection between all `rsync` calls on ``c``.
+
+    Normally each ``rsync`` spawns its own ``ssh`` process, which performs a
+    complete TCP/SSH handshake and authentication -- often the bulk of the
+    time taken when transferring small trees. Within this context manager,
+    OpenSSH connection multiplexing (``ControlMaster``/``ControlPath``) is
+    used instead: the first ``rsync`` opens a master connection, and the rest
+    tunnel over it. On exit, the master is shut down (``ssh -O exit``) and
+    its control socket removed::
+
+        with multiplexed(c):
+            for source, target in trees:
+                rsync(c, source, target)
+
+    Nested use (including within ``rsync(..., multiplex=True)``) is fine; the
+    outermost scope owns the connection.
+
+    :param c:
+        `~fabric.connection.Connection` whose rsyncs should be multiplexed.
+    :param int persist:
+        Seconds the master lingers when idle (``ControlPersist``), should
+        cleanup somehow not happen (e.g. the process is killed.)
+
+    :yields: The control socket path.
+    """
+    path = _control_path(c)
+    if path:
+        yield path
+        return
+    path = _start_multiplexing(c, persist)
+    try:
+        yield path
+    finally:
+        close_multiplexed(c)
+
+
+def close_multiplexed(c):
+    """
+    Shut down ``c``'s multiplexed SSH connection, if any; see `multiplexed`.
+
+    :param c: `~fabric.connection.Connection` to stop multiplexing.
+    """
+    state = context_state(c, "transfers")
+    path = state.pop("control_path", None)
+    state.pop("control_persist", None)
+    if not path:
+        return
+    command = "ssh -o ControlPath={} -O exit -p {} {}@{}".format(
+        path, c.port, c.user, c.host
+    )
+    import shutil
+
+    try:
+        c.local(command, hide=True, warn=True)
+    finally:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def rsync_many(
+    connections, source, target, workers=WORKERS, bwlimit=None, **kwargs
+):
+    """
+    Run `rsync` against many connections at once, with bounded concurrency.
+
+    Up to ``workers`` local ``rsync`` processes run at any one time (via
+    `.parallel.fan_out`). If ``bwlimit`` is given, it is treated as the
+    *aggregate* bandwidth budget and divided evenly between the workers, each
+    of which gets its share via ``rsync``'s own ``--bwlimit``.
+
+    Each ``rsync`` is run with ``--stats`` and its output hidden; the parsed
+    statistics are returned alongside the `~invoke.runners.Result` (and thus
+    its exit status) for every host.
+
+    :param connections:
+        Iterable of `~fabric.connection.Connection` objects, e.g. a
+        `~fabric.group.Group`.
+    :param str source: As in `rsync`.
+    :param str target: As in `rsync`.
+    :param int workers:
+        Maximum number of concurrent transfers, or ``None`` for no limit.
+        Defaults to `.parallel.WORKERS`.
+    :param int bwlimit:
+        Total bandwidth, in KiB/s, to be shared by all concurrent transfers.
+        Defaults to ``None`` (unlimited.)
+    :param kwargs:
+        Any of `rsync`'s options shaping the command itself: ``exclude``,
+        ``delete``, ``strict_host_keys``, ``rsync_opts`` and ``ssh_opts``.
+        (``detect_changes`` and ``multiplex`` aren't supported, and raise
+        `TypeError`.)
+
+    :returns:
+        A `~fabric.group.GroupResult` mapping each connection to a
+        `SyncReport`.
+
+    :raises:
+        `~fabric.exceptions.GroupException` if any transfer failed; failed
+        hosts map to the exception -- for ``rsync`` failures, a `SyncError`
+        carrying ``rsync``'s exit status, output and whatever statistics it
+        printed (e.g. for partial transfers.)
+    """
+    unknown = sorted(x for x in kwargs if x not in _RSYNC_OPTIONS)
+    if unknown:
+        err = "rsync_many() got unsupported keyword arguments: {}"
+        raise TypeError(err.format(", ".join(unknown)))
+    connections = list(connections)
+    extra = [kwargs.pop("rsync_opts", ""), "--stats"]
+    if bwlimit:
+        concurrency = min(workers or len(connections), len(connections))
+        share = bwlimit // max(1, concurrency)
+        extra.append("--bwlimit={}".format(max(1, share)))
+    kwargs["rsync_opts"] = " ".join(x for x in extra if x)
+
+    def sync(c):
+        cmd = _rsync_command(c, source, target, **kwargs)
+        try:
+            result = _transfer(c, cmd, target, hide=True)
+        except UnexpectedExit as e:
+            stats = parse_stats(e.result.stdout)
+            raise SyncError(SyncReport(result=e.result, stats=stats))
+        return SyncReport(result=result, stats=parse_stats(result.stdout))
+
+    return fan_out(connections, sync, workers=workers)
+
+
+#: Outcome of a single host's transfer within `rsync_many`: the
+#: `~invoke.runners.Result` of the ``rsync`` process, plus the dict of
+#: statistics parsed from its output by `parse_stats`.
+SyncReport = namedtuple("SyncReport", "result stats")
+
+
+class SyncError(UnexpectedExit):
+    """
+    A failed `rsync_many` transfer, standing in for its `SyncReport`.
+
+    An `~invoke.exceptions.UnexpectedExit` (so ``result`` is the failed
+    ``rsync``'s `~invoke.runners.Result`) which also keeps the ``report``,
+    and thus the statistics parsed from the output, as ``stats``.
+    """
+
+    def __init__(self, report):
+        super(SyncError, self).__init__(report.result)
+        self.report = report
+
+    @property
+    def stats(self):
+        return self.report.stats
+
+
+# rsync --stats labels we care about, mapped to the keys we expose.
+_STATS = {
+    "Number of files": "files",
+    "Number of regular files transferred": "files_transferred",
+    "Number of files transferred": "files_transferred",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+
+
+def parse_stats(output):
+    """
+    Parse the summary printed by ``rsync --stats`` into a dict of integers.
+
+    Keys present (when found in ``output``) are ``files``,
+    ``files_transferred``, ``total_size``, ``transferred_size``,
+    ``bytes_sent`` and ``bytes_received``.
+
+    :param str output: Raw stdout from ``rsync``.
+    :returns: A `dict`.
+    """
+    stats = {}
+    for line in output.splitlines():
+        label, _, value = line.partition(":")
+        key = _STATS.get(label.strip())
+        # Values look like e.g. "1,234 bytes" or "12 (reg: 10, dir: 2)"
+        number = (value.split() or [""])[0].replace(",", "")
+        if key and number.isdigit():
+            stats[key] = int(number)
+    return stats
+
+
+#: One line of ``rsync --itemize-changes`` output. ``path`` is relative to
+#: the transfer root; ``update`` is the update type character (``<`` for sent,
+#: ``c`` for created, ``*`` for messages such as deletions, etc); ``type`` is
+#: the file type character (``f`` for files, ``d`` for directories, ``L`` for
+#: symlinks, etc); and ``attributes`` holds the remaining change flags, or the
+#: message text (e.g. ``"deleting"``) for ``*`` updates.
+Change = namedtuple("Change", "path update type attributes")
+
+_ITEMIZED = re.compile(r"^([<>ch.])([fdLDS])([^ ]{9,10}) (.+)$")
+_MESSAGE = re.compile(r"^\*(\w+) +(.+)$")
+
+
+def parse_itemized(output):
+    """
+    Parse ``rsync --itemize-changes`` ``output`` into a list of `Change`.
+
+    Lines which aren't itemized changes (such as the summary printed in
+    verbose mode) are ignored, as are entries which ``rsync`` itemizes
+    despite nothing changing (all flags ``.``).
+
+    :param str output: Raw stdout from ``rsync``.
+    :returns: A `list` of `Change` objects, in output order.
+    """
+    changes = []
+    for line in output.splitlines():
+        match = _MESSAGE.match(line)
+        if match:
+            message, path = match.groups()
+            changes.append(Change(path, "*", "", message))
+            continue
+        match = _ITEMIZED.match(line)
+        if not match:
+            continue
+        update, type_, attributes, path = match.groups()
+        if update == "." and not attributes.strip("."):
+            continue
+        changes.append(Change(path, update, type_, attributes))
+    return changes
+
+
+def _rsync_command(
+    c,
+    source,
+    target,
+    exclude=(),
+    delete=False,
+    strict_host_keys=True,
+    rsync_opts="",
+    ssh_opts="",
+):
     # Turn single-string exclude into a one-item list for consistency
     if isinstance(exclude, six.string_types):
         exclude = [exclude]
@@ -110,6 +421,14 @@ def rsync(
     disable_keys = "-o StrictHostKeyChecking=no"
     if not strict_host_keys and disable_keys not in ssh_opts:
         ssh_opts += " {}".format(disable_keys)
+    control_path = _control_path(c)
+    if control_path:
+        ssh_opts += (
+            " -o ControlMaster=auto -o ControlPath={}"
+            " -o ControlPersist={}"
+        ).format(
+            control_path, context_state(c, "transfers")["control_persist"]
+        )
     rsh_parts = [key_string, port_string, ssh_opts]
     if any(rsh_parts):
         rsh_string = "--rsh='ssh {}'".format(" ".join(rsh_parts))
@@ -129,5 +448,58 @@ def rsync(
         cmd = "rsync {} {} [{}@{}]:{}"
     else:
         cmd = "rsync {} {} {}@{}:{}"
-    cmd = cmd.format(options, source, user, host, target)
-    return c.local(cmd)
+    return cmd.format(options, source, user, host, target)
+
+
+def _transfer(c, cmd, target, **kwargs):
+    """
+    Run rsync command ``cmd``, then drop cached state of ``target``'s tree.
+
+    (See `.files.enable_cache`.) Failed transfers may have changed things
+    too, so the cache is invalidated regardless.
+    """
+    try:
+        return c.local(cmd, **kwargs)
+    finally:
+        _invalidate(c, target, tree=True)
+
+
+def _control_path(c):
+    return context_state(c, "transfers").get("control_path")
+
+
+def _start_multiplexing(c, persist):
+    # Imported on demand, as tempfile is relatively slow to import.
+    import tempfile
+
+    # Private directory, as anyone able to reach the socket may use the
+    # connection; kept short, as socket paths are limited to ~100 bytes.
+    directory = tempfile.mkdtemp(prefix="patchwork-ssh-")
+    path = os.path.join(directory, "master")
+    state = context_state(c, "transfers")
+    state["control_path"] = path
+    state["control_persist"] = persist
+    return path
+
+
+def _close_with_connection(c):
+    """
+    Make ``c.close()`` also shut down any multiplexed connection it has.
+
+    Wraps ``c``'s bound ``close`` (once per connection object) rather than
+    registering an interpreter exit hook, which would keep every multiplexed
+    connection alive until then.
+    """
+    state = context_state(c, "transfers")
+    if state.get("close_hooked"):
+        return
+    state["close_hooked"] = True
+    close = c.close
+
+    def close_both():
+        try:
+            close_multiplexed(c)
+        finally:
+            close()
+
+    c.close = close_both
@@ -2,10 +2,19 @@
 Helpers and decorators, primarily for internal or advanced use.
 """
 
-import textwrap
+import binascii
+import os
+import re
+import sys
+import threading
+import time
 
+from collections import namedtuple
 from functools import wraps
-from inspect import getargspec, formatargspec
+
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import normalize_hide
+from invoke.vendor import six
 
 
 # TODO: calling all functions as eg directory(c, '/foo/bar/') (with initial c)
@@ -104,41 +113,235 @@ def set_runner(f):
     @wraps(f)
     def inner(*args, **kwargs):
         args = list(args)
-        # Pop all useful kwargs (either to prevent clash with real ones, or to
-        # remove ones not intended for wrapped function)
-        runner = kwargs.pop("runner", None)
-        sudo = kwargs.pop("sudo", False)
-        runner_method = kwargs.pop("runner_method", None)
-        # Figure out what gets applied and potentially overwrite runner
-        if not runner:
-            method = runner_method
-            if not method:
-                method = "sudo" if sudo else "run"
-            runner = getattr(args[0], method)
-        args.insert(1, runner)
-        return f(*args, **kwargs)
+        runner, method = _select_runner(args[0], kwargs)
+        if _call_wrappers:
+            return _wrapped_call(f, args, kwargs, runner, method)
+        return _call(f, args, kwargs, runner, method)
 
     inner.__doc__ = munge_docstring(f, inner)
     return inner
 
 
+def _call(f, args, kwargs, runner, method):
+    # Calls nested inside another, already-observed call (i.e. handed its
+    # recording runner) are accounted for by that outer call.
+    if _call_hooks and not isinstance(runner, _RecordingRunner):
+        return _observed_call(f, args, kwargs, runner, method)
+    args.insert(1, runner)
+    return f(*args, **kwargs)
+
+
+def _select_runner(c, kwargs):
+    """
+    Pop `set_runner`'s kwargs from ``kwargs``; return ``(runner, method)``.
+
+    ``method`` is the name of the context method selected, or ``None`` if a
+    ``runner`` was given explicitly.
+    """
+    # Pop all useful kwargs (either to prevent clash with real ones, or to
+    # remove ones not intended for wrapped function)
+    runner = kwargs.pop("runner", None)
+    sudo = kwargs.pop("sudo", False)
+    runner_method = kwargs.pop("runner_method", None)
+    # Figure out what gets applied and potentially overwrite runner
+    method = None
+    if not runner:
+        method = runner_method
+        if not method:
+            method = "sudo" if sudo else "run"
+        runner = getattr(c, method)
+    return runner, method
+
+
+#: A single command issued by a `set_runner`-decorated function: the command
+#: string, its wall-clock ``duration`` in seconds, and its ``exited`` status
+#: (``None`` if unknown, e.g. when deferred via a `Pipeline`.)
+CommandRecord = namedtuple("CommandRecord", "command duration exited")
+
+
+class CallRecord(object):
+    """
+    Record of one call to a `set_runner`-decorated function.
+
+    Handed to every hook registered via `add_call_hook` once the call
+    completes (successfully or otherwise.)
+
+    Attributes:
+
+    - ``function``: dotted name of the called function, e.g.
+      ``"patchwork.files.directory"``;
+    - ``context``: the context/connection given to the function;
+    - ``host``: that connection's host, or ``"local"`` for plain contexts;
+    - ``sudo``: whether commands were run via ``sudo``;
+    - ``commands``: list of `CommandRecord` objects, in order;
+    - ``duration``: wall-clock seconds for the entire call;
+    - ``error``: the exception raised by the call, if any.
+    """
+
+    def __init__(self, function, context, sudo):
+        self.function = function
+        self.context = context
+        self.host = getattr(context, "host", None) or "local"
+        self.sudo = sudo
+        self.commands = []
+        self.duration = None
+        self.error = None
+
+
+_call_hooks = []
+_call_hooks_lock = threading.Lock()
+
+
+def add_call_hook(hook):
+    """
+    Register ``hook`` to be called with a `CallRecord` after every call.
+
+    Applies to all `set_runner`-decorated functions, in all threads, until
+    removed with `remove_call_hook`. When no hooks are registered (the
+    default), decorated functions run without any recording overhead.
+
+    Hooks should be fast and must be thread-safe (e.g. when operations are
+    run via `.parallel.fan_out`.) Exceptions they raise propagate to the
+    caller of the decorated function.
+
+    :param hook: Callable accepting a single `CallRecord` argument.
+    """
+    with _call_hooks_lock:
+        _call_hooks.append(hook)
+
+
+def remove_call_hook(hook):
+    """
+    Unregister a hook previously given to `add_call_hook`.
+
+    :param hook: The callable to remove.
+    """
+    with _call_hooks_lock:
+        _call_hooks.remove(hook)
+
+
+#: A call to a `set_runner`-decorated function, as handed to call wrappers
+#: (see `add_call_wrapper`): the ``function``'s dotted name, the ``context``
+#: given, the remaining positional ``args`` and the ``kwargs`` (minus
+#: `set_runner`'s own), and the name of the context ``method`` selected to
+#: run commands -- or ``None`` if a ``runner`` was given explicitly, as when
+#: one decorated function calls another, or when using a `Pipeline`.
+Call = namedtuple("Call", "function context args kwargs method")
+
+_call_wrappers = []
+
+
+def add_call_wrapper(wrapper):
+    """
+    Register ``wrapper`` to run around every `set_runner`-decorated call.
+
+    Where call hooks (see `add_call_hook`) merely observe calls, wrappers
+    control them: ``wrapper(call, proceed)`` is given a `Call` and a
+    no-argument ``proceed`` callable which performs it, returning its result
+    (or raising its exception.) Whatever the wrapper returns is returned to
+    the caller, so it may skip the call entirely by not calling ``proceed``,
+    substitute a result, retry, and so on.
+
+    Wrappers apply in all threads until removed with `remove_call_wrapper`.
+    When several are registered, the first one registered is outermost.
+
+    :param wrapper: Callable accepting a `Call` and a ``proceed`` callable.
+    """
+    with _call_hooks_lock:
+        _call_wrappers.append(wrapper)
+
+
+def remove_call_wrapper(wrapper):
+    """
+    Unregister a wrapper previously given to `add_call_wrapper`.
+
+    :param wrapper: The callable to remove.
+    """
+    with _call_hooks_lock:
+        _call_wrappers.remove(wrapper)
+
+
+def _wrapped_call(f, args, kwargs, runner, method):
+    call = Call(
+        function="{}.{}".format(f.__module__, f.__name__),
+        context=args[0],
+        args=tuple(args[1:]),
+        kwargs=dict(kwargs),
+        method=method,
+    )
+
+    def proceed():
+        return _call(f, list(args), dict(kwargs), runner, method)
+
+    for wrapper in reversed(list(_call_wrappers)):
+        proceed = _bind(wrapper, call, proceed)
+    return proceed()
+
+
+def _bind(wrapper, call, proceed):
+    return lambda: wrapper(call, proceed)
+
+
+class _RecordingRunner(object):
+    """
+    Runner wrapper which times each command into a `CallRecord`.
+    """
+
+    def __init__(self, runner, record):
+        self.runner = runner
+        self.record = record
+        # Lets Pipeline-aware code (or nested calls) see what's underneath
+        self.runner_method = getattr(runner, "runner_method", None)
+
+    def __call__(self, command, **kwargs):
+        start = time.time()
+        exited = None
+        try:
+            result = self.runner(command, **kwargs)
+            if not isinstance(result, PendingResult):
+                exited = getattr(result, "exited", None)
+            return result
+        except UnexpectedExit as e:
+            exited = e.result.exited
+            raise
+        finally:
+            self.record.commands.append(
+                CommandRecord(command, time.time() - start, exited)
+            )
+
+
+def _observed_call(f, args, kwargs, runner, method):
+    # Explicitly given runners are either Pipelines or (hopefully) methods.
+    method = (
+        method
+        or getattr(runner, "runner_method", None)
+        or getattr(runner, "__name__", None)
+    )
+    record = CallRecord(
+        function="{}.{}".format(f.__module__, f.__name__),
+        context=args[0],
+        sudo=method == "sudo",
+    )
+    args.insert(1, _RecordingRunner(runner, record))
+    start = time.time()
+    try:
+        return f(*args, **kwargs)
+    except Exception as e:
+        record.error = e
+        raise
+    finally:
+        record.duration = time.time() - start
+        for hook in list(_call_hooks):
+            hook(record)
+
+
 def munge_docstring(f, inner):
     # Terrible, awful hacks to ensure Sphinx autodoc sees the intended
     # (modified) signature; leverages the fact that autodoc_docstring_signature
     # is True by default.
-    args, varargs, keywords, defaults = getargspec(f)
-    # Nix positional version of runner arg, which is always 2nd
-    del args[1]
-    # Add new args to end in desired order
-    args.extend(["sudo", "runner_method", "runner"])
-    # Add default values (remembering that this tuple matches the _end_ of the
-    # signature...)
-    defaults = tuple(list(defaults or []) + [False, "run", None])
     # Get signature first line for Sphinx autodoc_docstring_signature
-    sigtext = "{}{}".format(
-        f.__name__, formatargspec(args, varargs, keywords, defaults)
-    )
-    docstring = textwrap.dedent(inner.__doc__ or "").strip()
+    sigtext = "{}{}".format(f.__name__, _munged_signature(f))
+    docstring = _dedent(inner.__doc__ or "").strip()
     # Construct :param: list
     params = """:param bool sudo:
     Whether to run shell commands via ``sudo``.
@@ -148,3 +351,423 @@ def munge_docstring(f, inner):
     Callable runner function or method. Should ideally be a bound method on the given context object!
 """  # noqa
     return "{}\n{}\n\n{}".format(sigtext, docstring, params)
+
+
+def _dedent(text):
+    """
+    Remove the common leading whitespace of ``text``'s non-blank lines.
+
+    A loop-based stand-in for `textwrap.dedent`, whose regular expressions
+    would make up most of the cost of decorating a function.
+    """
+    lines = text.split("\n")
+    margin = min(
+        [len(x) - len(x.lstrip()) for x in lines if x.strip()] or [0]
+    )
+    return "\n".join(x[margin:] if x.strip() else "" for x in lines)
+
+
+def _munged_signature(f):
+    """
+    Return ``f``'s signature, sans ``runner`` posarg, plus `set_runner` args.
+
+    Built straight from ``f``'s code object, since this happens for every
+    decorated function at import time and `inspect` is comparatively slow.
+    (Annotations and positional-only markers aren't rendered; Patchwork's
+    own functions have neither.)
+    """
+    code = f.__code__
+    count = code.co_argcount
+    kwonly = getattr(code, "co_kwonlyargcount", 0)
+    names = code.co_varnames[: count + kwonly + 2]
+    defaults = f.__defaults__ or ()
+    missing = count - len(defaults)
+    # Defaults match the _end_ of the positional args
+    params = [
+        _param(x, defaults[i - missing] if i >= missing else _NO_DEFAULT)
+        for i, x in enumerate(names[:count])
+    ]
+    # Nix positional version of runner arg, which is always 2nd
+    del params[1]
+    # Add new args after the last positional one, in desired order
+    params.extend(
+        _param(name, default)
+        for name, default in (
+            ("sudo", False),
+            ("runner_method", "run"),
+            ("runner", None),
+        )
+    )
+    rest = list(names[count + kwonly:])
+    if code.co_flags & _CO_VARARGS:
+        params.append("*" + rest.pop(0))
+    elif kwonly:
+        params.append("*")
+    kwdefaults = getattr(f, "__kwdefaults__", None) or {}
+    params.extend(
+        _param(x, kwdefaults.get(x, _NO_DEFAULT))
+        for x in names[count:count + kwonly]
+    )
+    if code.co_flags & _CO_VARKEYWORDS:
+        params.append("**" + rest.pop(0))
+    return "({})".format(", ".join(params))
+
+
+def _param(name, default):
+    if default is _NO_DEFAULT:
+        return name
+    return "{}={!r}".format(name, default)
+
+
+_NO_DEFAULT = object()
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+
+def _memoize(f):
+    """
+    Cache the results of pure, single-argument function ``f``.
+
+    The cache is emptied whenever it reaches ``_MEMOIZE_SIZE`` entries, so
+    it can't grow without bound.
+    """
+    cache = {}
+
+    @wraps(f)
+    def inner(arg):
+        try:
+            return cache[arg]
+        except KeyError:
+            if len(cache) >= _MEMOIZE_SIZE:
+                cache.clear()
+            result = cache[arg] = f(arg)
+            return result
+
+    inner.cache = cache
+    return inner
+
+
+_MEMOIZE_SIZE = 4096
+
+
+def _random_hex():
+    """
+    Return 32 random hex digits, e.g. for unique markers or temp file names.
+    """
+    # Much cheaper to import than uuid.
+    return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+
+# Linux caps any single argument at 128KiB (MAX_ARG_STRLEN), and a command
+# reaches the (local or remote) shell as one argument; generated commands stay
+# below this many bytes, leaving room for e.g. sudo's own wrapping.
+_MAX_COMMAND = 100000
+
+
+def _shell_commands(parts, prefix=None, limit=_MAX_COMMAND):
+    """
+    Join shell script ``parts`` into as few ``sh -c`` commands as will fit.
+
+    Parts are kept in order and never split; each command holds ``prefix``
+    (e.g. ``"set -e"``), if given, followed by as many parts as fit within
+    ``limit`` bytes. A part too large to share a command gets one of its own,
+    oversized or not.
+
+    :returns: A `list` of ``(command, count)`` tuples, ``count`` being the
+        number of ``parts`` within ``command``.
+    """
+    quote = six.moves.shlex_quote
+    # "sh -c ''" plus the prefix (and its newline)
+    overhead = 8 + (_quoted_size(prefix) + 1 if prefix else 0)
+    chunks, chunk, size = [], [], overhead
+    for part in parts:
+        # Each part also costs a separating newline.
+        cost = _quoted_size(part) + 1
+        if chunk and size + cost > limit:
+            chunks.append(chunk)
+            chunk, size = [], overhead
+        chunk.append(part)
+        size += cost
+    if chunk:
+        chunks.append(chunk)
+    head = [prefix] if prefix else []
+    return [
+        ("sh -c {}".format(quote("\n".join(head + x))), len(x))
+        for x in chunks
+    ]
+
+
+def _quoted_size(text):
+    # Length once single-quoted: each ' becomes '"'"'
+    return len(text.encode("utf-8")) + 4 * text.count("'")
+
+
+def context_state(c, namespace):
+    """
+    Return a dict, unique to context ``c``, for caching ``namespace`` data.
+
+    This is how Patchwork remembers facts about a host (or other data which is
+    expensive to obtain remotely) for the lifetime of a given
+    `~invoke.context.Context` or `~fabric.connection.Connection`, without
+    leaking them into the object's configuration.
+
+    :param c:
+        `~invoke.context.Context` to store data on.
+    :param str namespace:
+        Key identifying the caller, typically a module or feature name.
+    :returns: A (possibly empty, but always the same) `dict`.
+    """
+    # NOTE: contexts proxy unknown attribute sets into their config, and are
+    # not hashable, so we hang state directly off the instance dict instead.
+    # dict.setdefault is atomic, so threads sharing a context (e.g. scheduler
+    # tasks, or a prefetch) can't each install -- and lose -- their own.
+    state = c.__dict__.setdefault("_patchwork_state", {})
+    return state.setdefault(namespace, {})
+
+
+def _open(c):
+    """
+    Connect ``c`` now, if it's a `~fabric.connection.Connection` not yet open.
+
+    Connections otherwise open lazily on their first command, but
+    `~fabric.connection.Connection.open` is not thread-safe: threads sharing
+    a connection must have it opened first (or serialize calls to this.)
+    """
+    if not getattr(c, "is_connected", True):
+        c.open()
+
+
+class Pipeline(object):
+    """
+    A deferred command runner, which batches commands into one shell script.
+
+    Instances are callable like any other runner, and so may be handed to
+    `set_runner`-decorated functions via their ``runner`` kwarg. Instead of
+    executing commands immediately, they are queued; the queue is flushed as a
+    single ``sh -c`` invocation (i.e. one remote exec) when:
+
+    - `flush` is called explicitly;
+    - the pipeline is used as a context manager and the block exits cleanly;
+    - any attribute of a queued command's `PendingResult` is accessed (e.g. a
+      function checking ``.ok`` on a result before deciding what to do next.)
+
+    (Queues too long for one command line -- the operating system limits
+    those to 128KiB -- are flushed as several scripts, in order.)
+
+    For example, the following issues one remote command instead of six::
+
+        with Pipeline(c, sudo=True) as pipe:
+            directory(c, "/srv/app", user="deploy", mode="0755", runner=pipe)
+            directory(c, "/srv/logs", user="deploy", mode="0750", runner=pipe)
+
+    Error semantics mirror running the commands one after another: each
+    command runs in its own subshell, and a failing command which was not
+    given ``warn=True`` stops the script, causing `flush` to raise
+    `~invoke.exceptions.UnexpectedExit` for that command. Commands queued
+    after it are never executed, and accessing their results re-raises that
+    same exception.
+
+    Only the ``hide`` and ``warn`` runner kwargs are honored per command;
+    output of non-hidden commands is printed once the flush completes.
+
+    :param c:
+        `~invoke.context.Context` within to execute the flushed script.
+    :param str runner_method:
+        Name of the context method used to run the script. Defaults to
+        ``"run"``, or to ``"sudo"`` if ``sudo=True``.
+    :param bool sudo:
+        Shorthand for ``runner_method="sudo"``.
+    """
+
+    def __init__(self, c, runner_method=None, sudo=False):
+        self.context = c
+        self.runner_method = runner_method or ("sudo" if sudo else "run")
+        #: Queued `PendingResult` objects, in order.
+        self.queue = []
+
+    def __call__(self, command, **kwargs):
+        pending = PendingResult(self, command, kwargs)
+        self.queue.append(pending)
+        return pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def flush(self):
+        """
+        Execute all queued commands in one go, resolving their results.
+
+        Does nothing if the queue is empty.
+        """
+        queue, self.queue = self.queue, []
+        if not queue:
+            return
+        runner = getattr(self.context, self.runner_method)
+        token = "patchwork-{}".format(_random_hex())
+        steps = list(enumerate(queue))
+        scripts = _shell_commands(
+            _pipeline_step(token, index, pending) for index, pending in steps
+        )
+        error = None
+        for script, count in scripts:
+            chunk, steps = steps[:count], steps[count:]
+            if count == 1:
+                # Nothing to gain by wrapping a lone command; run it as-is.
+                error = _pipeline_run(runner, chunk[0][1])
+            else:
+                error = _pipeline_flush(runner, token, script, chunk)
+            if error is not None:
+                break
+        if error is not None:
+            # Commands after the failed one never ran
+            for pending in queue:
+                if pending._result is None and pending._error is None:
+                    pending._error = error
+            raise error
+
+
+class PendingResult(object):
+    """
+    Placeholder for the result of a command queued in a `Pipeline`.
+
+    Behaves like the `~invoke.runners.Result` it stands in for: accessing any
+    attribute (or testing its truthiness) flushes the owning pipeline, if
+    necessary, and proxies to the real result.
+    """
+
+    def __init__(self, pipeline, command, kwargs):
+        self.pipeline = pipeline
+        self.command = command
+        self.kwargs = kwargs
+        self._result = None
+        self._error = None
+
+    def resolve(self):
+        """
+        Return the real `~invoke.runners.Result`, flushing if necessary.
+        """
+        if self._result is None and self._error is None:
+            self.pipeline.flush()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def __getattr__(self, name):
+        # Private names are never proxied (avoids recursion during e.g. copy)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __nonzero__(self):
+        return bool(self.resolve())
+
+    __bool__ = __nonzero__
+
+    def __str__(self):
+        return str(self.resolve())
+
+    def __repr__(self):
+        if self._result is None:
+            return "<PendingResult cmd={!r}>".format(self.command)
+        return repr(self._result)
+
+
+def _pipeline_run(runner, pending):
+    """
+    Run one queued command directly; return its error, if it failed.
+    """
+    try:
+        pending._result = runner(pending.command, **pending.kwargs)
+    except UnexpectedExit as e:
+        pending._error = e
+        return e
+    return None
+
+
+def _pipeline_flush(runner, token, script, steps):
+    """
+    Run ``script``, resolving its ``steps`` (``(index, pending)`` tuples.)
+
+    Returns the error which stopped the script, if any.
+    """
+    outer = runner(script, hide=True, warn=True)
+    outputs = _pipeline_outputs(token, outer)
+    for index, pending in steps:
+        if index not in outputs:
+            # Script died without reporting on this command at all
+            pending._error = UnexpectedExit(outer)
+            return pending._error
+        result = _pipeline_result(pending, outer, outputs[index])
+        hidden = normalize_hide(pending.kwargs.get("hide"))
+        if "stdout" not in hidden:
+            sys.stdout.write(result.stdout)
+        if "stderr" not in hidden:
+            sys.stderr.write(result.stderr)
+        if result.failed and not pending.kwargs.get("warn", False):
+            pending._error = UnexpectedExit(result)
+            return pending._error
+        pending._result = result
+    return None
+
+
+def _pipeline_step(token, index, pending):
+    # Markers bracket each command's output on both streams; the trailing one
+    # is preceded by a newline since output may not end with one.
+    begin = "{} {}".format(token, index)
+    lines = [
+        "printf '%s\\n' '{0}'; printf '%s\\n' '{0}' >&2".format(begin),
+        "(\n{}\n)".format(pending.command),
+        "rc=$?",
+        "printf '\\n%s %s\\n' '{}' $rc".format(begin),
+        "printf '\\n%s\\n' '{}' >&2".format(begin),
+    ]
+    if not pending.kwargs.get("warn", False):
+        lines.append("[ $rc -eq 0 ] || exit $rc")
+    return "\n".join(lines)
+
+
+def _pipeline_outputs(token, outer):
+    """
+    Split a flushed script's output into per-step stdout, stderr & exit code.
+
+    Returns a dict mapping step index to ``(stdout, stderr, exited)``; steps
+    which never completed are absent. Done in one pass per stream, as
+    pipelines may hold many thousands of steps.
+    """
+    stdouts = re.finditer(
+        r"{0} (\d+)\n(.*?)\n{0} \1 (\d+)\n".format(token), outer.stdout, re.S
+    )
+    stderrs = re.finditer(
+        r"{0} (\d+)\n(.*?)\n{0} \1\n".format(token), outer.stderr, re.S
+    )
+    errors = dict((int(x.group(1)), x.group(2)) for x in stderrs)
+    return dict(
+        (
+            int(x.group(1)),
+            (x.group(2), errors.get(int(x.group(1)), ""), int(x.group(3))),
+        )
+        for x in stdouts
+    )
+
+
+def _pipeline_result(pending, outer, output):
+    stdout, stderr, exited = output
+    kwargs = dict(
+        stdout=stdout,
+        stderr=stderr,
+        encoding=outer.encoding,
+        command=pending.command,
+        shell=outer.shell,
+        env=outer.env,
+        exited=exited,
+        pty=outer.pty,
+        hide=tuple(normalize_hide(pending.kwargs.get("hide"))),
+    )
+    connection = getattr(outer, "connection", None)
+    if connection is not None:
+        kwargs["connection"] = connection
+    return type(outer)(**kwargs)
@@ -20,7 +20,33 @@ def sanity(c):
         print("Imported {} successfully".format(mod))
 
 
-ns = Collection(docs, release, travis, test, coverage, sanity, blacken)
+@task(
+    help={
+        "check": "Exit nonzero if round trips regress vs. the baseline.",
+        "write-baseline": "Record the current numbers as the new baseline.",
+        "latency": "Simulated per-round-trip latency, in seconds.",
+        "imports": "Also report per-module import times.",
+    }
+)
+def benchmark(
+    c, check=False, write_baseline=False, latency=0.05, imports=False
+):
+    """
+    Run the simulated-transport round-trip benchmarks in benchmarks/.
+    """
+    cmd = "python benchmarks/roundtrips.py --latency {}".format(latency)
+    if check:
+        cmd += " --check"
+    if write_baseline:
+        cmd += " --write-baseline"
+    c.run(cmd, pty=True)
+    if imports:
+        c.run("python benchmarks/imports.py", pty=True)
+
+
+ns = Collection(
+    docs, release, travis, test, coverage, sanity, blacken, benchmark
+)
 ns.configure(
     {
         "packaging": {
@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import json
+import zlib
+
+from fabric import Result
+from invoke import Context
+from mock import Mock
+from pytest import raises
+
+from patchwork.agent import Batch, BatchError, OperationError, execute
+from patchwork.files import Stat, enable_cache, exists
+
+
+def _local():
+    c = Context()
+    c.config.run.in_stream = False
+    return c
+
+
+def _reply(cxn, outcomes):
+    stdout = "noise\nPATCHWORK-AGENT {}\n".format(json.dumps(outcomes))
+    return Result(connection=cxn, stdout=stdout)
+
+
+class agent:
+
+    class execute_:
+
+        def runs_all_operations_in_one_command(self, cxn):
+            cxn.run.return_value = _reply(
+                cxn, [{"value": True}, {"value": ["x"]}]
+            )
+            batch = Batch()
+            batch.exists("/etc/hosts")
+            batch.append("/etc/hosts", "x")
+            assert batch.run(cxn) == [True, ["x"]]
+            assert cxn.run.call_count == 1
+            command = cxn.run.call_args[0][0]
+            assert command.startswith("python3 -c ")
+            payload = command.split()[-1]
+            sent = json.loads(zlib.decompress(base64.b64decode(payload)))
+            assert sent == batch.operations
+            assert sent[1] == {
+                "op": "append",
+                "path": "/etc/hosts",
+                "lines": ["x"],
+                "partial": False,
+            }
+
+        def nothing_to_do_runs_nothing(self, cxn):
+            assert execute(cxn, []) == []
+            assert not cxn.run.called
+
+        def failures_raise_unless_warn(self, cxn):
+            cxn.run.return_value = _reply(
+                cxn, [{"error": "OSError: nope"}, {"value": None}]
+            )
+            batch = Batch()
+            batch.chmod("/nope", "0644")
+            batch.checksum("/nope")
+            with raises(BatchError) as info:
+                batch.run(cxn)
+            error = info.value.results[0]
+            assert isinstance(error, OperationError)
+            assert error.message == "OSError: nope"
+            assert error.operation["path"] == "/nope"
+            results = batch.run(cxn, warn=True)
+            assert results[1] is None
+
+        def mutations_invalidate_file_cache(self, cxn):
+            enable_cache(cxn)
+            cxn.run.return_value = Result(connection=cxn)
+            exists(cxn, "/srv/app")
+            cxn.run.return_value = _reply(cxn, [{"value": None}])
+            batch = Batch()
+            batch.mkdir("/srv/app/logs")
+            batch.run(cxn)
+            cxn.run.return_value = Result(connection=cxn)
+            exists(cxn, "/srv/app")
+            assert cxn.run.call_count == 3
+
+        def splits_batches_too_large_for_one_command(self, tmp_path):
+            path = tmp_path / "big.conf"
+            # Hex digests barely compress, so this won't fit in one command.
+            lines = [
+                hashlib.sha256(str(x).encode("ascii")).hexdigest()
+                for x in range(6000)
+            ]
+            batch = Batch()
+            for x in range(0, len(lines), 100):
+                batch.append(str(path), lines[x:x + 100])
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            results = batch.run(c)
+            assert c.run.call_count > 1
+            for args, _ in c.run.call_args_list:
+                assert len(args[0]) < 131072
+            assert sum(results, []) == lines
+            assert path.read_text() == u"\n".join(lines) + u"\n"
+
+        def rejects_single_operations_too_large_for_a_command(self, cxn):
+            lines = [
+                hashlib.sha256(str(x).encode("ascii")).hexdigest()
+                for x in range(6000)
+            ]
+            batch = Batch()
+            batch.append("/etc/big.conf", lines)
+            with raises(ValueError):
+                batch.run(cxn)
+            assert not cxn.run.called
+
+        def performs_operations_for_real(self, tmp_path):
+            base = tmp_path / "app"
+            conf = base / "app.conf"
+            batch = Batch()
+            batch.mkdir(str(base), mode="0700")
+            batch.append(str(conf), ["a", "b $HOME 'q\" \\x", "a", ""])
+            batch.append(str(conf), ["a", "b"], partial=True)
+            batch.contains(str(conf), "$HOME")
+            batch.contains(str(conf), "a", exact=True)
+            batch.contains(str(conf), r"^b \$", regex=True)
+            batch.stat(str(base))
+            batch.stat(str(tmp_path / "nope"))
+            batch.exists(str(conf))
+            index = batch.checksum(str(conf))
+            results = batch.run(_local())
+            text = u"a\nb $HOME 'q\" \\x\n\n"
+            assert conf.read_text() == text
+            assert results[:index] == [
+                None,
+                ["a", "b $HOME 'q\" \\x", ""],
+                [],
+                True,
+                True,
+                True,
+                Stat("directory", results[6].size, results[6].mtime, 0o700),
+                None,
+                True,
+            ]
+            expected = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            assert results[index] == expected
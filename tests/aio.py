@@ -0,0 +1,169 @@
+import asyncio
+
+from fabric.exceptions import GroupException
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+from pytest import raises
+
+from patchwork import aio
+from patchwork.files import enable_cache
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class _Context(object):
+    """
+    Async context answering commands via ``respond(command) -> stdout``.
+    """
+
+    def __init__(self, respond=lambda command: "", failing=()):
+        self.respond = respond
+        self.failing = failing
+        self.commands = []
+        self.sudo_commands = []
+
+    async def run(self, command, **kwargs):
+        self.commands.append(command)
+        return Result(command=command, stdout=self.respond(command))
+
+    async def sudo(self, command, **kwargs):
+        self.sudo_commands.append(command)
+        failed = any(command.endswith(" " + x) for x in self.failing)
+        return Result(command=command, exited=int(failed))
+
+
+class aio_:
+
+    class LocalContext_:
+
+        def returns_results(self):
+            result = _run(aio.LocalContext().run("echo hi", hide=True))
+            assert result.stdout == "hi\n"
+            assert result.ok
+
+        def raises_on_failure_unless_warn(self):
+            c = aio.LocalContext()
+            with raises(UnexpectedExit):
+                _run(c.run("exit 3", hide=True))
+            assert _run(c.run("exit 3", hide=True, warn=True)).exited == 3
+
+    class files:
+
+        def directory_and_exists(self, tmp_path):
+            c = aio.LocalContext()
+            path = str(tmp_path / "a" / "b")
+            assert not _run(aio.exists(c, path))
+            _run(aio.directory(c, path, mode="0700"))
+            assert _run(aio.exists(c, path))
+            found = _run(aio.exists_many(c, [path, path + "/nope"]))
+            assert found == {path: True, path + "/nope": False}
+
+        def append_and_contains(self, tmp_path):
+            c = aio.LocalContext()
+            path = str(tmp_path / "conf")
+            _run(aio.append(c, path, ["a=1", "b=$2"]))
+            _run(aio.append(c, path, "a=1"))
+            added = _run(aio.append(c, path, ["b=$2", "c"], batch=True))
+            assert added == ["c"]
+            assert _run(aio.contains(c, path, "b=$2", exact=True))
+            assert (tmp_path / "conf").read_text() == "a=1\nb=$2\nc\n"
+
+        def search(self, tmp_path):
+            log = tmp_path / "log"
+            log.write_text(u"ok\nERROR\n")
+            c = aio.LocalContext()
+            found = _run(aio.search(c, str(log), ["ERR", "x"]))
+            assert found == {"ERR": True, "x": False}
+
+        def shares_the_file_cache(self):
+            c = _Context()
+            enable_cache(c)
+            _run(aio.exists(c, "/foo"))
+            _run(aio.exists(c, "/foo"))
+            assert c.commands == ['test -e "$(echo /foo)"']
+
+    class info:
+
+        def detects_distro_family_with_one_command(self):
+            c = _Context(lambda _: "ID=ubuntu\n--patchwork-facts--\n")
+            assert _run(aio.distro_family(c)) == "debian"
+            assert _run(aio.distro_name(c)) == "ubuntu"
+            assert len(c.commands) == 1
+
+    class packages:
+
+        def installs_missing_packages_in_one_transaction(self):
+            def respond(command):
+                if command.startswith("cat /etc/os-release"):
+                    return "ID=debian\n--patchwork-facts--\n"
+                return "git installed\n"
+
+            c = _Context(respond)
+            report = _run(aio.package(c, "git", "vim", "tmux"))
+            assert c.sudo_commands == [
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y vim tmux"
+            ]
+            assert report.installed == ["vim", "tmux"]
+            assert report.present == ["git"]
+
+        def uses_the_packages_backends_and_their_options(self):
+            c = _Context(lambda _: "git\n")
+            report = _run(
+                aio.package(
+                    c,
+                    "git",
+                    "vim",
+                    manager="apk",
+                    proxy="http://mirror:3142",
+                    refresh=True,
+                )
+            )
+            # No distro detection, since the manager was given
+            assert c.commands == ["apk info -e git vim"]
+            proxy = "http://mirror:3142"
+            env = "http_proxy={0} https_proxy={0} ".format(proxy)
+            assert c.sudo_commands[0].startswith("sh -c ")
+            assert "apk update" in c.sudo_commands[0]
+            assert c.sudo_commands[1:] == [env + "apk add vim"]
+            assert report.installed == ["vim"]
+
+        def raises_the_first_failure_unless_warn(self):
+            c = _Context(failing=("aaa", "bbb"))
+            with raises(UnexpectedExit) as info:
+                _run(aio.package(c, "aaa", "bbb", manager="apk"))
+            assert info.value.result.command == "apk add aaa"
+            report = _run(
+                aio.package(c, "aaa", "bbb", manager="apk", warn=True)
+            )
+            assert report.failed == ["aaa", "bbb"]
+
+        def rejects_unknown_kwargs(self):
+            with raises(TypeError):
+                _run(aio.package(_Context(), "git", nope=True))
+
+    class fan_out_:
+
+        def gathers_results_per_context(self):
+            contexts = [aio.LocalContext() for _ in range(3)]
+
+            async def whoami(c, text):
+                return (await c.run("echo " + text, hide=True)).stdout
+
+            results = _run(aio.fan_out(contexts, whoami, "hi", workers=2))
+            assert list(results.values()) == ["hi\n"] * 3
+
+        def raises_GroupException_on_any_failure(self):
+            contexts = [aio.LocalContext() for _ in range(2)]
+
+            async def fail(c):
+                await c.run("false", hide=True)
+
+            with raises(GroupException) as info:
+                _run(aio.fan_out(contexts, fail))
+            assert len(info.value.result.failed) == 2
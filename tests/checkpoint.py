@@ -0,0 +1,174 @@
+import json
+from io import BytesIO
+
+from fabric import Connection, Result
+from mock import Mock
+
+from patchwork.checkpoint import Journal
+from patchwork.files import Stat, append, directory, exists, exists_many
+
+
+def _connection(host):
+    c = Connection(host)
+    c.run = Mock(return_value=Result(connection=c, stdout=""))
+    return c
+
+
+class checkpoint:
+
+    class Journal_:
+
+        def records_completed_calls_as_json_lines(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            with Journal(path):
+                directory(c, "/srv")
+                assert exists(c, "/srv") is True
+            entries = [json.loads(x) for x in open(path)]
+            assert [x["function"] for x in entries] == [
+                "patchwork.files.directory",
+                "patchwork.files.exists",
+            ]
+            assert all(x["host"] == "web1" for x in entries)
+            assert entries[1]["result"] is True
+
+        def reruns_skip_completed_calls(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            with Journal(path):
+                directory(c, "/srv")
+                exists(c, "/srv")
+            c = _connection("web1")
+            with Journal(path) as journal:
+                directory(c, "/srv")
+                assert exists(c, "/srv") is True
+                directory(c, "/opt")
+            assert journal.replayed == 2
+            c.run.assert_called_once_with("mkdir -p /opt")
+
+        def keys_on_host_and_arguments(self, tmp_path):
+            path = str(tmp_path / "journal")
+            with Journal(path):
+                directory(_connection("web1"), "/srv")
+            web1, web2 = _connection("web1"), _connection("web2")
+            with Journal(path) as journal:
+                directory(web1, "/srv", mode="0755")
+                directory(web2, "/srv")
+            assert journal.replayed == 0
+            assert web1.run.called and web2.run.called
+
+        def repeated_identical_calls_are_distinct_steps(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            with Journal(path):
+                exists(c, "/srv")
+            c = _connection("web1")
+            with Journal(path) as journal:
+                exists(c, "/srv")
+                exists(c, "/srv")
+            assert journal.replayed == 1
+            assert c.run.call_count == 1
+
+        def failed_calls_are_retried(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            c.run.side_effect = Exception("boom")
+            with Journal(path):
+                try:
+                    directory(c, "/srv")
+                except Exception:
+                    pass
+            c = _connection("web1")
+            with Journal(path) as journal:
+                directory(c, "/srv")
+            assert journal.replayed == 0
+            assert c.run.called
+
+        def nested_calls_are_part_of_their_callers_step(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            with Journal(path):
+                append(c, "/etc/hosts", "x")
+            functions = [json.loads(x)["function"] for x in open(path)]
+            assert functions == ["patchwork.files.append"]
+
+        def force_runs_everything(self, tmp_path):
+            path = str(tmp_path / "journal")
+            with Journal(path):
+                directory(_connection("web1"), "/srv")
+            c = _connection("web1")
+            with Journal(path, force=True) as journal:
+                directory(c, "/srv")
+            assert journal.replayed == 0
+            assert c.run.called
+
+        def replays_results_as_json(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            c.run.return_value = Result(connection=c, stdout="0\t1\n")
+            with Journal(path):
+                first = exists_many(c, ["/srv"])
+            c = _connection("web1")
+            with Journal(path):
+                assert exists_many(c, ["/srv"]) == first == {"/srv": True}
+            assert not c.run.called
+
+        def replays_results_as_the_original_types(self, tmp_path):
+            path = str(tmp_path / "journal")
+            c = _connection("web1")
+            c.run.return_value = Result(
+                connection=c, stdout="0\tregular file\t5\t100\t644\n"
+            )
+            with Journal(path):
+                first = exists_many(c, ["/srv"], stat=True)
+            result = {(1, 2): {"a", "b"}, "list": [1, (2, 3)]}
+            task = Mock(return_value=result, __name__="task")
+            with Journal(path) as journal:
+                journal.call(c, task)
+            c = _connection("web1")
+            with Journal(path) as journal:
+                replayed = exists_many(c, ["/srv"], stat=True)
+                assert replayed == first
+                assert isinstance(replayed["/srv"], Stat)
+                assert journal.call(c, task) == result
+            assert not c.run.called
+            task.assert_called_once_with(c)
+
+        def calls_with_unstable_arguments_always_run(self, tmp_path):
+            path = str(tmp_path / "journal")
+            task = Mock(return_value=1, __name__="task")
+            c = _connection("web1")
+            for _ in range(2):
+                with Journal(path) as journal:
+                    journal.call(c, task, BytesIO(b"data"))
+                    journal.call(c, task, object())
+                    # Functions are identified by name instead
+                    journal.call(c, task, exists)
+                    journal.call(c, task, lambda: 1)
+            assert task.call_count == 7
+            assert len(open(path).readlines()) == 1
+
+        def tolerates_truncated_journals(self, tmp_path):
+            path = tmp_path / "journal"
+            with Journal(str(path)):
+                directory(_connection("web1"), "/srv")
+            with open(str(path), "a") as fd:
+                fd.write('{"host": "web1", "func')
+            c = _connection("web1")
+            with Journal(str(path)) as journal:
+                directory(c, "/srv")
+                directory(c, "/opt")
+            assert journal.replayed == 1
+            with Journal(str(path)) as journal:
+                directory(c, "/opt")
+            assert journal.replayed == 1
+
+        def journals_other_operations_explicitly(self, tmp_path):
+            path = str(tmp_path / "journal")
+            deploy = Mock(return_value={"files": 3}, __name__="deploy")
+            c = _connection("web1")
+            with Journal(path) as journal:
+                assert journal.call(c, deploy, "build/") == {"files": 3}
+            with Journal(path) as journal:
+                assert journal.call(c, deploy, "build/") == {"files": 3}
+            deploy.assert_called_once_with(c, "build/")
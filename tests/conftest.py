@@ -1,2 +1,7 @@
 # flake8: noqa
+import sys
+
 from fabric.testing.fixtures import cxn
+
+# The asyncio API relies on async/await syntax.
+collect_ignore = ["aio.py"] if sys.version_info < (3, 5) else []
@@ -0,0 +1,49 @@
+from fabric import Result
+from mock import Mock, patch
+
+from patchwork.environment import clear_programs, have_programs
+from patchwork.packages import package
+
+
+class environment:
+
+    class have_programs_:
+
+        def resolves_all_names_in_one_command(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\t/usr/bin/git\n1\t\n"
+            )
+            found = have_programs(cxn, ["git", "hg"])
+            assert found == {"git": "/usr/bin/git", "hg": None}
+            assert cxn.run.call_count == 1
+            assert "command -v git" in cxn.run.call_args[0][0]
+
+        def caches_per_connection(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\t/usr/bin/git\n"
+            )
+            have_programs(cxn, ["git"])
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t\n")
+            found = have_programs(cxn, ["git", "hg"])
+            assert found == {"git": "/usr/bin/git", "hg": None}
+            # Second call only asked about the new name
+            assert "git" not in cxn.run.call_args[0][0]
+
+        def refresh_and_clear_programs_reprobe(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t\n")
+            have_programs(cxn, ["git"])
+            have_programs(cxn, ["git"], refresh=True)
+            clear_programs(cxn)
+            have_programs(cxn, ["git"])
+            assert cxn.run.call_count == 3
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def installing_packages_clears_cache(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t\n")
+            have_programs(cxn, ["git"])
+            cxn.sudo = Mock(return_value=Result(connection=cxn))
+            package(cxn, "git")
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\t/usr/bin/git\n"
+            )
+            assert have_programs(cxn, ["git"]) == {"git": "/usr/bin/git"}
@@ -1,6 +1,36 @@
-from mock import call
+import hashlib
+import threading
+from io import BytesIO
 
-from patchwork.files import directory
+from fabric import Result
+from invoke import Context
+from invoke.exceptions import UnexpectedExit
+from mock import Mock, call, patch
+from pytest import raises
+
+from patchwork.files import (
+    _PLANS,
+    _append_batch_commands,
+    _ensure_block_command,
+    _escape_for_regex,
+    _forget_plans,
+    _install_command,
+    _plan,
+    Prepared,
+    Stat,
+    append,
+    clear_cache,
+    contains,
+    directory,
+    disable_cache,
+    enable_cache,
+    ensure_block,
+    exists,
+    exists_many,
+    prepare,
+    search,
+    upload_if_changed,
+)
 
 
 class files:
@@ -32,3 +62,498 @@ class files:
                 call("chown user:admins /some/dir"),
                 call("chmod 0700 /some/dir"),
             ]
+
+    class append_:
+
+        class batch:
+
+            def issues_single_command(self, cxn):
+                cxn.run.return_value = Result(connection=cxn, stdout="")
+                append(cxn, "/etc/hosts", ["a", "b", "c"], batch=True)
+                assert cxn.run.call_count == 1
+                command = cxn.run.call_args[0][0]
+                assert command.startswith("sh -c ")
+                assert cxn.run.call_args[1]["hide"] is True
+
+            def returns_lines_actually_appended(self, cxn):
+                cxn.run.return_value = Result(connection=cxn, stdout="0\n2\n")
+                added = append(cxn, "/etc/hosts", ["a", "b", "c"], batch=True)
+                assert added == ["a", "c"]
+
+            def single_string_normalized_to_list(self, cxn):
+                cxn.run.return_value = Result(connection=cxn, stdout="0\n")
+                assert append(cxn, "/etc/hosts", "a", batch=True) == ["a"]
+
+            def full_line_match_by_default(self, cxn):
+                cxn.run.return_value = Result(connection=cxn, stdout="")
+                append(cxn, "/etc/hosts", ["a.b"], batch=True)
+                assert r"^a\.b$" in cxn.run.call_args[0][0]
+
+            def partial_match_omits_trailing_anchor(self, cxn):
+                cxn.run.return_value = Result(connection=cxn, stdout="")
+                append(cxn, "/etc/hosts", ["a.b"], partial=True, batch=True)
+                command = cxn.run.call_args[0][0]
+                assert r"^a\.b" in command
+                assert r"^a\.b$" not in command
+
+            def honors_sudo(self, cxn):
+                cxn.sudo = Mock(return_value=Result(connection=cxn))
+                append(cxn, "/etc/hosts", ["a"], batch=True, sudo=True)
+                assert cxn.sudo.call_count == 1
+                assert not cxn.run.called
+
+            def splits_huge_inputs_over_several_commands(self, tmp_path):
+                # Well over the kernel's 128KiB single-argument limit
+                path = tmp_path / "big.conf"
+                path.write_text(u"line 0000 'quoted'\n")
+                lines = ["line {:04} 'quoted'".format(x) for x in range(1000)]
+                c = Context()
+                c.config.run.in_stream = False
+                added = append(c, str(path), lines, batch=True)
+                assert added == lines[1:]
+                assert path.read_text() == u"\n".join(lines) + u"\n"
+                commands = prepare(append, str(path), lines, batch=True)
+                assert len(commands.commands) > 1
+                assert all(len(x) < 131072 for x in commands.commands)
+
+    class upload_if_changed_:
+
+        def _remote_sum(self, cxn, digest, exited=0):
+            stdout = "{}  /etc/app.conf\n".format(digest) if digest else ""
+            cxn.run.return_value = Result(
+                connection=cxn, stdout=stdout, exited=exited
+            )
+            cxn.put = Mock()
+
+        def skips_upload_when_checksums_match(self, cxn):
+            self._remote_sum(cxn, hashlib.sha256(b"data").hexdigest())
+            local = BytesIO(b"data")
+            assert upload_if_changed(cxn, local, "/etc/app.conf") is False
+            cxn.run.assert_called_once_with(
+                'sha256sum "/etc/app.conf"', hide=True, warn=True
+            )
+            assert not cxn.put.called
+
+        def uploads_and_renames_into_place_on_mismatch(self, cxn):
+            self._remote_sum(cxn, "0" * 64)
+            local = BytesIO(b"data")
+            assert upload_if_changed(cxn, local, "/etc/app.conf") is True
+            staging = cxn.put.call_args[0][1]
+            assert cxn.put.call_args[0][0] is local
+            assert staging.startswith("/tmp/patchwork-")
+            install = cxn.run.call_args[0][0]
+            assert 'cp "{}" "/etc/app.conf.patchwork-tmp"'.format(
+                staging
+            ) in install
+            assert install.index("fi && ") < install.index(
+                'mv -f "/etc/app.conf.patchwork-tmp" "/etc/app.conf"'
+            )
+            assert 'rm -f "{}"'.format(staging) in install
+
+        def uploads_when_remote_file_is_missing(self, cxn):
+            self._remote_sum(cxn, None, exited=1)
+            assert upload_if_changed(cxn, BytesIO(b"x"), "/etc/app.conf")
+            assert cxn.put.called
+
+        def applies_owner_and_mode_before_rename(self, cxn):
+            self._remote_sum(cxn, None, exited=1)
+            upload_if_changed(
+                cxn,
+                BytesIO(b"x"),
+                "/etc/app.conf",
+                user="app",
+                group="admins",
+                mode="0640",
+            )
+            install = cxn.run.call_args[0][0]
+            chown = install.index(
+                'chown app:admins "/etc/app.conf.patchwork-tmp"'
+            )
+            chmod = install.index('chmod 0640 "/etc/app.conf.patchwork-tmp"')
+            assert chown < chmod < install.index("mv -f")
+
+        def keeps_existing_mode_unless_given(self, tmp_path):
+            # Runs the install step through a real local shell
+            staging, target = tmp_path / "staging", tmp_path / "secret"
+            target.write_text(u"old")
+            target.chmod(0o600)
+            c = Context()
+            c.config.run.in_stream = False
+            for mode, expected in ((None, 0o600), ("0640", 0o640)):
+                staging.write_text(u"new")
+                staging.chmod(0o644)
+                c.run(
+                    _install_command(str(staging), str(target), mode=mode),
+                    hide=True,
+                )
+                assert target.read_text() == u"new"
+                assert target.stat().st_mode & 0o777 == expected
+            assert sorted(x.name for x in tmp_path.iterdir()) == ["secret"]
+
+        def hashes_local_paths(self, cxn, tmpdir):
+            path = tmpdir.join("app.conf")
+            path.write(b"data", mode="wb")
+            self._remote_sum(cxn, hashlib.sha256(b"data").hexdigest())
+            assert not upload_if_changed(cxn, str(path), "/etc/app.conf")
+
+        def rewinds_file_objects_after_hashing(self, cxn):
+            self._remote_sum(cxn, "0" * 64)
+            local = BytesIO(b"data")
+            upload_if_changed(cxn, local, "/etc/app.conf")
+            assert local.tell() == 0
+
+    class exists_many_:
+
+        def checks_all_paths_in_one_command(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\t1\n1\t0\n2\t1\n"
+            )
+            found = exists_many(cxn, ["/a", "/b", "/c"])
+            assert found == {"/a": True, "/b": False, "/c": True}
+            assert cxn.run.call_count == 1
+            assert cxn.run.call_args[0][0].startswith("sh -c ")
+
+        def preserves_exists_shell_expansion(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t1\n")
+            exists_many(cxn, ["~/.ssh/*.pub"])
+            assert 'p="$(echo ~/.ssh/*.pub)"' in cxn.run.call_args[0][0]
+
+        def splits_huge_inputs_over_several_commands(self, tmp_path):
+            (tmp_path / "present").write_text(u"")
+            paths = [str(tmp_path / "gone{}".format(x)) for x in range(3000)]
+            paths.append(str(tmp_path / "present"))
+            c = Context()
+            c.config.run.in_stream = False
+            c.run = Mock(wraps=c.run)
+            found = exists_many(c, paths)
+            assert c.run.call_count > 1
+            assert all(len(x[0][0]) < 131072 for x in c.run.call_args_list)
+            assert found == dict((x, x == paths[-1]) for x in paths)
+
+        def may_return_stat_records(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn,
+                stdout=(
+                    "0\tregular file\t12\t1500000000\t644\n"
+                    "1\n"
+                    "2\tdirectory\t4096\t1500000001\t755\n"
+                ),
+            )
+            found = exists_many(cxn, ["/a", "/b", "/c"], stat=True)
+            assert found == {
+                "/a": Stat("file", 12, 1500000000, 0o644),
+                "/b": None,
+                "/c": Stat("directory", 4096, 1500000001, 0o755),
+            }
+
+        def empty_input_runs_nothing(self, cxn):
+            assert exists_many(cxn, []) == {}
+            assert not cxn.run.called
+
+    class search_:
+
+        def checks_all_patterns_in_one_command(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0 3\n2 9\n")
+            found = search(cxn, "/var/log/app.log", ["OOM", "panic", "ERR"])
+            assert found == {"OOM": True, "panic": False, "ERR": True}
+            assert cxn.run.call_count == 1
+            command = cxn.run.call_args[0][0]
+            assert command.startswith("awk -v limit=1 ")
+            assert command.endswith(' OOM panic ERR "/var/log/app.log"')
+
+        def may_return_line_numbers(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0 3\n0 5\n1 4\n"
+            )
+            found = search(cxn, "/log", ["a", "b"], line_numbers=True)
+            assert found == {"a": [3, 5], "b": [4]}
+
+        def empty_input_runs_nothing(self, cxn):
+            assert search(cxn, "/log", []) == {}
+            assert not cxn.run.called
+
+        def matches_real_files(self, tmp_path):
+            # Exercises the awk program itself, via a real local shell
+            log = tmp_path / "app.log"
+            log.write_text(u"boot\nERROR: disk\n1+1\nERROR: net\nOOM\n")
+            c = Context()
+            c.config.run.in_stream = False
+            patterns = ["ERROR", "^OOM$", "1+1", "missing"]
+            assert search(c, str(log), patterns) == {
+                "ERROR": True,
+                "^OOM$": True,
+                "1+1": False,
+                "missing": False,
+            }
+            found = search(
+                c,
+                str(log),
+                ["ERROR", "1+1"],
+                fixed=True,
+                line_numbers=True,
+                limit=None,
+            )
+            assert found == {"ERROR": [2, 4], "1+1": [3]}
+            assert search(c, str(tmp_path / "nope"), ["x"]) == {"x": False}
+
+    class ensure_block_:
+
+        def runs_one_command_and_reports_changes(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="changed\n")
+            assert ensure_block(cxn, "/etc/sysctl.conf", ["a = 1"]) is True
+            assert cxn.run.call_count == 1
+            command = cxn.run.call_args[0][0]
+            assert command.startswith("sh -c ")
+            assert "# BEGIN patchwork" in command
+
+        def reports_unchanged_files(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            assert ensure_block(cxn, "/etc/sysctl.conf", "a = 1") is False
+
+        def invalidates_cache_on_change(self, cxn):
+            enable_cache(cxn)
+            cxn.run.return_value = Result(connection=cxn, stdout="changed\n")
+            contains(cxn, "/etc/motd", "hi")
+            ensure_block(cxn, "/etc/motd", ["hi"])
+            contains(cxn, "/etc/motd", "hi")
+            assert cxn.run.call_count == 3
+
+        def edits_real_files(self, tmp_path):
+            # Exercises the checksum gate & awk rewrite via a real local shell
+            path = tmp_path / "app.conf"
+            path.write_text(u"head\n# BEGIN x\nold\n# END x\ntail\n")
+            path.chmod(0o600)
+            c = Context()
+            c.config.run.in_stream = False
+            lines = ["new", r"with \backslash $and 'quotes'"]
+            assert ensure_block(c, str(path), lines, marker="x")
+            expected = u"head\n# BEGIN x\n{}\n{}\n# END x\ntail\n"
+            assert path.read_text() == expected.format(*lines)
+            assert path.stat().st_mode & 0o777 == 0o600
+            assert not ensure_block(c, str(path), lines, marker="x")
+            assert ensure_block(c, str(path), [], marker="x", present=False)
+            assert path.read_text() == u"head\ntail\n"
+            assert sorted(x.name for x in tmp_path.iterdir()) == ["app.conf"]
+
+        def refuses_unterminated_blocks(self, tmp_path):
+            path = tmp_path / "app.conf"
+            original = u"head\n# BEGIN x\nold\ntail\n"
+            path.write_text(original)
+            c = Context()
+            c.config.run.in_stream = False
+            for present in (True, False):
+                with raises(UnexpectedExit) as info:
+                    ensure_block(
+                        c, str(path), ["new"], marker="x", present=present
+                    )
+                stderr = info.value.result.stderr
+                assert "unterminated block: # BEGIN x" in stderr
+                assert path.read_text() == original
+            assert sorted(x.name for x in tmp_path.iterdir()) == ["app.conf"]
+
+        def creates_missing_files(self, tmp_path):
+            path = tmp_path / "new.conf"
+            c = Context()
+            c.config.run.in_stream = False
+            assert not ensure_block(c, str(path), ["a"], present=False)
+            assert not path.exists()
+            assert ensure_block(c, str(path), ["a"], comment=";")
+            expected = u"; BEGIN patchwork\na\n; END patchwork\n"
+            assert path.read_text() == expected
+
+    class prepare_:
+
+        def builds_commands_without_a_context(self):
+            prepared = prepare(directory, "/srv/app", user="deploy")
+            assert isinstance(prepared, Prepared)
+            assert prepared.args == ("/srv/app", "deploy", None, None)
+            assert prepared.commands == (
+                "mkdir -p /srv/app",
+                "chown deploy:deploy /srv/app",
+            )
+
+        def runs_against_many_contexts_without_recompiling(self):
+            _forget_plans()
+            target = "patchwork.files._append_batch_commands"
+            with patch(target, wraps=_append_batch_commands) as builder:
+                lines = ["a", "b"]
+                prepared = prepare(append, "/etc/hosts", lines, batch=True)
+                # Not even via the shared cache
+                _forget_plans()
+                for _ in range(3):
+                    c = Mock(spec=Context)
+                    c.sudo.return_value = Result(connection=c, stdout="1\n")
+                    assert prepared(c, sudo=True) == ["b"]
+                    c.sudo.assert_called_once_with(prepared.command, hide=True)
+            assert builder.call_count == 1
+
+        def plain_calls_reuse_compiled_commands_too(self, cxn):
+            _forget_plans()
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            target = "patchwork.files._ensure_block_command"
+            with patch(target, wraps=_ensure_block_command) as builder:
+                ensure_block(cxn, "/etc/motd", ["hi"])
+                ensure_block(cxn, "/etc/motd", ["hi"])
+                ensure_block(cxn, "/etc/motd", ["bye"])
+            assert builder.call_count == 2
+
+        def cache_evicts_least_recently_used(self):
+            _forget_plans()
+            with patch("patchwork.files._MAX_PLANS", 2):
+                first = _plan(exists, "/a")
+                _plan(exists, "/b")
+                assert _plan(exists, "/a") is first
+                _plan(exists, "/c")
+                assert _plan(exists, "/a") is first
+                assert list(_PLANS) == [(exists, "/c"), (exists, "/a")]
+
+        def cache_is_limited_by_size_too(self):
+            _forget_plans()
+            with patch("patchwork.files._MAX_PLAN_BYTES", 100):
+                _plan(exists, "/" + "a" * 30)
+                _plan(exists, "/" + "b" * 30)
+                _plan(exists, "/" + "c" * 30)
+                assert len(_PLANS) == 2
+                assert (exists, "/" + "a" * 30) not in _PLANS
+                # Too big to cache at all, and doesn't evict anything
+                _plan(exists, "/" + "d" * 100)
+                assert len(_PLANS) == 2
+            _forget_plans()
+
+        def cache_is_thread_safe(self):
+            _forget_plans()
+            errors = []
+
+            def churn(offset):
+                try:
+                    for x in range(300):
+                        path = "/{}".format((x + offset) % 20)
+                        assert _plan(exists, path).args == (path,)
+                except Exception as e:
+                    errors.append(e)
+
+            with patch("patchwork.files._MAX_PLANS", 8):
+                threads = [
+                    threading.Thread(target=churn, args=(x,)) for x in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            assert errors == []
+            assert len(_PLANS) <= 8
+
+        def non_batched_append_precomputes_checks(self, cxn):
+            prepared = prepare(append, "/etc/hosts", ["a.b", ""], partial=True)
+            assert prepared.checks == ("^a\\.b", None)
+            assert prepared.commands == (
+                "echo 'a.b' >> /etc/hosts",
+                "echo '' >> /etc/hosts",
+            )
+
+        def rejects_other_functions(self):
+            with raises(TypeError):
+                prepare(upload_if_changed, "a", "b")
+
+        def escaping_is_memoized(self):
+            _escape_for_regex.cache.clear()
+            assert _escape_for_regex("a.b") is _escape_for_regex("a.b")
+            assert list(_escape_for_regex.cache) == ["a.b"]
+
+    class cache:
+
+        def disabled_by_default(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            exists(cxn, "/etc/hosts")
+            exists(cxn, "/etc/hosts")
+            assert cxn.run.call_count == 2
+
+        def exists_and_contains_are_cached_when_enabled(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            enable_cache(cxn)
+            assert exists(cxn, "/etc/hosts")
+            assert exists(cxn, "/etc/hosts")
+            assert contains(cxn, "/etc/hosts", "localhost")
+            assert contains(cxn, "/etc/hosts", "localhost")
+            assert cxn.run.call_count == 2
+            # Different arguments are different questions
+            contains(cxn, "/etc/hosts", "localhost", exact=True)
+            assert cxn.run.call_count == 3
+
+        def enable_cache_may_snapshot_paths_in_one_command(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\t1\n1\t0\n"
+            )
+            enable_cache(cxn, paths=["/a", "/b"])
+            assert exists(cxn, "/a") is True
+            assert exists(cxn, "/b") is False
+            assert cxn.run.call_count == 1
+
+        def exists_many_only_queries_unknown_paths(self, cxn):
+            enable_cache(cxn)
+            cxn.run.return_value = Result(connection=cxn)
+            exists(cxn, "/a")
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t0\n")
+            assert exists_many(cxn, ["/a", "/b"]) == {"/a": True, "/b": False}
+            assert "/a" not in cxn.run.call_args[0][0]
+
+        def mutations_invalidate_affected_paths(self, cxn):
+            enable_cache(cxn)
+            cxn.run.return_value = Result(connection=cxn, exited=1)
+            exists(cxn, "/srv")
+            exists(cxn, "/srv/app")
+            exists(cxn, "/etc/hosts")
+            cxn.run.return_value = Result(connection=cxn)
+            directory(cxn, "/srv/app")
+            append(cxn, "/etc/hosts", "x")
+            cxn.run.reset_mock()
+            # Target & parents were invalidated, so get re-checked...
+            assert exists(cxn, "/srv")
+            assert exists(cxn, "/srv/app")
+            assert exists(cxn, "/etc/hosts")
+            assert cxn.run.call_count == 3
+
+        def paths_are_normalized(self, cxn):
+            enable_cache(cxn)
+            cxn.run.return_value = Result(connection=cxn, exited=1)
+            assert not exists(cxn, "/srv/app")
+            assert not exists(cxn, "/srv//app/")
+            assert cxn.run.call_count == 1
+            cxn.run.return_value = Result(connection=cxn)
+            directory(cxn, "/srv/app/")
+            cxn.run.reset_mock()
+            assert exists(cxn, "/srv/app")
+            assert cxn.run.call_count == 1
+            clear_cache(cxn, "/srv/app/")
+            assert exists(cxn, "/srv/app")
+            assert cxn.run.call_count == 2
+
+        def append_does_not_trust_stale_contains(self, cxn):
+            def run(command, **kwargs):
+                # File exists, but never contains anything
+                exited = 1 if command.startswith("egrep") else 0
+                return Result(connection=cxn, command=command, exited=exited)
+
+            cxn.run.side_effect = run
+            enable_cache(cxn)
+            append(cxn, "/etc/hosts", ["dupe", "dupe"])
+            commands = [x[0][0].split()[0] for x in cxn.run.call_args_list]
+            # Second line was re-checked after the first append
+            assert commands == ["test", "egrep", "echo"] * 2
+
+        def clear_and_disable(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            enable_cache(cxn)
+            exists(cxn, "/a")
+            exists(cxn, "/b")
+            clear_cache(cxn, "/a")
+            exists(cxn, "/a")
+            exists(cxn, "/b")
+            assert cxn.run.call_count == 3
+            clear_cache(cxn)
+            exists(cxn, "/b")
+            assert cxn.run.call_count == 4
+            disable_cache(cxn)
+            exists(cxn, "/b")
+            exists(cxn, "/b")
+            assert cxn.run.call_count == 6
@@ -1,51 +1,100 @@
 from fabric import Result
 from mock import patch
 
-from patchwork.info import distro_name, distro_family
+from patchwork.info import clear_facts, distro_name, distro_family, facts
+
+
+def _probe(cxn, os_release="", sentinels=""):
+    stdout = "{}\n--patchwork-facts--\n{}\n".format(os_release, sentinels)
+    return Result(connection=cxn, stdout=stdout)
 
 
 class info:
 
+    class facts:
+
+        def gathers_with_a_single_command(self, cxn):
+            cxn.run.return_value = _probe(cxn)
+            facts(cxn)
+            assert cxn.run.call_count == 1
+            command = cxn.run.call_args[0][0]
+            assert "/etc/os-release" in command
+            assert "/etc/fedora-release" in command
+
+        def parses_os_release_and_sentinels(self, cxn):
+            cxn.run.return_value = _probe(
+                cxn, 'ID=ubuntu\nPRETTY_NAME="Ubuntu 18.04"', "/etc/foo"
+            )
+            found = facts(cxn)
+            assert found["os_release"]["ID"] == "ubuntu"
+            assert found["os_release"]["PRETTY_NAME"] == "Ubuntu 18.04"
+            assert found["sentinels"] == ["/etc/foo"]
+
+        def caches_per_connection(self, cxn):
+            cxn.run.return_value = _probe(cxn)
+            facts(cxn)
+            facts(cxn)
+            distro_family(cxn)
+            assert cxn.run.call_count == 1
+
+        def refresh_and_clear_facts_regather(self, cxn):
+            cxn.run.return_value = _probe(cxn)
+            facts(cxn)
+            facts(cxn, refresh=True)
+            assert cxn.run.call_count == 2
+            clear_facts(cxn)
+            facts(cxn)
+            assert cxn.run.call_count == 3
+
+        def may_cache_on_disk_keyed_by_host(self, cxn, tmpdir):
+            cache_dir = str(tmpdir)
+            cxn.run.return_value = _probe(cxn, "ID=debian")
+            facts(cxn, cache_dir=cache_dir)
+            assert tmpdir.join("host.json").check()
+            # Fresh in-memory state, but disk cache still hit
+            clear_facts(cxn)
+            assert facts(cxn, cache_dir=cache_dir)["os_release"]["ID"] == (
+                "debian"
+            )
+            assert cxn.run.call_count == 1
+            # Expired entries are ignored
+            clear_facts(cxn)
+            with patch("patchwork.info.time.time", return_value=1e12):
+                facts(cxn, cache_dir=cache_dir, ttl=60)
+            assert cxn.run.call_count == 2
+            # And clear_facts can remove the on-disk entry too
+            clear_facts(cxn, cache_dir=cache_dir)
+            assert not tmpdir.join("host.json").check()
+
     class distro_name:
 
         def returns_other_by_default(self, cxn):
-            # Sentinels don't exist -> yields default
-            # TODO: refactor with module contents in feature branch, eg tease
-            # out sentinel file definitions to module level data
-            # TODO: make a Session-like thing (or just allow reuse of Session?)
-            # that works at this level instead of what it currently does in
-            # MockRemote, mocking lower level stuff that is doubtlessly slower
-            # and not really necessary?
-            cxn.run.return_value = Result(connection=cxn, exited=1)
+            cxn.run.return_value = _probe(cxn)
             assert distro_name(cxn) == "other"
 
         def returns_fedora_if_fedora_release_exists(self, cxn):
-
-            def fedora_exists(*args, **kwargs):
-                # TODO: this is crazy fragile, indicates we want to refactor
-                # the guts of exists() or just mock exists() itself instead
-                if args[0] == 'test -e "$(echo /etc/fedora-release)"':
-                    return Result(connection=cxn, exited=0)
-                return Result(connection=cxn, exited=1)
-
-            cxn.run.side_effect = fedora_exists
+            cxn.run.return_value = _probe(cxn, "", "/etc/fedora-release")
             assert distro_name(cxn) == "fedora"
 
         def returns_centos_if_centos_release_exists(self, cxn):
+            cxn.run.return_value = _probe(cxn, "", "/etc/centos-release")
+            assert distro_name(cxn) == "centos"
 
-            def centos_exists(*args, **kwargs):
-                # TODO: this is crazy fragile, indicates we want to refactor
-                # the guts of exists() or just mock exists() itself instead
-                if args[0] == 'test -e "$(echo /etc/centos-release)"':
-                    return Result(connection=cxn, exited=0)
-                return Result(connection=cxn, exited=1)
-
-            cxn.run.side_effect = centos_exists
+        def sentinels_win_over_os_release(self, cxn):
+            cxn.run.return_value = _probe(
+                cxn, "ID=ubuntu", "/etc/centos-release"
+            )
             assert distro_name(cxn) == "centos"
 
-        # TODO: might as well document & test for the part where we test the
-        # sentinels in order, so a system with (somehow) >1 sentinel will
-        # appear to be the first one in our list/structure.
+        def falls_back_to_os_release_id(self, cxn):
+            for distro in ("rhel", "ubuntu", "debian"):
+                cxn.run.return_value = _probe(cxn, "ID={}".format(distro))
+                assert distro_name(cxn) == distro
+                clear_facts(cxn)
+
+        def unknown_os_release_id_is_other(self, cxn):
+            cxn.run.return_value = _probe(cxn, "ID=plan9")
+            assert distro_name(cxn) == "other"
 
     class distro_family:
 
@@ -0,0 +1,102 @@
+import json
+
+from fabric import Connection, Result
+from invoke.exceptions import UnexpectedExit
+from mock import Mock
+from pytest import raises
+
+from patchwork.files import append, directory
+from patchwork.instrumentation import Recorder
+from patchwork.parallel import fan_out
+from patchwork.util import add_call_hook, remove_call_hook, set_runner
+
+
+class instrumentation:
+
+    class call_hooks:
+
+        def receive_record_per_decorated_call(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            records = []
+            add_call_hook(records.append)
+            try:
+                directory(cxn, "/srv", mode="0755")
+            finally:
+                remove_call_hook(records.append)
+            assert len(records) == 1
+            record = records[0]
+            assert record.function == "patchwork.files.directory"
+            assert record.host == "host"
+            assert record.sudo is False
+            assert [x.command for x in record.commands] == [
+                "mkdir -p /srv",
+                "chmod 0755 /srv",
+            ]
+            assert all(x.exited == 0 for x in record.commands)
+            assert record.duration >= 0
+            assert record.error is None
+
+        def nested_calls_are_folded_into_outer_call(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            with Recorder() as recorder:
+                append(cxn, "/etc/hosts", "x")
+            assert [x.function for x in recorder.calls] == [
+                "patchwork.files.append"
+            ]
+            # test -e, egrep (which succeeded, so no echo)
+            assert len(recorder.calls[0].commands) == 2
+
+        def records_sudo_and_failures(self, cxn):
+            failure = UnexpectedExit(Result(connection=cxn, exited=1))
+            cxn.sudo = Mock(side_effect=failure)
+            with Recorder() as recorder:
+                with raises(UnexpectedExit):
+                    directory(cxn, "/srv", sudo=True)
+            record = recorder.calls[0]
+            assert record.sudo is True
+            assert record.error is failure
+            assert record.commands[0].exited == 1
+
+        def no_hooks_means_no_wrapping(self, cxn):
+            @set_runner
+            def myfunc(c, runner):
+                assert runner == c.run
+
+            myfunc(cxn)
+
+    class Recorder_:
+
+        def aggregates_per_function_and_host(self):
+            cxns = []
+            for name in ("web1", "web2"):
+                c = Connection(name, user="user")
+                c.run = Mock(return_value=Result(connection=c))
+                cxns.append(c)
+            with Recorder() as recorder:
+                fan_out(cxns, directory, "/srv", user="app")
+                directory(cxns[0], "/tmp")
+            report = recorder.report()
+            functions = report["functions"]["patchwork.files.directory"]
+            assert functions["calls"] == 3
+            assert functions["commands"] == 5
+            assert functions["errors"] == 0
+            assert report["hosts"]["web1"]["calls"] == 2
+            assert report["hosts"]["web2"]["commands"] == 2
+            assert "calls" not in report
+
+        def exports_json_with_optional_detail(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            with Recorder() as recorder:
+                directory(cxn, "/srv")
+            data = json.loads(recorder.to_json(detail=True))
+            assert data["calls"][0]["commands"][0]["command"] == (
+                "mkdir -p /srv"
+            )
+            assert data["hosts"]["host"]["commands"] == 1
+
+        def stops_recording_on_exit(self, cxn):
+            cxn.run.return_value = Result(connection=cxn)
+            with Recorder() as recorder:
+                pass
+            directory(cxn, "/srv")
+            assert recorder.calls == []
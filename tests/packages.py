@@ -0,0 +1,316 @@
+from fabric import Result
+from invoke.exceptions import UnexpectedExit
+from mock import Mock, patch
+from pytest import raises
+
+from patchwork.packages import (
+    Apk,
+    Apt,
+    Backend,
+    Dnf,
+    Gem,
+    Pacman,
+    Yum,
+    backend,
+    installed_packages,
+    package,
+    prefetch,
+    refresh,
+    rubygem,
+)
+
+
+def _sudo(cxn, failing=()):
+    def sudo(command, **kwargs):
+        failed = any(command.endswith(" " + x) for x in failing)
+        return Result(connection=cxn, command=command, exited=int(failed))
+
+    cxn.sudo = Mock(side_effect=sudo)
+    # prefetch() opens the connection before sharing it with its thread
+    cxn.open = Mock()
+    return cxn.sudo
+
+
+class packages:
+
+    class package_:
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def installs_all_missing_packages_in_one_transaction(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            report = package(cxn, "git", "vim", "tmux")
+            sudo.assert_called_once_with(
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y git vim tmux",  # noqa
+                warn=True,
+            )
+            assert report.installed == ["git", "vim", "tmux"]
+            assert report.present == []
+            assert report.failed == []
+
+        @patch("patchwork.packages.distro_family", return_value="redhat")
+        def uses_yum_on_non_debian(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            package(cxn, "git", "vim")
+            sudo.assert_called_once_with("yum install -y git vim", warn=True)
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def skips_already_installed_packages(self, _, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="git installed\nvim not-installed\n"
+            )
+            sudo = _sudo(cxn)
+            report = package(cxn, "git", "vim")
+            sudo.assert_called_once_with(
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y vim",
+                warn=True,
+            )
+            assert report.installed == ["vim"]
+            assert report.present == ["git"]
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def does_nothing_when_everything_is_present(self, _, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="git installed\n"
+            )
+            sudo = _sudo(cxn)
+            report = package(cxn, "git")
+            assert not sudo.called
+            assert report.present == ["git"]
+
+        @patch("patchwork.packages.distro_family", return_value="redhat")
+        def failed_transaction_isolates_failures(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn, failing=("nope", "git vim nope"))
+            report = package(cxn, "git", "vim", "nope", warn=True)
+            assert sudo.call_count == 4
+            assert report.installed == ["git", "vim"]
+            assert report.failed == ["nope"]
+
+        @patch("patchwork.packages.distro_family", return_value="redhat")
+        def failures_raise_unless_warn(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            _sudo(cxn, failing=("nope",))
+            with raises(UnexpectedExit):
+                package(cxn, "nope")
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def raises_the_first_failure(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            _sudo(cxn, failing=("aaa", "bbb"))
+            with raises(UnexpectedExit) as info:
+                package(cxn, "aaa", "bbb")
+            assert info.value.result.command.endswith("install -y aaa")
+
+        @patch("patchwork.packages.distro_family", return_value="redhat")
+        def transaction_false_installs_one_at_a_time(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            package(cxn, "git", "vim", transaction=False)
+            assert sudo.call_count == 2
+
+        def rejects_unknown_kwargs(self, cxn):
+            with raises(TypeError):
+                package(cxn, "git", nope=True)
+
+    class installed_packages_:
+
+        def uses_single_dpkg_query_on_debian(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn,
+                stdout="git installed\nvim config-files\nfoo installed\n",
+            )
+            found = installed_packages(cxn, ["git", "vim"], family="debian")
+            assert found == {"git"}
+            assert cxn.run.call_count == 1
+            assert cxn.run.call_args[0][0].startswith("dpkg-query -W")
+
+        def uses_single_rpm_query_otherwise(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn,
+                stdout="git installed\npackage vim is not installed\n",
+            )
+            found = installed_packages(cxn, ["git", "vim"], family="redhat")
+            assert found == {"git"}
+            assert cxn.run.call_args[0][0] == (
+                "rpm -q --qf '%{NAME} installed\\n' git vim"
+            )
+
+        def empty_input_runs_nothing(self, cxn):
+            assert installed_packages(cxn, []) == set()
+            assert not cxn.run.called
+
+    class backend_:
+
+        def base_class_is_abstract(self):
+            with raises(TypeError):
+                Backend()
+
+            class Partial(Backend):
+                def install_command(self, packages):
+                    return "install"
+
+            with raises(TypeError):
+                Partial()
+
+            class Complete(Partial):
+                def installed_command(self, packages):
+                    return "query"
+
+            assert Complete(proxy="http://mirror").proxy == "http://mirror"
+
+        @patch("patchwork.packages.distro_family")
+        def follows_distro_family(self, family, cxn):
+            for name, kind in (
+                ("debian", Apt),
+                ("redhat", Yum),
+                ("alpine", Apk),
+                ("arch", Pacman),
+                ("no-clue", Yum),
+            ):
+                family.return_value = name
+                assert type(backend(cxn)) is kind
+
+        def may_be_chosen_explicitly(self, cxn):
+            manager = backend(cxn, "dnf", cache="/mnt/cache")
+            assert type(manager) is Dnf
+            assert manager.cache == "/mnt/cache"
+
+        def rejects_unknown_managers(self, cxn):
+            with raises(ValueError):
+                backend(cxn, "brew")
+
+        def apt_options(self):
+            manager = Apt(cache="/mnt/apt", proxy="http://cache:3142")
+            assert manager.install_command(["git"]) == (
+                "sh -c 'mkdir -p /mnt/apt/partial && "
+                "DEBIAN_FRONTEND=noninteractive apt-get "
+                "-o Dir::Cache::Archives=/mnt/apt "
+                "-o Acquire::http::Proxy=http://cache:3142 install -y git'"
+            )
+
+        def dnf_options(self):
+            manager = Dnf(cache="/mnt/dnf", proxy="http://proxy:3128")
+            assert manager.download_command(["git"]) == (
+                "dnf --setopt=cachedir=/mnt/dnf --setopt=keepcache=1 "
+                "--setopt=proxy=http://proxy:3128 "
+                "install -y --downloadonly git"
+            )
+
+        def apk_and_pacman_use_proxy_environment(self):
+            proxy = "http_proxy=http://p https_proxy=http://p "
+            manager = Apk(cache="/mnt/apk", proxy="http://p")
+            assert manager.install_command(["git", "vim"]) == (
+                proxy + "apk --cache-dir /mnt/apk add git vim"
+            )
+            assert manager.download_command(["git"]) is None
+            manager = Pacman(proxy="http://p")
+            assert manager.install_command(["git"]) == (
+                proxy + "pacman -S --needed --noconfirm git"
+            )
+
+        def parse_installed_per_manager(self):
+            assert Apk().parse_installed("git\n", ["git", "vim"]) == {"git"}
+            stdout = "git 2.40.0-1\n"
+            assert Pacman().parse_installed(stdout, ["git", "vim"]) == {"git"}
+            stdout = "*** LOCAL GEMS ***\n\nrake\nrails\n"
+            assert Gem().parse_installed(stdout, ["rake", "pry"]) == {"rake"}
+
+    class refresh_:
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def skips_remotely_fresh_metadata(self, _, cxn):
+            sudo = cxn.sudo = Mock(
+                return_value=Result(connection=cxn, stdout="refreshed\n")
+            )
+            assert refresh(cxn, ttl=600) is True
+            command = sudo.call_args[0][0]
+            assert command.startswith("sh -c ")
+            assert "find /var/tmp/patchwork-apt-refreshed -mmin -10" in command
+            assert "apt-get update && touch" in command
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def remembers_refreshes_per_context(self, _, cxn):
+            sudo = cxn.sudo = Mock(return_value=Result(connection=cxn))
+            refresh(cxn)
+            assert refresh(cxn) is False
+            assert sudo.call_count == 1
+            refresh(cxn, force=True)
+            assert sudo.call_count == 2
+            assert "find" not in sudo.call_args[0][0]
+
+        def nothing_to_refresh_for_gems(self, cxn):
+            cxn.sudo = Mock()
+            assert refresh(cxn, manager="gem") is False
+            assert not cxn.sudo.called
+
+        @patch("patchwork.packages.distro_family", return_value="redhat")
+        def package_may_refresh_first(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            package(cxn, "git", refresh=True)
+            commands = [x[0][0] for x in sudo.call_args_list]
+            assert "yum makecache" in commands[0]
+            assert commands[1] == "yum install -y git"
+
+    class prefetch_:
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def downloads_missing_packages_in_background(self, _, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="git installed\n"
+            )
+            sudo = _sudo(cxn)
+            pending = prefetch(cxn, "git", "vim", cache="/mnt/apt")
+            assert pending.wait().ok
+            command = sudo.call_args[0][0]
+            assert "install -y --download-only vim'" in command
+            assert "Dir::Cache::Archives=/mnt/apt" in command
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def package_waits_for_prefetches(self, _, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            prefetch(cxn, "git")
+            package(cxn, "git")
+            commands = [x[0][0] for x in sudo.call_args_list]
+            assert commands == [
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y "
+                "--download-only git",
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y git",
+            ]
+
+        @patch("patchwork.packages.Prefetch")
+        def opens_the_connection_before_downloading(self, Prefetch, cxn):
+            # Fabric connections open lazily, and not thread-safely
+            cxn.open = Mock(side_effect=lambda: Prefetch.assert_not_called())
+            prefetch(cxn, "git", manager="apt")
+            cxn.open.assert_called_once_with()
+            assert Prefetch.called
+
+        def unsupported_managers_download_nothing(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            assert prefetch(cxn, "git", manager="apk").wait() is None
+            assert not sudo.called
+
+    class rubygem_:
+
+        def installs_missing_gems_in_one_command(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="rake\n")
+            sudo = _sudo(cxn)
+            report = rubygem(cxn, "rake", "rails", "pry")
+            sudo.assert_called_once_with(
+                "gem install --no-document rails pry", warn=True
+            )
+            assert report.present == ["rake"]
+
+        def may_use_another_source(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="")
+            sudo = _sudo(cxn)
+            rubygem(cxn, "rake", source="http://gems.local")
+            assert sudo.call_args[0][0] == (
+                "gem install --no-document --clear-sources "
+                "--source http://gems.local rake"
+            )
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from fabric import Connection, Result
+from fabric.exceptions import GroupException
+from invoke.exceptions import UnexpectedExit
+from mock import Mock
+from pytest import raises
+
+from patchwork.files import directory
+from patchwork.parallel import fan_out, pool_map
+
+
+def _connections(count):
+    cxns = []
+    for index in range(count):
+        c = Connection("host{}".format(index), user="user")
+        c.run = Mock(return_value=Result(connection=c))
+        cxns.append(c)
+    return cxns
+
+
+class parallel:
+
+    class fan_out_:
+
+        def runs_decorated_function_on_every_connection(self):
+            cxns = _connections(5)
+            fan_out(cxns, directory, "/srv/app", mode="0755")
+            for c in cxns:
+                c.run.assert_any_call("mkdir -p /srv/app")
+                c.run.assert_any_call("chmod 0755 /srv/app")
+
+        def returns_group_result_keyed_by_connection(self):
+            cxns = _connections(3)
+            result = fan_out(cxns, lambda c, x: (c.host, x), "arg")
+            assert set(result.keys()) == set(cxns)
+            for c in cxns:
+                assert result[c] == (c.host, "arg")
+
+        def aggregates_exceptions_into_group_exception(self):
+            cxns = _connections(3)
+            failure = UnexpectedExit(Result(connection=cxns[1], exited=1))
+            cxns[1].run.side_effect = failure
+            with raises(GroupException) as info:
+                fan_out(cxns, directory, "/srv/app")
+            result = info.value.result
+            assert list(result.failed.keys()) == [cxns[1]]
+            assert result.failed[cxns[1]] is failure
+            assert len(result.succeeded) == 2
+
+        def honors_worker_limit(self):
+            active, peak = [0], [0]
+            lock = threading.Lock()
+
+            def slow(c):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.01)
+                with lock:
+                    active[0] -= 1
+
+            fan_out(_connections(12), slow, workers=3)
+            assert peak[0] <= 3
+
+    class pool_map_:
+
+        def preserves_order(self):
+            assert pool_map(lambda x: x * 2, range(50), workers=4) == [
+                x * 2 for x in range(50)
+            ]
+
+        def substitutes_exceptions_for_results(self):
+            def maybe(x):
+                if x == 1:
+                    raise ValueError(x)
+                return x
+
+            results = pool_map(maybe, [0, 1, 2])
+            assert results[0] == 0 and results[2] == 2
+            assert isinstance(results[1], ValueError)
+
+        def handles_empty_input(self):
+            assert pool_map(lambda x: x, []) == []
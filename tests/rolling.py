@@ -0,0 +1,124 @@
+import threading
+
+from fabric import Connection, Result
+from mock import Mock
+
+from patchwork.rolling import HealthCheckFailed, rolling
+
+
+def _connections(count):
+    cxns = []
+    for index in range(count):
+        c = Connection("host{}".format(index), user="user")
+        c.run = Mock(return_value=Result(connection=c))
+        cxns.append(c)
+    return cxns
+
+
+class _Log(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def deploy(self, c):
+        with self.lock:
+            self.events.append(("deploy", c.host))
+        return c.host
+
+    def check(self, c):
+        with self.lock:
+            self.events.append(("check", c.host))
+        return True
+
+
+class rolling_:
+
+    def deploys_and_checks_batch_by_batch(self):
+        log = _Log()
+        cxns = _connections(4)
+        rollout = rolling(cxns, log.deploy, check=log.check, batch_size=2)
+        assert not rollout.halted
+        assert rollout.skipped == []
+        assert [rollout.results[c] for c in cxns] == [c.host for c in cxns]
+        kinds = [x for x, _ in log.events]
+        assert kinds == ["deploy"] * 2 + ["check"] * 2 + ["deploy"] * 2 + [
+            "check"
+        ] * 2
+
+    def batch_size_may_be_a_percentage(self):
+        log = _Log()
+        cxns = _connections(10)
+        rolling(cxns, log.deploy, check=log.check, batch_size="25%")
+        kinds = "".join(x[0] for x, _ in log.events)
+        # 10 hosts at 25% (rounded up) -> batches of 3, 3, 3, 1
+        assert kinds == "dddccc" * 3 + "dc"
+
+    def command_checks_run_hidden_on_each_host(self):
+        cxns = _connections(2)
+        rolling(cxns, lambda c: None, check="curl -f localhost/health")
+        for c in cxns:
+            c.run.assert_called_once_with(
+                "curl -f localhost/health", hide=True, warn=True
+            )
+
+    def halts_once_failures_exceed_threshold(self):
+        cxns = _connections(6)
+
+        def check(c):
+            return c.host not in ("host0", "host2")
+
+        rollout = rolling(
+            cxns, lambda c: "ok", check=check, batch_size=2, max_failures=1
+        )
+        assert rollout.halted
+        assert rollout.skipped == cxns[4:]
+        assert set(rollout.results.failed) == set([cxns[0], cxns[2]])
+        assert isinstance(rollout.results[cxns[0]], HealthCheckFailed)
+        assert rollout.results[cxns[1]] == "ok"
+
+    def deploy_errors_count_as_failures_and_skip_checks(self):
+        log = _Log()
+        cxns = _connections(2)
+
+        def deploy(c):
+            if c.host == "host0":
+                raise ValueError("boom")
+
+        rollout = rolling(cxns, deploy, check=log.check, batch_size=2)
+        assert isinstance(rollout.results[cxns[0]], ValueError)
+        assert log.events == [("check", "host1")]
+        assert rollout.halted
+
+    def depth_overlaps_next_deploy_with_current_checks(self):
+        cxns = _connections(2)
+        second_deploy = threading.Event()
+        overlapped = []
+
+        def deploy(c):
+            if c.host == "host1":
+                second_deploy.set()
+
+        def check(c):
+            if c.host == "host0":
+                overlapped.append(second_deploy.wait(2))
+            return True
+
+        rolling(cxns, deploy, check=check, depth=2)
+        assert overlapped == [True]
+
+    def depth_one_is_strictly_sequential(self):
+        cxns = _connections(2)
+        second_deploy = threading.Event()
+        overlapped = []
+
+        def deploy(c):
+            if c.host == "host1":
+                second_deploy.set()
+
+        def check(c):
+            if c.host == "host0":
+                overlapped.append(second_deploy.is_set())
+            return True
+
+        rolling(cxns, deploy, check=check)
+        assert overlapped == [False]
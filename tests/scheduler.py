@@ -0,0 +1,173 @@
+import threading
+import time
+
+from fabric import Connection
+from fabric.exceptions import GroupException
+from mock import Mock
+from pytest import raises
+
+from patchwork.scheduler import DependencyFailed, Scheduler, TaskError
+
+
+def _connections(count):
+    cxns = [Connection("host{}".format(x), user="user") for x in range(count)]
+    for c in cxns:
+        c.open = Mock()
+    return cxns
+
+
+class _Tracker(object):
+    """
+    Task factory recording start order and peak concurrency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.peak = 0
+
+    def task(self, name, delay=0.02):
+        def run(c):
+            with self.lock:
+                self.started.append((c.host, name))
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(delay)
+            with self.lock:
+                self.running -= 1
+            return name.upper()
+
+        return run
+
+
+class scheduler:
+
+    class Scheduler_:
+
+        def runs_every_task_on_every_host(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            s.add("a", tracker.task("a"))
+            s.add("b", tracker.task("b"), after=["a"])
+            cxns = _connections(3)
+            results = s.run(cxns)
+            for c in cxns:
+                assert results[c] == {"a": "A", "b": "B"}
+
+        def honors_dependencies_per_host(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            # Added out of order on purpose
+            s.add("restart", tracker.task("restart"), after=["config"])
+            s.add("config", tracker.task("config"), after=["package"])
+            s.add("package", tracker.task("package"))
+            s.run(_connections(2))
+            for host in ("host0", "host1"):
+                order = [y for x, y in tracker.started if x == host]
+                assert order == ["package", "config", "restart"]
+
+        def passes_arguments(self):
+            s = Scheduler()
+            s.add("x", lambda c, a, b=None: (a, b), 1, b=2)
+            cxn = _connections(1)[0]
+            assert s.run([cxn])[cxn] == {"x": (1, 2)}
+
+        def runs_independent_tasks_concurrently_on_one_host(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            for name in "abcd":
+                s.add(name, tracker.task(name, delay=0.1))
+            s.run(_connections(1), per_host=4)
+            assert tracker.peak == 4
+
+        def limits_concurrency_per_host(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            for name in "abcd":
+                s.add(name, tracker.task(name))
+            s.run(_connections(1), per_host=1)
+            assert tracker.peak == 1
+
+        def limits_concurrency_globally(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            for name in "ab":
+                s.add(name, tracker.task(name))
+            s.run(_connections(4), workers=3)
+            assert tracker.peak <= 3
+
+        def workers_and_per_host_may_be_none(self):
+            tracker = _Tracker()
+            s = Scheduler()
+            for name in "abcd":
+                s.add(name, tracker.task(name, delay=0.1))
+            s.run(_connections(2), workers=None, per_host=None)
+            assert tracker.peak == 8
+
+        def opens_each_connection_once_before_its_tasks(self):
+            cxns = _connections(2)
+
+            def open_(c):
+                time.sleep(0.05)
+                # Real opens set up a transport, making is_connected true
+                c.transport = Mock(active=True)
+
+            for c in cxns:
+                c.open.side_effect = lambda c=c: open_(c)
+            s = Scheduler()
+            for name in "abcd":
+                s.add(name, lambda c: c.is_connected)
+            results = s.run(cxns)
+            for c in cxns:
+                assert c.open.call_count == 1
+                assert all(results[c].values())
+
+        def failures_skip_dependents_on_that_host_only(self):
+            def package(c):
+                if c.host == "host0":
+                    raise ValueError("nope")
+
+            s = Scheduler()
+            s.add("package", package)
+            s.add("config", lambda c: "ok", after=["package"])
+            s.add("restart", lambda c: "ok", after=["config"])
+            s.add("unrelated", lambda c: "ok")
+            bad, good = cxns = _connections(2)
+            with raises(GroupException) as info:
+                s.run(cxns)
+            results = info.value.result
+            assert results[good] == {
+                "package": None,
+                "config": "ok",
+                "restart": "ok",
+                "unrelated": "ok",
+            }
+            error = results[bad]
+            assert isinstance(error, TaskError)
+            assert error.results["unrelated"] == "ok"
+            assert isinstance(error.results["package"], ValueError)
+            for name in ("config", "restart"):
+                skipped = error.results[name]
+                assert isinstance(skipped, DependencyFailed)
+                assert skipped.dependency == "package"
+            assert sorted(error.errors) == ["config", "package", "restart"]
+
+        def rejects_unknown_dependencies(self):
+            s = Scheduler()
+            s.add("a", len, after=["nope"])
+            with raises(ValueError):
+                s.run(_connections(1))
+
+        def rejects_cycles(self):
+            s = Scheduler()
+            s.add("a", len, after=["b"])
+            s.add("b", len, after=["a"])
+            with raises(ValueError):
+                s.order()
+
+        def rejects_duplicate_names(self):
+            s = Scheduler()
+            s.add("a", len)
+            with raises(ValueError):
+                s.add("a", len)
@@ -0,0 +1,166 @@
+import re
+
+from fabric import Result
+from mock import Mock, patch
+from pytest import raises
+
+from patchwork.state import (
+    Action,
+    Directory,
+    Line,
+    Package,
+    Tree,
+    apply,
+    converge,
+    plan,
+)
+
+
+def _pipeline_ok(cxn):
+    # Answer Pipeline scripts as though every step succeeded silently
+    def run(command, **kwargs):
+        steps = sorted(set(re.findall(r"patchwork-\w{32} \d+", command)))
+        stdout = "".join("{0}\n\n{0} 0\n".format(x) for x in steps)
+        stderr = "".join("{0}\n\n{0}\n".format(x) for x in steps)
+        return Result(
+            connection=cxn, command=command, stdout=stdout, stderr=stderr
+        )
+
+    cxn.run.side_effect = run
+
+
+class state:
+
+    class plan_:
+
+        def gathers_paths_and_lines_in_one_command(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn,
+                stdout=(
+                    "0\tdirectory\tdeploy\tdeploy\t755\n"
+                    "1\t\n"
+                    "2\t1\n"
+                    "3\t0\n"
+                ),
+            )
+            resources = [
+                Directory("/srv/app", user="deploy", mode="0755"),
+                Directory("/srv/logs"),
+                Line("/etc/env", "A=1"),
+                Line("/etc/env", "B=2"),
+            ]
+            actions = plan(cxn, resources)
+            assert cxn.run.call_count == 1
+            assert actions == [
+                Action(Directory("/srv/logs"), ["create"]),
+                Action(Line("/etc/env", "B=2"), ["append"]),
+            ]
+
+        def detects_owner_and_mode_drift(self, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="0\tdirectory\troot\troot\t700\n"
+            )
+            resource = Directory("/srv/app", user="deploy", mode="0755")
+            actions = plan(cxn, [resource])
+            assert actions == [Action(resource, ["owner", "mode"])]
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def checks_packages_in_one_command(self, _, cxn):
+            cxn.run.return_value = Result(
+                connection=cxn, stdout="git installed\n"
+            )
+            actions = plan(cxn, [Package("git"), Package("vim")])
+            assert cxn.run.call_count == 1
+            assert actions == [Action(Package("vim"), ["install"])]
+
+        def dry_runs_trees(self, cxn):
+            cxn.local.return_value = Result(
+                connection=cxn, stdout=">f+++++++++ app.py\n"
+            )
+            tree = Tree("build/", "/srv/app")
+            actions = plan(cxn, [tree])
+            assert "--dry-run --itemize-changes" in cxn.local.call_args[0][0]
+            assert len(actions) == 1
+            assert actions[0].changes[0].path == "app.py"
+
+        def passes_only_rsync_command_options_to_dry_run(self, cxn):
+            cxn.local.return_value = Result(connection=cxn, stdout="")
+            options = dict(
+                exclude=["*.pyc"], detect_changes=True, multiplex=True
+            )
+            plan(cxn, [Tree("build/", "/srv/app", options)])
+            assert '--exclude "*.pyc"' in cxn.local.call_args[0][0]
+
+        def splits_huge_probes_over_several_commands(self, cxn):
+            def run(command, **kwargs):
+                found = re.findall(r'printf "(\d+)\\t"', command)
+                stdout = "".join("{}\t1\n".format(x) for x in found)
+                return Result(connection=cxn, command=command, stdout=stdout)
+
+            cxn.run.side_effect = run
+            lines = [
+                Line("/etc/big", "line {:04} {}".format(x, "x" * 100))
+                for x in range(2000)
+            ]
+            assert plan(cxn, lines) == []
+            assert cxn.run.call_count > 1
+            for args, _ in cxn.run.call_args_list:
+                assert len(args[0]) < 131072
+
+        def skips_unchanged_trees(self, cxn):
+            cxn.local.return_value = Result(connection=cxn, stdout="")
+            assert plan(cxn, [Tree("build/", "/srv/app")]) == []
+
+        def rejects_unknown_resources(self, cxn):
+            with raises(TypeError):
+                plan(cxn, ["/srv/app"])
+
+    class apply_:
+
+        @patch("patchwork.packages.distro_family", return_value="debian")
+        def batches_all_changes(self, _, cxn):
+            cxn.sudo = Mock(return_value=Result(connection=cxn))
+            _pipeline_ok(cxn)
+            actions = [
+                Action(Package("vim"), ["install"]),
+                Action(Package("git"), ["install"]),
+                Action(Directory("/srv/a"), ["create"]),
+                Action(Directory("/srv/b"), ["create"]),
+                Action(Line("/etc/env", "A=1"), ["append"]),
+                Action(Line("/etc/env", "B=2"), ["append"]),
+            ]
+            apply(cxn, actions)
+            cxn.sudo.assert_called_once_with(
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y vim git"
+            )
+            # Everything else is one Pipeline flush
+            assert cxn.run.call_count == 1
+            script = cxn.run.call_args[0][0]
+            for expected in ("mkdir -p /srv/a", "mkdir -p /srv/b", "A=1"):
+                assert expected in script
+
+        def installs_via_the_package_backend(self, cxn):
+            cxn.sudo = Mock(return_value=Result(connection=cxn))
+            with patch("patchwork.packages.distro_family") as family:
+                family.return_value = "alpine"
+                apply(cxn, [Action(Package("git"), ["install"])])
+            cxn.sudo.assert_called_once_with("apk add git")
+
+        def syncs_changed_trees(self, cxn):
+            cxn.local.return_value = Result(connection=cxn)
+            apply(cxn, [Action(Tree("build/", "/srv/app"), ["x"])])
+            assert cxn.local.call_count == 1
+            assert "--dry-run" not in cxn.local.call_args[0][0]
+
+    class converge_:
+
+        def applies_nothing_when_converged(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t1\n")
+            assert converge(cxn, [Line("/etc/env", "A=1")]) == []
+            assert cxn.run.call_count == 1
+
+        def dry_run_only_plans(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, stdout="0\t\n")
+            actions = converge(cxn, [Directory("/srv/app")], dry_run=True)
+            assert [str(x) for x in actions] == ["directory /srv/app (create)"]
+            assert cxn.run.call_count == 1
@@ -1,4 +1,22 @@
-from patchwork.transfers import rsync
+import os
+
+from fabric import Connection, Result
+from fabric.exceptions import GroupException
+from invoke.exceptions import UnexpectedExit
+from mock import Mock, patch
+from pytest import raises
+
+from patchwork.files import enable_cache, exists
+from patchwork.transfers import (
+    Change,
+    SyncError,
+    close_multiplexed,
+    multiplexed,
+    parse_itemized,
+    parse_stats,
+    rsync,
+    rsync_many,
+)
 
 
 local = "localpath"
@@ -49,3 +67,254 @@ class transfers:
                 exclusions, flags, end
             )
             self._expect(cxn, expected, kwargs=dict(exclude=["foo", "bar"]))
+
+        class multiplexing:
+
+            def shares_one_ssh_connection_within_scope(self, cxn):
+                cxn.local.return_value = Result(connection=cxn)
+                with multiplexed(cxn) as path:
+                    assert os.path.isdir(os.path.dirname(path))
+                    rsync(cxn, local, remote)
+                    rsync(cxn, local, remote)
+                commands = [x[0][0] for x in cxn.local.call_args_list]
+                opts = "-o ControlMaster=auto -o ControlPath={}".format(path)
+                assert opts in commands[0]
+                assert "-o ControlPersist=60" in commands[0]
+                assert commands[0] == commands[1]
+                assert commands[2] == (
+                    "ssh -o ControlPath={} -O exit -p 22 user@host".format(
+                        path
+                    )
+                )
+                assert not os.path.exists(os.path.dirname(path))
+                # And not afterwards
+                rsync(cxn, local, remote)
+                assert "ControlPath" not in cxn.local.call_args[0][0]
+
+            def nested_scopes_share_the_outer_connection(self, cxn):
+                with multiplexed(cxn) as outer:
+                    with multiplexed(cxn) as inner:
+                        assert inner == outer
+                    assert not cxn.local.called
+                assert cxn.local.call_count == 1
+
+            def kwarg_multiplexes_for_connection_lifetime(self, cxn):
+                cxn.local.return_value = Result(connection=cxn)
+                rsync(cxn, local, remote, multiplex=True)
+                rsync(cxn, local, remote)
+                assert "ControlPath" in cxn.local.call_args[0][0]
+                close_multiplexed(cxn)
+                assert "-O exit" in cxn.local.call_args[0][0]
+                close_multiplexed(cxn)
+                assert cxn.local.call_count == 3
+
+            def closing_the_connection_closes_the_master(self, cxn):
+                cxn.local.return_value = Result(connection=cxn)
+                with patch.object(Connection, "close") as close:
+                    rsync(cxn, local, remote, multiplex=True)
+                    rsync(cxn, local, remote, multiplex=True)
+                    cxn.close()
+                    assert "-O exit" in cxn.local.call_args[0][0]
+                    assert close.call_count == 1
+                    # Multiplexing may start over, and still gets cleaned up
+                    rsync(cxn, local, remote, multiplex=True)
+                    cxn.close()
+                    assert "-O exit" in cxn.local.call_args[0][0]
+                    assert close.call_count == 2
+                assert cxn.local.call_count == 5
+
+        class detect_changes:
+
+            def performs_itemized_dry_run_first(self, cxn):
+                cxn.local.return_value = Result(connection=cxn, stdout="")
+                rsync(cxn, local, remote, detect_changes=True)
+                command = cxn.local.call_args_list[0][0][0]
+                assert "--dry-run --itemize-changes" in command
+                assert cxn.local.call_args_list[0][1] == {"hide": True}
+
+            def skips_transfer_when_nothing_changed(self, cxn):
+                cxn.local.return_value = Result(
+                    connection=cxn,
+                    stdout=(
+                        "sending incremental file list\n\n"
+                        "sent 80 bytes  received 12 bytes\n"
+                    ),
+                )
+                assert rsync(cxn, local, remote, detect_changes=True) == []
+                assert cxn.local.call_count == 1
+
+            def transfers_and_returns_changes_when_needed(self, cxn):
+                cxn.local.return_value = Result(
+                    connection=cxn,
+                    stdout=(
+                        "sending incremental file list\n"
+                        "<f.st...... app.py\n"
+                        "cd+++++++++ static/\n"
+                        "*deleting   old.txt\n"
+                    ),
+                )
+                changes = rsync(cxn, local, remote, detect_changes=True)
+                assert cxn.local.call_count == 2
+                real = cxn.local.call_args_list[1][0][0]
+                assert "--dry-run" not in real
+                assert changes == [
+                    Change("app.py", "<", "f", ".st......"),
+                    Change("static/", "c", "d", "+++++++++"),
+                    Change("old.txt", "*", "", "deleting"),
+                ]
+
+        def invalidates_cached_state_under_target(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, exited=1)
+            enable_cache(cxn)
+            assert not exists(cxn, "/srv/app/new")
+            assert not exists(cxn, "/srv/other")
+            rsync(cxn, local, "/srv/app")
+            cxn.run.return_value = Result(connection=cxn, exited=0)
+            assert exists(cxn, "/srv/app/new")
+            assert not exists(cxn, "/srv/other")
+            assert cxn.run.call_count == 3
+
+        def skipped_transfers_keep_cached_state(self, cxn):
+            cxn.run.return_value = Result(connection=cxn, exited=1)
+            cxn.local.return_value = Result(connection=cxn, stdout="")
+            enable_cache(cxn)
+            exists(cxn, "/srv/app/new")
+            rsync(cxn, local, "/srv/app", detect_changes=True)
+            assert not exists(cxn, "/srv/app/new")
+            assert cxn.run.call_count == 1
+
+    class parse_itemized_:
+
+        def ignores_unchanged_entries(self):
+            assert parse_itemized(".f          same.txt\n") == []
+            assert parse_itemized(".d..t...... ./\n") == [
+                Change("./", ".", "d", "..t......")
+            ]
+
+        def handles_paths_with_spaces(self):
+            assert parse_itemized(">f+++++++++ my file.txt") == [
+                Change("my file.txt", ">", "f", "+++++++++")
+            ]
+
+    class rsync_many_:
+
+        def _cxns(self, count, stdout=""):
+            cxns = []
+            for index in range(count):
+                c = Connection("host{}".format(index), user="user")
+                result = Result(connection=c, stdout=stdout)
+                c.local = Mock(return_value=result)
+                cxns.append(c)
+            return cxns
+
+        def syncs_every_host_with_stats_and_hidden_output(self):
+            cxns = self._cxns(3)
+            rsync_many(cxns, local, remote)
+            for c in cxns:
+                command = c.local.call_args[0][0]
+                assert "--stats" in command
+                assert command.endswith(
+                    "{} user@{}:{}".format(local, c.host, remote)
+                )
+                assert c.local.call_args[1] == {"hide": True}
+
+        def returns_parsed_stats_per_host(self):
+            stdout = "Number of files: 3\nTotal file size: 1,024 bytes\n"
+            cxns = self._cxns(2, stdout=stdout)
+            results = rsync_many(cxns, local, remote)
+            for c in cxns:
+                report = results[c]
+                assert report.result.ok
+                assert report.stats == {"files": 3, "total_size": 1024}
+
+        def splits_bandwidth_budget_across_workers(self):
+            cxns = self._cxns(10)
+            rsync_many(cxns, local, remote, workers=4, bwlimit=1000)
+            assert "--bwlimit=250" in cxns[0].local.call_args[0][0]
+
+        def budget_not_split_more_than_host_count(self):
+            cxns = self._cxns(2)
+            rsync_many(cxns, local, remote, workers=8, bwlimit=1000)
+            assert "--bwlimit=500" in cxns[0].local.call_args[0][0]
+
+        def passes_through_rsync_kwargs(self):
+            cxns = self._cxns(1)
+            rsync_many(
+                cxns, local, remote, exclude="foo", rsync_opts="--checksum"
+            )
+            command = cxns[0].local.call_args[0][0]
+            assert '--exclude "foo"' in command
+            assert "--checksum --stats" in command
+
+        def invalidates_cached_state_per_host(self):
+            cxns = self._cxns(2)
+            for c in cxns:
+                c.run = Mock(return_value=Result(connection=c, exited=1))
+                enable_cache(c)
+                exists(c, "{}/new".format(remote))
+            rsync_many(cxns, local, remote)
+            for c in cxns:
+                exists(c, "{}/new".format(remote))
+                assert c.run.call_count == 2
+
+        def rejects_options_it_does_not_support(self):
+            cxns = self._cxns(1)
+            for kwargs in (
+                dict(detect_changes=True),
+                dict(multiplex=True),
+                dict(nope=1),
+            ):
+                with raises(TypeError):
+                    rsync_many(cxns, local, remote, **kwargs)
+            assert not cxns[0].local.called
+
+        def failures_raise_group_exception(self):
+            cxns = self._cxns(2)
+            failure = UnexpectedExit(Result(connection=cxns[0], exited=23))
+            cxns[0].local.side_effect = failure
+            with raises(GroupException) as info:
+                rsync_many(cxns, local, remote)
+            error = info.value.result.failed[cxns[0]]
+            assert isinstance(error, SyncError)
+            assert error.result is failure.result
+            assert cxns[1] in info.value.result.succeeded
+
+        def failed_hosts_keep_their_stats(self):
+            cxns = self._cxns(1)
+            stdout = "Number of files: 3\nTotal bytes sent: 2,048\n"
+            result = Result(connection=cxns[0], stdout=stdout, exited=23)
+            cxns[0].local.side_effect = UnexpectedExit(result)
+            with raises(GroupException) as info:
+                rsync_many(cxns, local, remote)
+            error = info.value.result[cxns[0]]
+            assert isinstance(error, UnexpectedExit)
+            assert error.stats == {"files": 3, "bytes_sent": 2048}
+            assert error.report.result is result
+
+        def workers_may_be_none(self):
+            cxns = self._cxns(4)
+            rsync_many(cxns, local, remote, workers=None, bwlimit=1000)
+            assert "--bwlimit=250" in cxns[0].local.call_args[0][0]
+
+    class parse_stats_:
+
+        def parses_modern_rsync_output(self):
+            output = """
+Number of files: 12 (reg: 10, dir: 2)
+Number of created files: 0
+Number of regular files transferred: 4
+Total file size: 12,345 bytes
+Total transferred file size: 2,048 bytes
+Total bytes sent: 3,000
+Total bytes received: 120
+
+sent 3,000 bytes  received 120 bytes  6,240.00 bytes/sec
+"""
+            assert parse_stats(output) == {
+                "files": 12,
+                "files_transferred": 4,
+                "total_size": 12345,
+                "transferred_size": 2048,
+                "bytes_sent": 3000,
+                "bytes_received": 120,
+            }
@@ -1,8 +1,29 @@
+import inspect
+import pickle
 import re
+import sys
+import threading
 
 from invoke import Context
+from invoke.exceptions import UnexpectedExit
+from mock import Mock
+from pytest import mark, raises
 
-from patchwork.util import set_runner
+from patchwork.files import directory, exists
+from patchwork.util import (
+    Pipeline,
+    add_call_wrapper,
+    context_state,
+    remove_call_wrapper,
+    set_runner,
+)
+
+
+def _local():
+    # Real local context which won't try reading pytest's captured stdin
+    c = Context()
+    c.config.run.in_stream = False
+    return c
 
 
 class util:
@@ -183,3 +204,226 @@ seriously, whatever
                     myfunc.__doc__,
                     re.DOTALL,
                 )
+
+            @mark.skipif(sys.version_info < (3,), reason="Python 3 syntax")
+            def keyword_only_and_variadic_args(self):
+                ns = {}
+                source = "def myfunc(c, runner, foo, *args, bar=1, baz, **kw):"
+                exec(source + " pass", ns)
+                munged = set_runner(ns["myfunc"])
+                assert munged.__doc__.startswith(
+                    "myfunc(c, foo, sudo=False, runner_method='run', "
+                    "runner=None, *args, bar=1, baz, **kw)\n"
+                )
+
+        def poses_as_the_wrapped_function(self):
+
+            @set_runner
+            def myfunc(c, runner):
+                pass
+
+            assert myfunc.__name__ == "myfunc"
+            assert myfunc.__module__ == __name__
+            assert inspect.isfunction(myfunc)
+
+        def pickles_by_reference(self):
+            assert pickle.loads(pickle.dumps(directory)) is directory
+
+        def binds_as_a_method(self):
+
+            class Thing(object):
+                run = Mock()
+
+                @set_runner
+                def method(self, runner, arg):
+                    runner(arg)
+
+            thing = Thing()
+            thing.method("hi")
+            thing.run.assert_called_once_with("hi")
+
+    class call_wrappers:
+
+        def may_observe_and_replace_results(self, cxn):
+            cxn.sudo = Mock()
+            calls = []
+
+            def wrapper(call, proceed):
+                calls.append(call)
+                return proceed() is None and "replaced"
+
+            add_call_wrapper(wrapper)
+            try:
+                assert directory(cxn, "/srv", sudo=True) == "replaced"
+            finally:
+                remove_call_wrapper(wrapper)
+            cxn.sudo.assert_called_once_with("mkdir -p /srv")
+            call = calls[0]
+            assert call.function == "patchwork.files.directory"
+            assert call.context is cxn
+            assert call.args == ("/srv",)
+            assert call.kwargs == {}
+            assert call.method == "sudo"
+
+        def may_skip_calls(self, cxn):
+            def wrapper(call, proceed):
+                return False
+
+            add_call_wrapper(wrapper)
+            try:
+                assert exists(cxn, "/srv") is False
+            finally:
+                remove_call_wrapper(wrapper)
+            assert not cxn.run.called
+
+        def nest_in_registration_order(self, cxn):
+            order = []
+
+            def outer(call, proceed):
+                order.append("outer")
+                return proceed()
+
+            def inner(call, proceed):
+                order.append("inner")
+                return proceed()
+
+            add_call_wrapper(outer)
+            add_call_wrapper(inner)
+            try:
+                directory(cxn, "/srv")
+            finally:
+                remove_call_wrapper(outer)
+                remove_call_wrapper(inner)
+            assert order == ["outer", "inner"]
+
+    class context_state_:
+
+        def returns_same_dict_per_context_and_namespace(self):
+            c = Context()
+            state = context_state(c, "mine")
+            state["key"] = "value"
+            assert context_state(c, "mine") is state
+            assert context_state(c, "other") == {}
+            assert context_state(Context(), "mine") == {}
+
+        def does_not_leak_into_config(self):
+            c = Context()
+            context_state(c, "mine")
+            assert "_patchwork_state" not in c.config
+
+        def first_use_from_many_threads_shares_one_dict(self):
+            contexts = [Context() for _ in range(50)]
+
+            def use(c):
+                context_state(c, "mine")[threading.current_thread()] = 1
+
+            for c in contexts:
+                threads = [
+                    threading.Thread(target=use, args=(c,)) for _ in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                assert len(context_state(c, "mine")) == 8
+
+    class Pipeline_:
+        # NOTE: these execute real (trivial) local shell commands, as the
+        # interesting bits are the generated script's markers & exit codes.
+
+        def queues_until_flushed(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            pipe = Pipeline(c)
+            directory(c, "/tmp", mode="0700", user="nobody", runner=pipe)
+            assert len(pipe.queue) == 3
+            assert not c.run.called
+            pipe.queue = []
+
+        def flushes_as_single_command_and_demultiplexes(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            with Pipeline(c) as pipe:
+                one = pipe("echo one; echo uno >&2", hide=True)
+                two = pipe("printf two", hide=True)
+                three = pipe("exit 3", hide=True, warn=True)
+            assert c.run.call_count == 1
+            assert c.run.call_args[0][0].startswith("sh -c ")
+            assert one.stdout == "one\n"
+            assert one.stderr == "uno\n"
+            assert one.command == "echo one; echo uno >&2"
+            assert two.stdout == "two"
+            assert three.exited == 3
+            assert not three
+
+        def attribute_access_forces_flush(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            pipe = Pipeline(c)
+            directory(c, "/tmp", runner=pipe)
+            assert exists(c, "/tmp", runner=pipe)
+            assert c.run.call_count == 1
+            assert pipe.queue == []
+
+        def lone_command_is_run_directly(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            with Pipeline(c) as pipe:
+                pipe("true", hide=True)
+            c.run.assert_called_once_with("true", hide=True)
+
+        def splits_huge_queues_over_several_scripts(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            with Pipeline(c) as pipe:
+                # Some 200KiB of script; more than one argument may hold
+                echoes = [
+                    pipe("echo {:04}{}".format(x, "x" * 150), hide=True)
+                    for x in range(1200)
+                ]
+            assert c.run.call_count > 1
+            assert all(len(x[0][0]) < 131072 for x in c.run.call_args_list)
+            for index, result in enumerate(echoes):
+                assert result.stdout.startswith("{:04}x".format(index))
+
+        def failure_stops_later_scripts(self):
+            c = _local()
+            c.run = Mock(wraps=c.run)
+            pipe = Pipeline(c)
+            pipe("exit 2", hide=True)
+            for _ in range(1200):
+                pipe("echo {}".format("x" * 150), hide=True)
+            with raises(UnexpectedExit):
+                pipe.flush()
+            assert c.run.call_count == 1
+
+        def failure_stops_script_and_raises(self):
+            c = _local()
+            pipe = Pipeline(c)
+            first = pipe("true", hide=True)
+            failing = pipe("exit 2", hide=True)
+            never = pipe("echo never", hide=True)
+            with raises(UnexpectedExit) as info:
+                pipe.flush()
+            assert info.value.result.command == "exit 2"
+            assert info.value.result.exited == 2
+            assert first.ok
+            for pending in (failing, never):
+                with raises(UnexpectedExit):
+                    pending.ok
+
+        def context_manager_does_not_flush_on_error(self):
+            c = _local()
+            c.run = Mock()
+            with raises(ValueError):
+                with Pipeline(c) as pipe:
+                    pipe("true")
+                    raise ValueError
+            assert not c.run.called
+
+        def sudo_flag_selects_sudo_runner(self):
+            c = _local()
+            c.sudo = Mock()
+            with Pipeline(c, sudo=True) as pipe:
+                pipe("true")
+            c.sudo.assert_called_once_with("true")